@@ -1,9 +1,34 @@
 '''
 Module to send data to domoticz
+
+All device updates of a poll are pipelined over one kept-alive
+connection. Devices whose value did not change more than the deadband
+since the last update are skipped (but refreshed every max_age seconds).
 '''
 # pylint: disable=E0401
-import urequests
+import time
 import ubinascii
+from http_client import HttpClient
+
+
+def _changed(old, new, deadband):
+    '''
+    True when new differs more than deadband from old
+    Values like "power;energy" are compared per part
+    '''
+    old_parts = str(old).split(';')
+    new_parts = str(new).split(';')
+    if len(old_parts) != len(new_parts):
+        return True
+    for old_part, new_part in zip(old_parts, new_parts):
+        try:
+            if abs(float(new_part) - float(old_part)) > deadband:
+                return True
+        except ValueError:
+            if old_part != new_part:
+                return True
+    return False
+
 
 class Domoticz:
     '''
@@ -12,28 +37,80 @@ class Domoticz:
     headers = ""
     url = ""
 
-    def __init__(self, url, username, password):
+    def __init__(self, url, username, password, deadband=0, max_age=300, pipeline=True):
         '''
         Set local vars
+        deadband: default allowed change, or dict idx -> deadband
         '''
         base64pass = ubinascii.b2a_base64(username+":"+password).decode("utf-8").rstrip()
         self.headers = {'Authorization':'Basic '+base64pass}
+        # 'http://host/domoticz/' must not give '//json.htm'
+        url = url.rstrip('/')
         self.url = url
+        parts = url.split('/', 3)
+        self.path = '/' + parts[3] if len(parts) > 3 else ''
+        self.client = HttpClient(url, headers=self.headers)
+        self.deadband = deadband
+        self.max_age = max_age
+        self.pipeline = pipeline
+        # idx -> (value, time.time()) of last update
+        self.last = {}
 
-    def send_data(self, data):
+    def __deadband(self, idx):
         '''
-        Send data
-        data = {'idx': value, 'idx': value}
+        Deadband of device idx
+        '''
+        if isinstance(self.deadband, dict):
+            return self.deadband.get(idx, 0)
+        return self.deadband
+
+    def __request_path(self, idx, val):
+        '''
+        Path of the update request of device idx
+        '''
+        return (self.path + "/json.htm?type=command&param=udevice&idx=" +
+                idx + "&nvalue=0&svalue=" + str(val))
+
+    def __send_pipelined(self, updates):
+        '''
+        Send all updates before reading the responses
+        Returns status codes, shorter than updates when the connection failed
         '''
         result = []
         try:
-            for key, val in data.items():
-                url = self.url + "/json.htm?type=command&param=udevice&idx="
-                url += key + "&nvalue=0&svalue=" + str(val)
-                client = urequests.get(url, headers=self.headers)
-                result.append(client.status_code)
-                client.close()
+            for idx, val in updates:
+                self.client.send('GET', self.__request_path(idx, val))
+            for _ in updates:
+                result.append(self.client.read_response()[0])
         except Exception as domoticz_error:
             print("Error in domo", domoticz_error)
-            result.append('err')
+            self.client.close()
+        return result
+
+    def send_data(self, data):
+        '''
+        Send data
+        data = {'idx': value, 'idx': value}
+        Returns a status code (or 'err') per device sent, unchanged devices are skipped
+        '''
+        now = time.time()
+        updates = []
+        for key, val in data.items():
+            last = self.last.get(key)
+            if (last is None or now - last[1] >= self.max_age or
+                    _changed(last[0], val, self.__deadband(key))):
+                updates.append((key, val))
+        result = []
+        if self.pipeline and len(updates) > 1:
+            result = self.__send_pipelined(updates)
+        # One by one what was not sent pipelined, an error does not stop the rest
+        for idx, val in updates[len(result):]:
+            try:
+                result.append(self.client.request('GET', self.__request_path(idx, val))[0])
+            except Exception as domoticz_error:
+                print("Error in domo", domoticz_error)
+                result.append('err')
+        for (idx, val), status in zip(updates, result):
+            if status == 200:
+                self.last[idx] = (val, now)
         return result
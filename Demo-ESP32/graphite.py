@@ -1,8 +1,37 @@
 '''
 class for communication with Graphite
+
+Metrics are buffered and sent in batches over one connection that is
+kept open (and reopened after an error). Both the plaintext (port 2003)
+and the pickle protocol (port 2004) are supported.
 '''
 import socket
 import time
+try:
+    import struct
+except ImportError:
+    import ustruct as struct
+
+# Seconds between 1970 and the epoch of time.time() (2000 on older micropython ports)
+EPOCH_OFFSET = 946684800 if time.gmtime(0)[0] == 2000 else 0
+
+
+def _pickle_metrics(metrics):
+    '''
+    Pickle (protocol 2) list of (path, (timestamp, value)) with length header
+    micropython has no pickle module, the few opcodes needed are written here.
+    '''
+    parts = [b'\x80\x02](']  # PROTO 2, EMPTY_LIST, MARK
+    for path, timestamp, value in metrics:
+        path = path.encode()
+        # BINUNICODE path, BINFLOAT timestamp, BINFLOAT value, TUPLE2, TUPLE2
+        parts.append(b'X' + struct.pack('<I', len(path)) + path)
+        parts.append(b'G' + struct.pack('>d', timestamp) + b'G' + struct.pack('>d', value))
+        parts.append(b'\x86\x86')
+    parts.append(b'e.')  # APPENDS, STOP
+    payload = b''.join(parts)
+    return struct.pack('>I', len(payload)) + payload
+
 
 class Graphite():
     '''
@@ -11,30 +40,107 @@ class Graphite():
     hostname = ""
     port = 0
 
-    def __init__(self, hostname, port):
+    def __init__(self, hostname, port, protocol='plaintext', flush_interval=10,
+                 batch_size=200, max_metrics=2000, timeout=5):
         '''
-        Set hostname and port
+        Set hostname and port, protocol is 'plaintext' or 'pickle'
+        Buffered metrics are sent every flush_interval seconds or when
+        batch_size are waiting, at most max_metrics are kept when Graphite is down.
         '''
+        if protocol not in ('plaintext', 'pickle'):
+            raise Exception('Unknown protocol')
         self.hostname = hostname
         self.port = port
+        self.protocol = protocol
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_metrics = max_metrics
+        self.timeout = timeout
+        # (path, timestamp, value)
+        self.metrics = []
+        self.last_flush = time.time()
+        self.sock = None
 
-    def send_data(self, data, timestamp=False):
+    def connect(self):
         '''
-        Send data to plaintext input
+        Open connection (when not open yet)
         '''
-        if time.time() < 692284226:
-            raise Exception('Time not set!')
-        if not timestamp:
-            timestamp = time.time() + 946684800
+        if self.sock is not None:
+            return
         g_sock = socket.socket()
+        g_sock.settimeout(self.timeout)
         try:
-            g_sock.connect((self.hostname, self.port))
-            g_msg = ""
-            for key, val in data.items():
-                g_msg += key+' '+str(val)+' '+str(timestamp)+'\n'
-            g_sock.sendall(g_msg)
+            g_sock.connect(socket.getaddrinfo(self.hostname, self.port)[0][-1])
+        except Exception:
             g_sock.close()
-        except Exception as graphite_error:
-            print("Error in graphite", graphite_error)
-            return "err"
+            raise
+        self.sock = g_sock
+
+    def close(self):
+        '''
+        Close connection, the next flush reconnects
+        '''
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+    def __encode(self, metrics):
+        '''
+        Message for metrics in configured protocol
+        '''
+        if self.protocol == 'pickle':
+            return _pickle_metrics(metrics)
+        return ''.join(
+            ['%s %s %d\n' % (path, value, timestamp) for path, timestamp, value in metrics]
+        ).encode()
+
+    def add_data(self, data, timestamp=False):
+        '''
+        Buffer data = {'metric.path': value}
+        '''
+        if not timestamp:
+            timestamp = time.time() + EPOCH_OFFSET
+        for key, val in data.items():
+            self.metrics.append((key, timestamp, float(val)))
+        if len(self.metrics) > self.max_metrics:
+            # Drop oldest metrics
+            del self.metrics[:len(self.metrics) - self.max_metrics]
+
+    def flush_due(self):
+        '''
+        True when buffered metrics should be sent
+        '''
+        return bool(self.metrics) and (
+            len(self.metrics) >= self.batch_size or
+            time.time() - self.last_flush >= self.flush_interval)
+
+    def flush(self):
+        '''
+        Send all buffered metrics, on failure they are kept for the next flush
+        '''
+        self.last_flush = time.time()
+        while self.metrics:
+            batch = self.metrics[:self.batch_size]
+            try:
+                self.connect()
+                self.sock.sendall(self.__encode(batch))
+            except Exception as graphite_error:
+                print("Error in graphite", graphite_error)
+                self.close()
+                return "err"
+            del self.metrics[:len(batch)]
+        return True
+
+    def send_data(self, data, timestamp=False):
+        '''
+        Buffer data, send buffered metrics when due
+        '''
+        if time.time() < 692284226:
+            raise Exception('Time not set!')
+        self.add_data(data, timestamp)
+        if self.flush_due():
+            return self.flush()
         return True
@@ -0,0 +1,186 @@
+'''
+Minimal HTTP/1.1 client keeping its connection open between requests
+
+urequests opens a new connection for every request, this client
+reuses one socket (keep-alive) and reconnects when the server closed it.
+Requests can be pipelined: send() several, then read_response() for each.
+'''
+# pylint: disable=E0401
+import socket
+try:
+    import ssl
+except ImportError:
+    import ussl as ssl
+
+
+class HttpClient:
+    '''
+    Keep-alive connection to one HTTP server
+    '''
+    host = ''
+    port = 80
+
+    def __init__(self, url, timeout=5, headers=None):
+        '''
+        url: http(s)://host[:port], headers are sent with every request
+        '''
+        scheme, _, address = url.split('/', 3)[:3]
+        self.tls = scheme == 'https:'
+        self.host = address
+        self.port = 443 if self.tls else 80
+        if ':' in address:
+            self.host, port = address.split(':', 1)
+            self.port = int(port)
+        self.timeout = timeout
+        self.headers = headers or {}
+        self.sock = None
+        self.stream = None
+        self.write = None
+
+    def connect(self):
+        '''
+        Open connection (when not open yet)
+        '''
+        if self.sock is not None:
+            return
+        address = socket.getaddrinfo(self.host, self.port)[0][-1]
+        sock = socket.socket()
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(address)
+            if self.tls:
+                if hasattr(ssl, 'create_default_context'):
+                    sock = ssl.create_default_context().wrap_socket(
+                        sock, server_hostname=self.host)
+                else:
+                    sock = ssl.wrap_socket(sock, server_hostname=self.host)
+        except Exception:
+            sock.close()
+            raise
+        self.sock = sock
+        self.stream = sock.makefile('rb')
+        # micropython TLS sockets only have write()
+        self.write = getattr(sock, 'sendall', None) or sock.write
+
+    def close(self):
+        '''
+        Close connection, the next request reconnects
+        '''
+        if self.sock is not None:
+            try:
+                if self.stream is not self.sock:
+                    self.stream.close()
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.stream = None
+        self.write = None
+
+    def send(self, method, path, body=None, headers=None):
+        '''
+        Send request without waiting for the response (see read_response)
+        '''
+        self.connect()
+        lines = [method + ' ' + path + ' HTTP/1.1', 'Host: ' + self.host]
+        for key, val in self.headers.items():
+            lines.append(key + ': ' + val)
+        if headers:
+            for key, val in headers.items():
+                lines.append(key + ': ' + val)
+        if body is not None:
+            if isinstance(body, str):
+                body = body.encode()
+            lines.append('Content-Length: ' + str(len(body)))
+        lines.append('')
+        lines.append('')
+        try:
+            self.write('\r\n'.join(lines).encode())
+            if body:
+                self.write(body)
+        except Exception:
+            self.close()
+            raise
+
+    def read_response(self):
+        '''
+        Read response of oldest request sent, returns (status, body)
+        '''
+        try:
+            status_line = self.stream.readline()
+            if not status_line:
+                raise OSError('Connection closed')
+            status = int(status_line.split(None, 2)[1])
+            length = None
+            chunked = False
+            keep_alive = not status_line.startswith(b'HTTP/1.0')
+            while True:
+                line = self.stream.readline()
+                if not line or line == b'\r\n':
+                    break
+                key, _, val = line.decode().partition(':')
+                key = key.strip().lower()
+                val = val.strip().lower()
+                if key == 'content-length':
+                    length = int(val)
+                elif key == 'transfer-encoding' and val == 'chunked':
+                    chunked = True
+                elif key == 'connection':
+                    keep_alive = val != 'close'
+            if chunked:
+                body = self.__read_chunked()
+            elif length is not None:
+                body = self.__read_exact(length)
+            else:
+                # Body ends when the server closes the connection
+                body = self.stream.read()
+                keep_alive = False
+        except Exception:
+            self.close()
+            raise
+        if not keep_alive:
+            self.close()
+        return status, body
+
+    def __read_exact(self, length):
+        '''
+        Read exactly length bytes
+        '''
+        parts = []
+        while length > 0:
+            part = self.stream.read(length)
+            if not part:
+                raise OSError('Connection closed')
+            parts.append(part)
+            length -= len(part)
+        return b''.join(parts)
+
+    def __read_chunked(self):
+        '''
+        Read chunked transfer encoded body
+        '''
+        parts = []
+        while True:
+            size = int(self.stream.readline().split(b';')[0], 16)
+            if size == 0:
+                # Skip trailers
+                while self.stream.readline() not in (b'\r\n', b''):
+                    pass
+                return b''.join(parts)
+            parts.append(self.__read_exact(size))
+            self.stream.readline()
+
+    def request(self, method, path, body=None, headers=None):
+        '''
+        Send request and read response, returns (status, body)
+        A request on a connection the server closed meanwhile is retried once.
+        '''
+        reused = self.sock is not None
+        try:
+            self.send(method, path, body, headers)
+            return self.read_response()
+        except OSError:
+            if not reused:
+                raise
+        self.send(method, path, body, headers)
+        return self.read_response()
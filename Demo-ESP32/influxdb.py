@@ -1,8 +1,73 @@
 '''
 InfluxDB Client
+
+Points are buffered with their timestamp and written in batches
+(line protocol, one line per point) over a reused HTTP connection.
+When a write fails the points are kept and sent with the next flush,
+so readings taken during an outage arrive with their original time.
+The age limit is only checked when called: call flush_if_due() regularly
+(every poll cycle) and flush() on shutdown.
 '''
 # pylint: disable=E0401
-import urequests
+import time
+import _thread
+from http_client import HttpClient
+
+# Seconds between 1970 and the epoch of time.time() (2000 on older micropython ports)
+EPOCH_OFFSET = 946684800 if time.gmtime(0)[0] == 2000 else 0
+
+
+def _gzip(data):
+    '''
+    Gzip compress data, returns None when not supported (micropython < 1.21)
+    '''
+    try:
+        import gzip
+        return gzip.compress(data)
+    except ImportError:
+        pass
+    try:
+        import io
+        import deflate
+    except ImportError:
+        return None
+    buffer = io.BytesIO()
+    with deflate.DeflateIO(buffer, deflate.GZIP) as stream:
+        stream.write(data)
+    return buffer.getvalue()
+
+
+def _escape(value, chars):
+    '''
+    Escape chars in measurement, tag or field names
+    '''
+    value = str(value)
+    for char in chars:
+        value = value.replace(char, '\\' + char)
+    return value
+
+
+def line_protocol(measurement, fields, tags=None, timestamp=None):
+    '''
+    Format one point in line protocol, timestamp in seconds (unix epoch)
+    '''
+    parts = [_escape(measurement, ', ')]
+    if tags:
+        for key in sorted(tags):
+            parts.append(',' + _escape(key, ',= ') + '=' + _escape(tags[key], ',= '))
+    separator = ' '
+    for key, val in fields.items():
+        if isinstance(val, str):
+            val = '"' + val.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        elif isinstance(val, bool):
+            val = 'true' if val else 'false'
+        else:
+            val = str(val)
+        parts.append(separator + _escape(key, ',= ') + '=' + val)
+        separator = ','
+    if timestamp is not None:
+        parts.append(' ' + str(int(timestamp)))
+    return ''.join(parts)
 
 
 class InfluxDBClient:
@@ -11,37 +76,103 @@ class InfluxDBClient:
     '''
     url = ''
 
-    def __init__(self, url, db_name, username, token):
+    def __init__(self, url, db_name, username, token, batch_size=50, max_age=60,
+                 max_points=1000, gzip=False):
         '''
-        Set local var for url
+        Flush when batch_size points are buffered or the oldest is max_age
+        seconds old. At most max_points are kept while the server is unreachable.
+        '''
+        self.client = None
+        self.set_url(url, db_name, username, token)
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.max_points = max_points
+        self.gzip = gzip
+        # Line protocol lines and time.time() of the oldest one
+        self.lines = []
+        self.oldest = None
+        # write() and flush_if_due() may run on different threads
+        self.lock = _thread.allocate_lock()
+
+    def add_point(self, measurement, fields, tags=None, timestamp=None):
+        '''
+        Buffer point, timestamp is time.time() by default
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        if not self.lines:
+            self.oldest = time.time()
+        self.lines.append(line_protocol(measurement, fields, tags, timestamp + EPOCH_OFFSET))
+        if len(self.lines) > self.max_points:
+            # Drop oldest points
+            del self.lines[:len(self.lines) - self.max_points]
+
+    def flush_due(self):
+        '''
+        True when buffered points should be written
         '''
-        self.url = url+'/write?db='+db_name+'&u='+username+'&p='+token
-        # To be implemented:
-        # https://docs.influxdata.com/influxdb/v1.8/tools/api/#apiv2write-http-endpoint
+        if not self.lines:
+            return False
+        return (len(self.lines) >= self.batch_size or
+                time.time() - self.oldest >= self.max_age)
 
-    def write(self, bucket, data):
+    def flush(self):
         '''
-        Post data
+        Write all buffered points, returns HTTP status or "err"
         '''
-        influx_data = ""
-        result = False
-        http_client = ""
-        for key, val in data.items():
-            influx_data += key+'='+str(val)+','
+        if not self.lines:
+            return True
+        count = len(self.lines)
+        body = '\n'.join(self.lines).encode()
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if self.gzip:
+            compressed = _gzip(body)
+            if compressed is not None:
+                body = compressed
+                headers['Content-Encoding'] = 'gzip'
         try:
-            http_client = urequests.post(
-                self.url,
-                data=bucket+' '+influx_data[:-1])
-            result = http_client.status_code
-            http_client.close()
+            status = self.client.request('POST', self.path, body, headers)[0]
         except Exception as influx_error:
             print("Error in influx", influx_error)
-            result = "err"
+            return "err"
+        if status < 500:
+            # Written, or rejected for good (4xx): do not resend
+            del self.lines[:count]
+            self.oldest = time.time() if self.lines else None
+        return status
 
-        return result
+    def flush_if_due(self, wait=False):
+        '''
+        Flush when due (batch full or oldest point too old)
+        Returns flush result, True when nothing was written. Without wait
+        it returns right away while another thread writes.
+        '''
+        if not self.lock.acquire(1 if wait else 0):
+            return True
+        try:
+            if self.flush_due():
+                return self.flush()
+            return True
+        finally:
+            self.lock.release()
+
+    def write(self, bucket, data, tags=None, timestamp=None):
+        '''
+        Buffer data as point of measurement bucket, flush when due
+        Returns flush result, True when only buffered
+        '''
+        with self.lock:
+            self.add_point(bucket, data, tags, timestamp)
+            if self.flush_due():
+                return self.flush()
+            return True
 
     def set_url(self, url, db_name, username, token):
         '''
         Set local var for url
         '''
-        self.url = url+'/write?db='+db_name+'&u='+username+'&p='+token
+        self.url = url+'/write?db='+db_name+'&u='+username+'&p='+token+'&precision=s'
+        self.path = '/' + self.url.split('/', 3)[3]
+        if self.client is not None:
+            self.client.close()
+        self.client = HttpClient(url)
@@ -11,8 +11,10 @@ from machine import UART
 from machine import Pin
 import ntptime
 from aps_yc600 import ApsYc600
+from aps_scheduler import Scheduler
+from aps_fanout import FanOut
 from influxdb import InfluxDBClient
-from graphite import Graphite
+from graphite import Graphite, EPOCH_OFFSET as GRAPHITE_EPOCH_OFFSET
 from domoticz import Domoticz
 from _creds import secrets
 # RX = GPIO09 / SD2
@@ -41,6 +43,8 @@ time.sleep(1)
 inverter = ApsYc600(serial, serial)
 inverter.add_inverter(secrets['inv_serial'], secrets['inv_id'], 2)
 print("Coordinator starting", inverter.start_coordinator())
+# Poll when producing, back off when the inverter does not answer
+scheduler = Scheduler(inverter)
 
 # Graphite logger
 graphite_client = Graphite(secrets['graphite_host'], secrets['graphite_port'])
@@ -56,13 +60,12 @@ influx_client = InfluxDBClient(
     secrets['influx_user'],
     secrets['influx_pass'])
 
-# Send data to all destinations
-def push_data(data):
+# Sink functions run on the fan-out thread, reading = (poll time, data)
+def push_influx(reading):
     '''
-    Send data out
+    Influx output
     '''
-    result = []
-    # Influx output
+    timestamp, data = reading
     data_xlate = {
         'acv': data['voltage_ac'],
         'dcc0': data['current_dc1'],
@@ -75,10 +78,16 @@ def push_data(data):
         'pow_p1': data['watt_panel2'],
         'power': round(data['watt_panel1'] + data['watt_panel2'], 2),
         'temp': data['temperature']}
-    result.append(influx_client.write(secrets['influx_bucket'], data_xlate))
+    result = influx_client.write(
+        secrets['influx_bucket'], data_xlate, {'inverter': secrets['inv_serial']}, timestamp)
     gc.collect()
+    return result
 
-    # Domoticz output
+def push_domoticz(reading):
+    '''
+    Domoticz output
+    '''
+    data = reading[1]
     data_energy = str(round(data['watt_panel1'] + data['watt_panel2'], 2))
     data_energy += ';'
     data_energy += str(data['energy_panel1'] + data['energy_panel2'])
@@ -90,10 +99,15 @@ def push_data(data):
         '221': data['watt_panel2'],
         '222': data['temperature'],
         '223': data['voltage_ac']}
-    result.append(domo_client.send_data(data_xlate))
+    result = domo_client.send_data(data_xlate)
     gc.collect()
+    return result
 
-    # Graphite output
+def push_graphite(reading):
+    '''
+    Graphite output
+    '''
+    timestamp, data = reading
     data_xlate = {
         'energy.data.aps.acv': data['voltage_ac'],
         'energy.data.aps.dcc0': data['current_dc1'],
@@ -106,11 +120,25 @@ def push_data(data):
         'energy.data.aps.pow1': data['watt_panel2'],
         'energy.data.solar_aps': round(data['watt_panel1'] + data['watt_panel2'], 2),
         'energy.data.aps.temp': data['temperature']}
-    result.append(graphite_client.send_data(data_xlate))
+    result = graphite_client.send_data(data_xlate, timestamp + GRAPHITE_EPOCH_OFFSET)
     gc.collect()
-
     return result
 
+# Slow or unreachable outputs must not delay polling: one extra thread drains
+# a small queue per output
+fanout = FanOut(shared_worker=True)
+fanout.add_sink('influx', push_influx, maxlen=10)
+fanout.add_sink('domoticz', push_domoticz, maxlen=2)
+fanout.add_sink('graphite', push_graphite, maxlen=10)
+fanout.start()
+
+# Send data to all destinations
+def push_data(data):
+    '''
+    Queue data for all outputs, returns number of outputs that dropped a reading
+    '''
+    return fanout.publish((time.time(), data))
+
 def reset_data():
     '''
     Send all zeros to reset stats for new day
@@ -146,13 +174,22 @@ def ntp_update():
             print('NTP not updated!', ntp_error)
             time.sleep(5)
 
+polling = True
+
+def shutdown():
+    '''
+    Stop the poll thread after its current cycle, it then flushes all outputs
+    '''
+    global polling
+    polling = False
+
 def do_poll():
     '''
     Poll inverter and write to influx client
     '''
     current_day = -1
     last_ntp_update = time.time()
-    while True:
+    while polling:
         # Do we need to update via NTP?
         if last_ntp_update + 7200 < time.time() or time.time() < 692284226:
             print("NTP Update needed")
@@ -164,29 +201,31 @@ def do_poll():
                 current_day = time.gmtime()[2]
 
         try:
-            if inverter.ping_radio():
-                success = False
-                tries = 5
-                while not success and tries > 0:
-                    result = inverter.poll_inverter(0)
-                    if not 'error' in result:
-                        success = True
-                    tries = tries - 1
-                if success:
-                    if result['crc']:
-                        print("Data written:", push_data(result['data']))
-                else:
+            results = scheduler.poll_due()
+            for result in results.values():
+                if 'error' in result:
                     print("No reading", result)
-            else:
-                print('radio not healthy')
+                elif result['crc']:
+                    print("Data queued, dropped:", push_data(result['data']))
+            if results and all('error' in result for result in results.values()):
+                if not inverter.ping_radio():
+                    print('radio not healthy')
             # If day changed, reset counters
             if current_day != time.gmtime()[2] and current_day > 0:
                 reset_data()
                 current_day = time.gmtime()[2]
         except Exception as global_error:
             print("Oh noes", global_error)
+        # Points also get old when no new reading arrives (night, inverter offline)
+        influx_client.flush_if_due()
         gc.collect()
-        time.sleep(30)
+        # Sleep until the next inverter is due (check NTP / day change at least every 30s)
+        when = scheduler.next_due()[0]
+        time.sleep(max(1, min(30, when - time.time())))
+    # Send what is still queued or buffered
+    fanout.stop()
+    with influx_client.lock:
+        influx_client.flush()
 
 # Start poll thread
 _thread.start_new_thread(do_poll, ())
@@ -0,0 +1,132 @@
+'''
+Batch decoder for archived poll responses (AF_INCOMING_MSG frames)
+
+Decodes many responses at once into columns, using NumPy when it is
+installed and plain int.from_bytes otherwise. Scaling is shared with
+ApsYc600, values are not rounded.
+
+    columns = decode_batch(frames, num_panels=2)
+    print(columns['watt_panel1'][:10])
+'''
+from array import array
+from aps_yc600 import (
+    POLL_DATA_OFFSET, PANEL_OFFSETS, ENERGY_OFFSETS,
+    TEMPERATURE_OFFSET, TEMPERATURE_SCALE, FREQUENCY_BASE,
+    CURRENT_DC_SCALE, VOLTAGE_DC_SCALE, VOLTAGE_AC_SCALE, ENERGY_SCALE)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Poll data needed for decoding (last energy counter ends at 57)
+POLL_DATA_LENGTH = 57
+
+
+def columns_for(num_panels):
+    '''
+    Column names returned by decode_batch
+    '''
+    if num_panels not in (2, 4):
+        raise Exception("Only 2 or 4 panels supported")
+    names = ['temperature', 'freq_ac', 'voltage_ac']
+    for name in ('current_dc', 'voltage_dc', 'energy_panel', 'watt_panel'):
+        names.extend(name + str(panel + 1) for panel in range(num_panels))
+    return names
+
+
+def _stack(frames, offset):
+    '''
+    Cut poll data of every frame to the same length and join them
+    '''
+    end = offset + POLL_DATA_LENGTH
+    parts = []
+    for frame in frames:
+        if len(frame) < end:
+            raise Exception('Frame too short for poll response')
+        parts.append(bytes(frame[offset:end]))
+    return b''.join(parts)
+
+
+def _decode_numpy(data, count, num_panels):
+    '''
+    Decode stacked poll data using NumPy
+    '''
+    rows = numpy.frombuffer(data, dtype=numpy.uint8).reshape(count, POLL_DATA_LENGTH)
+    rows = rows.astype(numpy.uint32)
+
+    def uint_be(start, end):
+        value = numpy.zeros(count, dtype=numpy.uint32)
+        for pos in range(start, end):
+            value = (value << 8) | rows[:, pos]
+        return value
+
+    result = {
+        'temperature': TEMPERATURE_OFFSET + uint_be(12, 14) * TEMPERATURE_SCALE,
+        'freq_ac': FREQUENCY_BASE / uint_be(14, 17),
+        'voltage_ac': (uint_be(30, 32) * VOLTAGE_AC_SCALE) / 4}
+    for panel in range(num_panels):
+        curr_pos, shared_pos, volt_pos = PANEL_OFFSETS[panel]
+        current = (rows[:, curr_pos] + ((rows[:, shared_pos] & 0x0F) << 8)) * CURRENT_DC_SCALE
+        voltage = ((rows[:, volt_pos] << 4) + (rows[:, shared_pos] >> 4)) * VOLTAGE_DC_SCALE
+        energy_pos = ENERGY_OFFSETS[panel]
+        name = str(panel + 1)
+        result['current_dc' + name] = current
+        result['voltage_dc' + name] = voltage
+        result['energy_panel' + name] = uint_be(energy_pos, energy_pos + 3) * ENERGY_SCALE
+        result['watt_panel' + name] = current * voltage
+    return result
+
+
+def _decode_python(data, count, num_panels):
+    '''
+    Decode stacked poll data in plain Python, columns are array('d')
+    '''
+    result = {}
+    for name in columns_for(num_panels):
+        result[name] = array('d', bytes(8 * count))
+    from_bytes = int.from_bytes
+    for row in range(count):
+        base = row * POLL_DATA_LENGTH
+        result['temperature'][row] = TEMPERATURE_OFFSET + (
+            from_bytes(data[base + 12:base + 14], 'big') * TEMPERATURE_SCALE)
+        period = from_bytes(data[base + 14:base + 17], 'big')
+        # Same as NumPy for broken frames
+        result['freq_ac'][row] = FREQUENCY_BASE / period if period else float('inf')
+        result['voltage_ac'][row] = (
+            from_bytes(data[base + 30:base + 32], 'big') * VOLTAGE_AC_SCALE) / 4
+        for panel in range(num_panels):
+            curr_pos, shared_pos, volt_pos = PANEL_OFFSETS[panel]
+            shared = data[base + shared_pos]
+            current = (data[base + curr_pos] + ((shared & 0x0F) << 8)) * CURRENT_DC_SCALE
+            voltage = ((data[base + volt_pos] << 4) + (shared >> 4)) * VOLTAGE_DC_SCALE
+            energy_pos = base + ENERGY_OFFSETS[panel]
+            name = str(panel + 1)
+            result['current_dc' + name][row] = current
+            result['voltage_dc' + name][row] = voltage
+            result['energy_panel' + name][row] = from_bytes(
+                data[energy_pos:energy_pos + 3], 'big') * ENERGY_SCALE
+            result['watt_panel' + name][row] = current * voltage
+    return result
+
+
+def decode_batch(frames, num_panels=2, offset=POLL_DATA_OFFSET, use_numpy=None):
+    '''
+    Decode list of poll response frames of inverters with num_panels.
+    Use offset=0 when frames contain only the poll data.
+    Returns dict of column name to NumPy array (or array('d'))
+    '''
+    names = columns_for(num_panels)
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    elif use_numpy and numpy is None:
+        raise Exception('NumPy not available')
+    data = _stack(frames, offset)
+    count = len(data) // POLL_DATA_LENGTH
+    if count == 0:
+        if use_numpy:
+            return {name: numpy.zeros(0) for name in names}
+        return {name: array('d') for name in names}
+    if use_numpy:
+        return _decode_numpy(data, count, num_panels)
+    return _decode_python(data, count, num_panels)
@@ -0,0 +1,412 @@
+'''
+Software CC2530 / inverter emulator for testing without hardware
+
+Speaks the part of the ZNP protocol ApsYc600 uses (coordinator start,
+ping, pairing and polls) for any number of virtual YC600 / QS1
+inverters, with configurable latency, loss, NoRoute replies and counter
+resets. Connect over a pty (for python3-serial) or a socket pair:
+
+    emulator = Cc2530Emulator(seed=1)
+    for number in range(200):
+        emulator.add_inverter('4080%08d' % number, '%04X' % (number + 1))
+    port = emulator.open_socket()
+    inverter = ApsYc600(port, port)
+    ...
+    emulator.stop()
+'''
+import heapq
+import os
+import random
+import socket
+import threading
+import time
+from binascii import unhexlify
+from aps_yc600 import (
+    FrameParser, build_frame, frame_from_hex,
+    PANEL_OFFSETS, ENERGY_OFFSETS, POLL_DATA_OFFSET,
+    TEMPERATURE_OFFSET, TEMPERATURE_SCALE, FREQUENCY_BASE,
+    CURRENT_DC_SCALE, VOLTAGE_DC_SCALE, VOLTAGE_AC_SCALE, ENERGY_SCALE)
+
+# Fixed responses of the coordinator
+WRITE_CONF_RESP = frame_from_hex('660500')
+RESET_IND = frame_from_hex('4180020202020702')
+AF_REGISTER_RESP = frame_from_hex('640000')
+START_RESP = frame_from_hex('6600')
+STATE_STARTING = frame_from_hex('45C008')
+STATE_COORDINATOR = frame_from_hex('45C009')
+PING_RESP = frame_from_hex('61017907')
+DATA_REQ_RESP = frame_from_hex('640100')
+DATA_REQ_EXT_RESP = frame_from_hex('640200')
+
+# Poll response frame without SOF, length and FCS: cmd (2) + 108 bytes
+POLL_RESPONSE_LENGTH = 110
+
+
+def _raw(value, scale, maximum):
+    '''
+    Scaled value to raw counter value, clipped to range
+    '''
+    return max(0, min(maximum, int(round(value / scale))))
+
+
+class VirtualInverter:
+    '''
+    Simulated YC600 (2 panels) or QS1 (4 panels)
+    latency / loss / noroute / reset of None use the emulator defaults
+    '''
+
+    def __init__(self, inv_serial, inv_id, num_panels=2, watts=100.0,
+                 voltage_dc=35.0, voltage_ac=230.0, freq_ac=50.0, temperature=30.0,
+                 latency=None, loss=None, noroute=None, reset=None):
+        if num_panels not in (2, 4):
+            raise Exception("Only 2 or 4 panels supported")
+        self.serial = inv_serial
+        self.serial_bytes = unhexlify(inv_serial)
+        self.inv_id = inv_id
+        self.addr = int(inv_id, 16)
+        self.panels = num_panels
+        self.watts = watts
+        self.voltage_dc = voltage_dc
+        self.voltage_ac = voltage_ac
+        self.freq_ac = freq_ac
+        self.temperature = temperature
+        self.latency = latency
+        self.loss = loss
+        self.noroute = noroute
+        self.reset = reset
+        # Energy per panel (Wh) since inverter start
+        self.energy = [0.0] * num_panels
+        self.last_update = None
+        self.polls = 0
+        self.resets = 0
+
+    def update(self, now):
+        '''
+        Accumulate energy up to now
+        '''
+        if self.last_update is not None:
+            for panel in range(self.panels):
+                self.energy[panel] += self.watts * (now - self.last_update) / 3600
+        self.last_update = now
+
+    def restart(self):
+        '''
+        Simulate inverter restart, energy counters start at 0
+        '''
+        self.energy = [0.0] * self.panels
+        self.resets += 1
+
+    def poll_response(self, lqi=0xC0):
+        '''
+        AF_INCOMING_MSG frame with current values
+        '''
+        body = bytearray(POLL_RESPONSE_LENGTH)
+        body[0:2] = b'\x44\x81'
+        body[4:6] = b'\x06\x00'
+        body[6] = self.addr & 0xFF
+        body[7] = self.addr >> 8
+        body[8] = 0x14
+        body[9] = 0x14
+        body[11] = lqi
+        base = POLL_DATA_OFFSET - 2
+        body[base] = self.polls & 0xFF
+        body[base + 1] = POLL_RESPONSE_LENGTH - base - 2
+        data = memoryview(body)[base:]
+        temperature = _raw(self.temperature - TEMPERATURE_OFFSET, TEMPERATURE_SCALE, 0xFFFF)
+        data[12:14] = temperature.to_bytes(2, 'big')
+        data[14:17] = _raw(FREQUENCY_BASE / self.freq_ac, 1, 0xFFFFFF).to_bytes(3, 'big')
+        volt_ac = _raw(self.voltage_ac * 4, VOLTAGE_AC_SCALE, 0xFFFF)
+        data[30:32] = volt_ac.to_bytes(2, 'big')
+        # QS1 panel 4 shares bytes with the frequency, as in the decoder
+        for panel in range(self.panels):
+            curr_pos, shared_pos, volt_pos = PANEL_OFFSETS[panel]
+            current = _raw(self.watts / self.voltage_dc, CURRENT_DC_SCALE, 0xFFF)
+            voltage = _raw(self.voltage_dc, VOLTAGE_DC_SCALE, 0xFFF)
+            data[curr_pos] = current & 0xFF
+            data[shared_pos] = ((voltage & 0x0F) << 4) | (current >> 8)
+            data[volt_pos] = voltage >> 4
+            energy = _raw(self.energy[panel], ENERGY_SCALE, 1 << 30) & 0xFFFFFF
+            energy_pos = ENERGY_OFFSETS[panel]
+            data[energy_pos:energy_pos + 3] = energy.to_bytes(3, 'big')
+        return bytes(build_frame(body))
+
+    def pair_response(self):
+        '''
+        Short AF_INCOMING_MSG with serial followed by inverter ID
+        '''
+        body = bytearray(b'\x44\x81' + bytes(14))
+        body += self.serial_bytes
+        body.append(self.addr & 0xFF)
+        body.append(self.addr >> 8)
+        body += bytes(8)
+        return bytes(build_frame(body))
+
+
+class SocketSerial:
+    '''
+    python3-serial like wrapper around a socket
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    def __fill(self):
+        while True:
+            try:
+                data = self.sock.recv(4096, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+            if not data:
+                return
+            self.buffer.extend(data)
+
+    @property
+    def in_waiting(self):
+        '''
+        Number of received bytes available
+        '''
+        self.__fill()
+        return len(self.buffer)
+
+    def read(self, size=1):
+        '''
+        Read at most size available bytes
+        '''
+        self.__fill()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readinto(self, buf):
+        '''
+        Read at most len(buf) available bytes into buf, returns count
+        '''
+        self.__fill()
+        size = min(len(buf), len(self.buffer))
+        buf[:size] = self.buffer[:size]
+        del self.buffer[:size]
+        return size
+
+    def write(self, data):
+        '''
+        Send data
+        '''
+        self.sock.sendall(data)
+        return len(data)
+
+    def close(self):
+        '''
+        Close socket
+        '''
+        self.sock.close()
+
+
+class Cc2530Emulator:
+    '''
+    Emulated coordinator with virtual inverters
+    '''
+
+    def __init__(self, latency=(0.02, 0.1), loss=0.0, noroute=0.0, reset=0.0,
+                 controller_id='D8A3011B9780', seed=None, started=True):
+        '''
+        latency: (min, max) seconds before an inverter answers a poll
+        loss: chance a poll gets no answer at all
+        noroute: chance a poll is answered by NoRoute (4480 CD)
+        reset: chance an inverter restarts (counters to 0) before a poll
+        started: coordinator already runs (as after a previous start_coordinator)
+        '''
+        self.started = started
+        self.latency = latency
+        self.loss = loss
+        self.noroute = noroute
+        self.reset = reset
+        self.controller_id = controller_id
+        self.random = random.Random(seed)
+        self.inverters = []
+        self.by_addr = {}
+        self.by_serial = {}
+        self.stats = {'frames': 0, 'polls': 0, 'answered': 0, 'lost': 0, 'noroute': 0}
+        self.__parser = FrameParser()
+        self.__queue = []
+        self.__sequence = 0
+        self.__condition = threading.Condition()
+        self.__running = False
+        self.__threads = []
+        self.__fd = None
+        self.__sock = None
+
+    def add_inverter(self, inv_serial, inv_id, num_panels=2, **kwargs):
+        '''
+        Add virtual inverter, kwargs as VirtualInverter
+        '''
+        inverter = VirtualInverter(inv_serial, inv_id, num_panels, **kwargs)
+        self.inverters.append(inverter)
+        self.by_addr[inverter.addr] = inverter
+        self.by_serial[inverter.serial_bytes] = inverter
+        return inverter
+
+    def __setting(self, inverter, name):
+        '''
+        Inverter specific setting or emulator default
+        '''
+        value = getattr(inverter, name)
+        if value is None:
+            return getattr(self, name)
+        return value
+
+    def __device_info(self):
+        '''
+        UTIL_GET_DEVICE_INFO response: coordinator (07) started (09) or hold (00)
+        '''
+        ieee = 'FFFF' + ''.join(
+            self.controller_id[pos:pos + 2] for pos in range(10, -1, -2))
+        return frame_from_hex('6700' + '00' + ieee + '0000' + '07' +
+                              ('09' if self.started else '00') + '00')
+
+    def handle(self, frame):
+        '''
+        Responses to request frame: list of (delay in s, frame)
+        '''
+        self.stats['frames'] += 1
+        cmd = (frame[2] << 8) | frame[3]
+        if cmd == 0x2605:
+            return [(0, WRITE_CONF_RESP)]
+        if cmd == 0x4100:
+            self.started = False
+            return [(0.5, RESET_IND)]
+        if cmd == 0x2400:
+            return [(0, AF_REGISTER_RESP)]
+        if cmd == 0x2600:
+            self.started = True
+            return [(0, START_RESP), (0.3, STATE_STARTING), (0.8, STATE_COORDINATOR)]
+        if cmd in (0x2700, 0x6700):
+            return [(0, self.__device_info())]
+        if cmd == 0x2101:
+            return [(0, PING_RESP)]
+        if cmd == 0x2401:
+            return self.__data_request(frame)
+        if cmd == 0x2402:
+            for pos in range(4, len(frame) - 6):
+                inverter = self.by_serial.get(bytes(frame[pos:pos + 6]))
+                if inverter is not None:
+                    return [(0, DATA_REQ_EXT_RESP), (0.2, inverter.pair_response())]
+            return [(0, DATA_REQ_EXT_RESP)]
+        return []
+
+    def __data_request(self, frame):
+        '''
+        AF_DATA_REQ: confirm and (maybe) poll answer
+        '''
+        addr = frame[4] | (frame[5] << 8)
+        trans_id = frame[10]
+        if addr == 0xFFFF:
+            # Broadcast after coordinator start
+            return [(0, DATA_REQ_RESP), (0.01, frame_from_hex('448000%02X%02X' % (frame[6], trans_id)))]
+        self.stats['polls'] += 1
+        inverter = self.by_addr.get(addr)
+        if inverter is None or self.random.random() < self.__setting(inverter, 'noroute'):
+            self.stats['noroute'] += 1
+            return [(0, DATA_REQ_RESP), (0.05, frame_from_hex('4480CD%02X%02X' % (frame[6], trans_id)))]
+        responses = [(0, DATA_REQ_RESP), (0.01, frame_from_hex('448000%02X%02X' % (frame[6], trans_id)))]
+        if self.random.random() < self.__setting(inverter, 'loss'):
+            self.stats['lost'] += 1
+            return responses
+        now = time.time()
+        inverter.update(now)
+        if self.random.random() < self.__setting(inverter, 'reset'):
+            inverter.restart()
+        inverter.polls += 1
+        self.stats['answered'] += 1
+        latency = self.__setting(inverter, 'latency')
+        responses.append((self.random.uniform(latency[0], latency[1]), inverter.poll_response()))
+        return responses
+
+    def feed(self, data):
+        '''
+        Handle received bytes, schedule responses
+        '''
+        for frame in self.__parser.parse(data):
+            now = time.time()
+            with self.__condition:
+                for delay, response in self.handle(frame):
+                    self.__sequence += 1
+                    heapq.heappush(self.__queue, (now + delay, self.__sequence, response))
+                self.__condition.notify()
+
+    def __sender(self, send):
+        '''
+        Thread writing scheduled responses when they are due
+        '''
+        while True:
+            with self.__condition:
+                while self.__running and (
+                        not self.__queue or self.__queue[0][0] > time.time()):
+                    timeout = None
+                    if self.__queue:
+                        timeout = self.__queue[0][0] - time.time()
+                    self.__condition.wait(timeout)
+                if not self.__running:
+                    return
+                response = heapq.heappop(self.__queue)[2]
+            try:
+                send(response)
+            except OSError:
+                return
+
+    def __receiver(self, receive):
+        '''
+        Thread reading requests
+        '''
+        while self.__running:
+            try:
+                data = receive()
+            except OSError:
+                break
+            if not data:
+                break
+            self.feed(data)
+
+    def __start(self, receive, send):
+        self.__running = True
+        for target, args in ((self.__receiver, (receive,)), (self.__sender, (send,))):
+            thread = threading.Thread(target=target, args=args, daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def open_pty(self):
+        '''
+        Start emulator on a pseudo terminal, returns device path
+        for python3-serial (serial.Serial(path, 115200))
+        '''
+        import tty
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        self.__fd = master
+        self.__start(lambda: os.read(master, 4096), lambda data: os.write(master, data))
+        return os.ttyname(slave)
+
+    def open_socket(self):
+        '''
+        Start emulator on a socket pair, returns SocketSerial for ApsYc600
+        '''
+        ours, theirs = socket.socketpair()
+        self.__sock = ours
+        self.__start(lambda: ours.recv(4096), ours.sendall)
+        return SocketSerial(theirs)
+
+    def stop(self):
+        '''
+        Stop emulator threads
+        '''
+        self.__running = False
+        with self.__condition:
+            self.__condition.notify()
+        if self.__sock is not None:
+            self.__sock.shutdown(socket.SHUT_RDWR)
+            self.__sock.close()
+        if self.__fd is not None:
+            os.close(self.__fd)
+        for thread in self.__threads:
+            thread.join(1)
+        self.__threads = []
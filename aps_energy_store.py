@@ -0,0 +1,113 @@
+'''
+Crash-safe storage for the energy offsets of ApsYc600
+
+Every update is appended as a small fixed-size record, so a poll costs a
+single short write instead of rewriting a file. When enough records have
+been appended the file is compacted to one record per inverter (written
+to a temporary file and renamed over the log). A record cut off by a
+crash or power loss is detected by its checksum, load() then compacts
+the log so later records are not appended behind it.
+
+Any object with load() and save(serial, last, offsets) can be used as
+store, see ApsYc600(energy_store=...).
+
+    store = EnergyStore('/energy.log')
+    inverter = ApsYc600(serial, serial, energy_store=store)
+'''
+import os
+import struct
+from aps_yc600 import frame_fcs
+
+# serial (6 bytes), last energy p1-p4, energy offset p1-p4, checksum, marker
+RECORD = struct.Struct('<6s8dBB')
+RECORD_MARKER = 0xA5
+
+
+class EnergyStore:
+    '''
+    Append-only log of energy counters per inverter serial
+    '''
+
+    def __init__(self, path, compact_every=500):
+        '''
+        path: log file, compact_every: number of appended records before compaction
+        '''
+        self.path = path
+        self.compact_every = compact_every
+        # serial (upper-case hex string) -> (last, offsets), tuples of 4 floats
+        self.state = {}
+        self.records = 0
+
+    def load(self):
+        '''
+        Read log, returns dict of serial to (last, offsets)
+        '''
+        self.state = {}
+        self.records = 0
+        try:
+            log_file = open(self.path, 'rb')
+        except OSError:
+            # Crash between remove and rename in compact() (micropython)
+            try:
+                os.rename(self.path + '.tmp', self.path)
+                log_file = open(self.path, 'rb')
+            except OSError:
+                return self.state
+        torn = False
+        with log_file:
+            while True:
+                record = log_file.read(RECORD.size)
+                if len(record) < RECORD.size:
+                    torn = len(record) > 0
+                    break
+                fields = RECORD.unpack(record)
+                if fields[-1] != RECORD_MARKER or frame_fcs(record[:-2]) != fields[-2]:
+                    # Torn or corrupt record, everything after it is suspect
+                    torn = True
+                    break
+                serial = ''.join('%02X' % byte for byte in fields[0])
+                self.state[serial] = (tuple(fields[1:5]), tuple(fields[5:9]))
+                self.records += 1
+        if torn:
+            # New records must not be appended behind the bad one
+            self.compact()
+        return self.state
+
+    @staticmethod
+    def __pack(serial, last, offsets):
+        '''
+        Build record for serial, last and offsets are padded to 4 panels
+        '''
+        values = list(last) + [0.0] * (4 - len(last)) + list(offsets) + [0.0] * (4 - len(offsets))
+        serial_bytes = bytes(int(serial[pos:pos + 2], 16) for pos in range(0, 12, 2))
+        record = RECORD.pack(serial_bytes, *(values + [0, RECORD_MARKER]))
+        return record[:-2] + bytes((frame_fcs(record[:-2]), RECORD_MARKER))
+
+    def save(self, serial, last, offsets):
+        '''
+        Append new counters for inverter
+        '''
+        # Keys as load() returns them
+        serial = serial.upper()
+        self.state[serial] = (tuple(last), tuple(offsets))
+        with open(self.path, 'ab') as log_file:
+            log_file.write(self.__pack(serial, last, offsets))
+        self.records += 1
+        if self.records >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        '''
+        Rewrite log with only the latest record per inverter
+        '''
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as log_file:
+            for serial, (last, offsets) in self.state.items():
+                log_file.write(self.__pack(serial, last, offsets))
+        try:
+            os.rename(temp_path, self.path)
+        except OSError:
+            # micropython cannot rename over an existing file
+            os.remove(self.path)
+            os.rename(temp_path, self.path)
+        self.records = len(self.state)
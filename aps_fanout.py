@@ -0,0 +1,186 @@
+'''
+Fan-out of readings to output sinks without blocking the poll loop
+
+Every sink gets its own bounded queue. publish() only appends to the
+queues, worker threads call the sinks. A slow or unreachable sink fills
+its own queue, which then drops readings by its policy:
+- DROP_OLDEST: discard the oldest queued reading (default)
+- DROP_NEWEST: discard the new reading
+- BLOCK: publish() waits up to block_timeout for room, then drops the new reading
+
+    fanout = FanOut()
+    fanout.add_sink('influx', push_influx, maxlen=50)
+    fanout.add_sink('graphite', push_graphite, policy=DROP_NEWEST)
+    fanout.start()
+    fanout.publish(result['data'])
+
+Uses _thread so it works on micropython too. On an ESP32 use
+shared_worker=True to drain all sinks from one extra thread.
+'''
+import time
+import _thread
+
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+BLOCK = 'block'
+
+
+class Sink:
+    '''
+    Output with its queue and statistics
+    '''
+
+    def __init__(self, name, send, maxlen, policy, block_timeout):
+        if policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise Exception('Unknown drop policy')
+        self.name = name
+        self.send = send
+        self.maxlen = maxlen
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.queue = []
+        self.lock = _thread.allocate_lock()
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_result = None
+        self.busy = False
+
+    def put(self, reading):
+        '''
+        Queue reading, returns False when a reading was dropped
+        '''
+        end_time = time.time() + self.block_timeout
+        while True:
+            with self.lock:
+                if len(self.queue) < self.maxlen:
+                    self.queue.append(reading)
+                    return True
+                if self.policy == DROP_OLDEST:
+                    self.queue.pop(0)
+                    self.queue.append(reading)
+                    self.dropped += 1
+                    return False
+                if self.policy == DROP_NEWEST or time.time() >= end_time:
+                    self.dropped += 1
+                    return False
+            time.sleep(0.01)
+
+    def get(self):
+        '''
+        Oldest queued reading or None
+        '''
+        with self.lock:
+            if not self.queue:
+                return None
+            self.busy = True
+            return self.queue.pop(0)
+
+    def deliver(self, reading):
+        '''
+        Call sink for reading, errors are counted and printed
+        '''
+        try:
+            self.last_result = self.send(reading)
+            self.sent += 1
+        except Exception as sink_error:
+            print('Error in sink', self.name, sink_error)
+            self.errors += 1
+        self.busy = False
+
+
+class FanOut:
+    '''
+    Distribute readings to sinks on worker threads, see module docstring
+    '''
+
+    def __init__(self, shared_worker=False, idle_sleep=0.05):
+        '''
+        shared_worker: one thread for all sinks instead of one per sink
+        '''
+        self.sinks = []
+        self.shared_worker = shared_worker
+        self.idle_sleep = idle_sleep
+        self.running = False
+        self.workers = 0
+        self.__workers_lock = _thread.allocate_lock()
+
+    def add_sink(self, name, send, maxlen=20, policy=DROP_OLDEST, block_timeout=1.0):
+        '''
+        Add sink, send(reading) is called on a worker thread
+        '''
+        if self.running:
+            raise Exception('Add sinks before start()')
+        sink = Sink(name, send, maxlen, policy, block_timeout)
+        self.sinks.append(sink)
+        return sink
+
+    def publish(self, reading):
+        '''
+        Queue reading for every sink, returns number of sinks that dropped a reading
+        '''
+        dropped = 0
+        for sink in self.sinks:
+            if not sink.put(reading):
+                dropped += 1
+        return dropped
+
+    def __worker(self, sinks):
+        '''
+        Drain queues of sinks until stop()
+        '''
+        try:
+            while self.running:
+                idle = True
+                for sink in sinks:
+                    reading = sink.get()
+                    if reading is not None:
+                        idle = False
+                        sink.deliver(reading)
+                if idle:
+                    time.sleep(self.idle_sleep)
+        finally:
+            with self.__workers_lock:
+                self.workers -= 1
+
+    def start(self):
+        '''
+        Start worker thread(s)
+        '''
+        if self.running:
+            return
+        self.running = True
+        if self.shared_worker:
+            groups = [self.sinks]
+        else:
+            groups = [[sink] for sink in self.sinks]
+        for group in groups:
+            with self.__workers_lock:
+                self.workers += 1
+            _thread.start_new_thread(self.__worker, (group,))
+
+    def pending(self):
+        '''
+        Number of readings queued or being sent
+        '''
+        return sum(len(sink.queue) + (1 if sink.busy else 0) for sink in self.sinks)
+
+    def stop(self, timeout=5):
+        '''
+        Wait up to timeout seconds for the queues to drain, then stop workers
+        '''
+        end_time = time.time() + timeout
+        while self.pending() and time.time() < end_time:
+            time.sleep(0.05)
+        self.running = False
+        while self.workers and time.time() < end_time + 1:
+            time.sleep(0.01)
+
+    def stats(self):
+        '''
+        Per sink name: queued, sent, dropped and errors
+        '''
+        return dict(
+            (sink.name, {'queued': len(sink.queue), 'sent': sink.sent,
+                         'dropped': sink.dropped, 'errors': sink.errors})
+            for sink in self.sinks)
@@ -0,0 +1,257 @@
+'''
+Fixed-memory history of poll readings
+
+Readings are stored as fixed-width records in preallocated arrays
+(uint32 time, uint16 inverter index, float32 per field), the memory use is
+set by the byte budget and never grows. The budget is split over tiers:
+- tier 0 keeps readings as they were added
+- every next tier keeps averages over a longer period (default 5 min, 1 h)
+
+When a tier is full its oldest record moves down into the averages of
+the next tier, so recent data is kept in full detail and older data
+with less. Energy counters keep their last value instead of an average.
+
+    history = History(budget=32768)
+    history.add(0, result['data'])
+    for timestamp, inverter_index, values in history.query(start, end, 0):
+        ...
+
+Works with micropython, save() / load() keep the history on flash.
+'''
+import time
+from array import array
+
+# Stored fields (all values of a 4 panel inverter), missing fields are NaN
+FIELDS = (
+    'temperature', 'freq_ac', 'voltage_ac',
+    'current_dc1', 'current_dc2', 'current_dc3', 'current_dc4',
+    'voltage_dc1', 'voltage_dc2', 'voltage_dc3', 'voltage_dc4',
+    'energy_panel1', 'energy_panel2', 'energy_panel3', 'energy_panel4',
+    'watt_panel1', 'watt_panel2', 'watt_panel3', 'watt_panel4')
+# (period in seconds, share of budget), period 0 stores readings unchanged
+TIERS = ((0, 0.5), (300, 0.3), (3600, 0.2))
+NAN = float('nan')
+HISTORY_MAGIC = b'APSH\x02'
+
+
+def _zeros(typecode, length):
+    '''
+    Preallocated array (micropython arrays cannot be multiplied)
+    '''
+    return array(typecode, (0 for _ in range(length)))
+
+
+class Ring:
+    '''
+    Ring of fixed-width records: time, inverter index, width float values
+    '''
+
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.width = width
+        self.times = _zeros('I', capacity)
+        self.inverters = _zeros('H', capacity)
+        self.values = _zeros('f', capacity * width)
+        self.start = 0
+        self.count = 0
+
+    def append(self, timestamp, inverter_index, values):
+        '''
+        Add record, returns the record pushed out (time, inverter, values) or None
+        '''
+        evicted = None
+        if self.count == self.capacity:
+            evicted = self.record(0)
+            pos = self.start
+            self.start = (self.start + 1) % self.capacity
+        else:
+            pos = (self.start + self.count) % self.capacity
+            self.count += 1
+        self.times[pos] = int(timestamp)
+        self.inverters[pos] = inverter_index
+        base = pos * self.width
+        for field in range(self.width):
+            self.values[base + field] = values[field]
+        return evicted
+
+    def record(self, index):
+        '''
+        Record index (0 is oldest) as (time, inverter, values)
+        '''
+        pos = (self.start + index) % self.capacity
+        base = pos * self.width
+        return (self.times[pos], self.inverters[pos],
+                tuple(self.values[base:base + self.width]))
+
+    def clear(self):
+        '''
+        Drop all records
+        '''
+        self.start = 0
+        self.count = 0
+
+
+class History:
+    '''
+    Tiered ring store of readings, see module docstring
+    '''
+
+    def __init__(self, budget=32768, fields=FIELDS, tiers=TIERS):
+        '''
+        budget: bytes for all records, fields: names of stored values
+        tiers: (period seconds, share of budget), first period must be 0
+        '''
+        if tiers[0][0] != 0:
+            raise Exception('First tier must store unchanged readings')
+        self.fields = tuple(fields)
+        self.periods = tuple(tier[0] for tier in tiers)
+        record_size = 4 + 2 + 4 * len(self.fields)
+        self.rings = []
+        for _, share in tiers:
+            capacity = int(budget * share) // record_size
+            if capacity < 1:
+                raise Exception('Budget too small')
+            self.rings.append(Ring(capacity, len(self.fields)))
+        # Per tier above 0: inverter index -> [bucket start, count, sums]
+        self.pending = [{} for _ in tiers]
+        # Fields kept as last value instead of average
+        self.last_fields = tuple(
+            field for field in range(len(self.fields))
+            if self.fields[field].startswith('energy'))
+
+    def add(self, inverter_index, data, timestamp=None):
+        '''
+        Store decoded poll data (dict, see ApsYc600.poll_inverter) of inverter
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        values = [data.get(field, NAN) for field in self.fields]
+        self.__append(0, timestamp, inverter_index, values)
+
+    def __append(self, tier, timestamp, inverter_index, values):
+        '''
+        Add record to tier, move evicted record down to the next tier
+        '''
+        evicted = self.rings[tier].append(timestamp, inverter_index, values)
+        if evicted is not None and tier + 1 < len(self.rings):
+            self.__fold(tier + 1, evicted)
+
+    def __fold(self, tier, record):
+        '''
+        Add record to running average of its period, store finished periods
+        '''
+        timestamp, inverter_index, values = record
+        period = self.periods[tier]
+        bucket = timestamp - timestamp % period
+        pending = self.pending[tier].get(inverter_index)
+        if pending is not None and pending[0] != bucket:
+            self.__append(tier, pending[0], inverter_index, self.__average(pending))
+            pending = None
+        if pending is None:
+            pending = [bucket, 0, [0.0] * len(values)]
+            self.pending[tier][inverter_index] = pending
+        pending[1] += 1
+        sums = pending[2]
+        for field in range(len(values)):
+            if field in self.last_fields:
+                sums[field] = values[field]
+            else:
+                sums[field] += values[field]
+
+    def __average(self, pending):
+        '''
+        Values of a running average
+        '''
+        count = pending[1]
+        return [value if field in self.last_fields else value / count
+                for field, value in enumerate(pending[2])]
+
+    def query(self, start=None, end=None, inverter_index=None):
+        '''
+        Records with start <= time < end (None: no limit) of one or all inverters
+        Returns list of (time, inverter index, values in order of fields), oldest first.
+        Averaged records have the start of their period as time.
+        '''
+        found = []
+        for tier, ring in enumerate(self.rings):
+            for index in range(ring.count):
+                found.append(ring.record(index))
+            if tier > 0:
+                # Periods still being averaged
+                for pending_index, pending in self.pending[tier].items():
+                    found.append((pending[0], pending_index, tuple(self.__average(pending))))
+        result = [
+            record for record in found
+            if (start is None or record[0] >= start) and
+            (end is None or record[0] < end) and
+            (inverter_index is None or record[1] == inverter_index)]
+        result.sort(key=lambda record: (record[0], record[1]))
+        return result
+
+    def as_dicts(self, records):
+        '''
+        Convert query result to dicts (not stored like this, only for output)
+        '''
+        return [dict(zip(('time', 'inverter') + self.fields, (record[0], record[1]) + record[2]))
+                for record in records]
+
+    def clear(self):
+        '''
+        Drop all history
+        '''
+        for ring in self.rings:
+            ring.clear()
+        self.pending = [{} for _ in self.rings]
+
+    def save(self, path):
+        '''
+        Write rings to file (running averages are not saved)
+        '''
+        with open(path, 'wb') as history_file:
+            history_file.write(HISTORY_MAGIC)
+            for ring in self.rings:
+                history_file.write(array('I', (ring.capacity, ring.width, ring.start, ring.count)))
+                history_file.write(ring.times)
+                history_file.write(ring.inverters)
+                history_file.write(ring.values)
+
+    def load(self, path):
+        '''
+        Read rings written by save(), returns False when the file does not match.
+        A file of other rings or one that ends early leaves the history empty.
+        '''
+        try:
+            history_file = open(path, 'rb')
+        except OSError:
+            return False
+        with history_file:
+            if history_file.read(len(HISTORY_MAGIC)) != HISTORY_MAGIC:
+                return False
+            for ring in self.rings:
+                if not self.__load_ring(history_file, ring):
+                    # Other budget or fields, or a short file
+                    self.clear()
+                    return False
+        return True
+
+    @staticmethod
+    def __load_ring(history_file, ring):
+        '''
+        Read one ring written by save(), returns False when it does not match
+        '''
+        header = _zeros('I', 4)
+        if history_file.readinto(header) != 16:
+            return False
+        if header[0] != ring.capacity or header[1] != ring.width:
+            return False
+        if header[2] >= ring.capacity or header[3] > ring.capacity:
+            return False
+        # Byte sizes of the arrays (micropython arrays have no itemsize)
+        for data, size in ((ring.times, 4 * ring.capacity),
+                           (ring.inverters, 2 * ring.capacity),
+                           (ring.values, 4 * ring.capacity * ring.width)):
+            if history_file.readinto(data) != size:
+                return False
+        ring.start = header[2]
+        ring.count = header[3]
+        return True
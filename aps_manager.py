@@ -0,0 +1,223 @@
+'''
+Manage several CC2530 coordinators (ApsYc600 instances) as one system
+
+Every coordinator gets its own worker thread. Inverters are registered
+on all coordinators with the same index and assigned to one of them for
+polling, either statically or based on measured link success. Readings
+of all coordinators are merged into one queue.
+
+Dynamic assignment only works when every coordinator can talk to the
+inverters, i.e. all sticks use the controller ID the inverters were
+paired with.
+
+    manager = CoordinatorManager([ApsYc600(ser1, ser1), ApsYc600(ser2, ser2)])
+    manager.add_inverter('123456789012', '9988', 2)
+    manager.add_inverter('123456789013', '9989', 2, coordinator=1)
+    print(manager.start_coordinators())
+    manager.start(interval=30)
+    while True:
+        print(manager.readings.get())
+'''
+import queue
+import threading
+import time
+
+
+class CoordinatorManager:
+    '''
+    Shard inverters across several coordinators
+    '''
+
+    def __init__(self, coordinators, min_success=0.5, smoothing=0.2):
+        '''
+        coordinators: list of ApsYc600 instances, one per radio
+        min_success: link success rate below which rebalance() moves an inverter
+        smoothing: weight of the latest poll in the link success rate
+        '''
+        if not coordinators:
+            raise Exception('At least one coordinator required')
+        self.coordinators = list(coordinators)
+        self.min_success = min_success
+        self.smoothing = smoothing
+        # Coordinator number per inverter index
+        self.assignment = []
+        # Link success per inverter index, per coordinator (None = not measured)
+        self.link_success = []
+        # Merged stream of readings from all coordinators
+        self.readings = queue.Queue()
+        self.__stop = threading.Event()
+        self.__threads = []
+        self.__lock = threading.Lock()
+
+    def __parallel(self, func):
+        '''
+        Run func(coordinator_no) for all coordinators in parallel
+        Returns list of results (or raised exceptions) per coordinator
+        '''
+        results = [None] * len(self.coordinators)
+
+        def worker(coordinator_no):
+            try:
+                results[coordinator_no] = func(coordinator_no)
+            except Exception as worker_error:
+                results[coordinator_no] = worker_error
+
+        threads = []
+        for coordinator_no in range(len(self.coordinators)):
+            thread = threading.Thread(target=worker, args=(coordinator_no,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def add_inverter(self, inv_serial, inv_id, num_panels, coordinator=None):
+        '''
+        Add inverter to all coordinators, poll it using coordinator
+        (number) or the coordinator with the least inverters.
+        Returns inverter index
+        '''
+        if coordinator is None:
+            load = [self.assignment.count(no) for no in range(len(self.coordinators))]
+            coordinator = load.index(min(load))
+        if not 0 <= coordinator < len(self.coordinators):
+            raise Exception('Invalid coordinator')
+        for radio in self.coordinators:
+            inverter_index = radio.add_inverter(inv_serial, inv_id, num_panels)
+        self.assignment.append(coordinator)
+        self.link_success.append([None] * len(self.coordinators))
+        return inverter_index
+
+    def set_inverter_id(self, inv_index, inv_id):
+        '''
+        Set inverter ID for existing inverter on all coordinators
+        '''
+        for radio in self.coordinators:
+            radio.set_inverter_id(inv_index, inv_id)
+        return True
+
+    def reset_counters(self, inverter_index):
+        '''
+        Reset historical data on all coordinators
+        '''
+        for radio in self.coordinators:
+            radio.reset_counters(inverter_index)
+
+    def assigned(self, coordinator_no):
+        '''
+        Inverter indexes polled by coordinator
+        '''
+        return [index for index, no in enumerate(self.assignment) if no == coordinator_no]
+
+    def start_coordinators(self, pair_mode=False):
+        '''
+        Start all coordinators in parallel, returns result per coordinator
+        '''
+        return self.__parallel(
+            lambda coordinator_no: self.coordinators[coordinator_no].start_coordinator(pair_mode))
+
+    def __record(self, coordinator_no, results):
+        '''
+        Update link success and queue readings of one coordinator
+        '''
+        with self.__lock:
+            for inverter_index, result in results.items():
+                success = 0.0 if 'error' in result else 1.0
+                last = self.link_success[inverter_index][coordinator_no]
+                if last is None:
+                    last = success
+                self.link_success[inverter_index][coordinator_no] = (
+                    last + self.smoothing * (success - last))
+                self.readings.put({
+                    'index': inverter_index,
+                    'coordinator': coordinator_no,
+                    'time': time.time(),
+                    'result': result})
+
+    def __poll_coordinator(self, coordinator_no, timeout):
+        '''
+        Poll all inverters assigned to coordinator
+        A failing coordinator gives an error result for each of its inverters
+        '''
+        radio = self.coordinators[coordinator_no]
+        assigned = self.assigned(coordinator_no)
+        try:
+            results = radio.poll_all(assigned, timeout)
+        except Exception as poll_error:
+            print('Poll failed on coordinator', coordinator_no, poll_error)
+            results = dict((inverter_index, {'error': str(poll_error)})
+                           for inverter_index in assigned)
+        self.__record(coordinator_no, results)
+        return results
+
+    def poll_all(self, timeout=2000):
+        '''
+        Poll all inverters, every coordinator in parallel.
+        Returns dict of inverter index to poll result, readings are queued too.
+        '''
+        merged = {}
+        for results in self.__parallel(
+                lambda coordinator_no: self.__poll_coordinator(coordinator_no, timeout)):
+            if isinstance(results, Exception):
+                continue
+            merged.update(results)
+        return merged
+
+    def rebalance(self):
+        '''
+        Move inverters with a poor link to the coordinator with the best
+        (or not yet measured) link. Returns list of (index, from, to).
+        '''
+        moves = []
+        with self.__lock:
+            for inverter_index, current in enumerate(self.assignment):
+                rates = self.link_success[inverter_index]
+                if rates[current] is None or rates[current] >= self.min_success:
+                    continue
+                # Unmeasured coordinators are worth a try
+                best = max(
+                    range(len(self.coordinators)),
+                    key=lambda no: 1.0 if rates[no] is None else rates[no])
+                if best == current or (rates[best] is not None and rates[best] <= rates[current]):
+                    continue
+                # Keep energy offsets continuous on the new coordinator
+                self.coordinators[best].energy.copy_from(
+                    self.coordinators[current].energy, inverter_index)
+                self.coordinators[best].store_energy(inverter_index)
+                self.assignment[inverter_index] = best
+                moves.append((inverter_index, current, best))
+        return moves
+
+    def start(self, interval=30, timeout=2000, auto_rebalance=True):
+        '''
+        Start worker thread per coordinator polling its inverters every
+        interval seconds. Readings are put in self.readings.
+        '''
+        if self.__threads:
+            raise Exception('Already running')
+        self.__stop.clear()
+
+        def worker(coordinator_no):
+            while not self.__stop.is_set():
+                started = time.time()
+                try:
+                    self.__poll_coordinator(coordinator_no, timeout)
+                except Exception as poll_error:
+                    print('Poll failed on coordinator', coordinator_no, poll_error)
+                if auto_rebalance and coordinator_no == 0:
+                    self.rebalance()
+                self.__stop.wait(max(0, interval - (time.time() - started)))
+
+        for coordinator_no in range(len(self.coordinators)):
+            thread = threading.Thread(target=worker, args=(coordinator_no,), daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def stop(self):
+        '''
+        Stop worker threads, waits for running polls to finish
+        '''
+        self.__stop.set()
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
@@ -0,0 +1,158 @@
+'''
+Optional instrumentation for ApsYc600
+
+Records how long each stage of an exchange takes and how often the
+radio link fails. Works on micropython too, use as_dict() there and
+prometheus() for a scrape endpoint on a full python host.
+
+    metrics = Metrics()
+    inverter = ApsYc600(serial, serial, metrics=metrics)
+    ...
+    print(metrics.prometheus())
+
+Stages (seconds):
+- send: writing the request frame
+- first_byte: request sent until the first answer bytes arrived
+- read: reading the serial buffer
+- parse: finding and checking frames
+- decode: turning a poll response into values
+- response: request sent until the matching answer was decoded
+
+Counters: polls, crc_errors, length_errors, skipped_bytes, noroute,
+timeouts and retries. Values are labelled by inverter serial where the
+library knows which inverter they belong to, '' otherwise.
+'''
+
+# Upper bounds of the histogram buckets (seconds)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    '''
+    Fixed bucket histogram
+    '''
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # Not cumulative, the last slot counts values above all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        '''
+        Add value to histogram
+        '''
+        slot = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            slot += 1
+        self.counts[slot] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        '''
+        Plain dict with cumulative bucket counts
+        '''
+        cumulative = []
+        total = 0
+        for count in self.counts[:-1]:
+            total += count
+            cumulative.append(total)
+        return {
+            'buckets': list(zip(self.buckets, cumulative)),
+            'count': self.count,
+            'sum': self.sum}
+
+
+class Metrics:
+    '''
+    Stage histograms and protocol counters, see module docstring
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # (stage, inverter) -> Histogram
+        self.histograms = {}
+        # (name, inverter) -> count
+        self.counters = {}
+
+    def observe(self, stage, seconds, inverter=''):
+        '''
+        Record duration of stage
+        '''
+        key = (stage, inverter)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = Histogram(self.buckets)
+            self.histograms[key] = histogram
+        histogram.observe(seconds)
+
+    def inc(self, name, inverter='', amount=1):
+        '''
+        Increment counter
+        '''
+        key = (name, inverter)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def reset(self):
+        '''
+        Forget all recorded values
+        '''
+        self.histograms = {}
+        self.counters = {}
+
+    def as_dict(self):
+        '''
+        Returns {'stages': {stage: {inverter: histogram}},
+                 'counters': {name: {inverter: count}}}
+        '''
+        stages = {}
+        for (stage, inverter), histogram in self.histograms.items():
+            stages.setdefault(stage, {})[inverter] = histogram.as_dict()
+        counters = {}
+        for (name, inverter), count in self.counters.items():
+            counters.setdefault(name, {})[inverter] = count
+        return {'stages': stages, 'counters': counters}
+
+    @staticmethod
+    def __labels(pairs):
+        '''
+        Format Prometheus label set, empty labels are left out
+        '''
+        labels = ['%s="%s"' % (name, value) for name, value in pairs if value != '']
+        if not labels:
+            return ''
+        return '{' + ','.join(labels) + '}'
+
+    def prometheus(self, prefix='apsyc600'):
+        '''
+        Export in Prometheus text exposition format
+        '''
+        lines = []
+        name = prefix + '_stage_seconds'
+        lines.append('# HELP %s Time spent per exchange stage' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for (stage, inverter) in sorted(self.histograms):
+            histogram = self.histograms[(stage, inverter)].as_dict()
+            for bound, count in histogram['buckets']:
+                lines.append('%s_bucket%s %d' % (name, self.__labels(
+                    (('stage', stage), ('inverter', inverter), ('le', repr(float(bound))))), count))
+            labels = self.__labels((('stage', stage), ('inverter', inverter)))
+            lines.append('%s_bucket%s %d' % (name, self.__labels(
+                (('stage', stage), ('inverter', inverter), ('le', '+Inf'))), histogram['count']))
+            lines.append('%s_sum%s %r' % (name, labels, histogram['sum']))
+            lines.append('%s_count%s %d' % (name, labels, histogram['count']))
+        counter_names = sorted(set(key[0] for key in self.counters))
+        for counter in counter_names:
+            name = '%s_%s_total' % (prefix, counter)
+            lines.append('# TYPE %s counter' % name)
+            for key in sorted(self.counters):
+                if key[0] == counter:
+                    lines.append('%s%s %d' % (
+                        name, self.__labels((('inverter', key[1]),)), self.counters[key]))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,258 @@
+'''
+Record raw serial traffic of ApsYc600 and replay it later
+
+RecordingTransport wraps the reader / writer passed to ApsYc600 and
+appends every chunk to a binary log:
+
+    header: b'APSR' + version (1 byte)
+    record: monotonic time in ns (8 bytes), direction (1 byte: 0 = RX,
+            1 = TX), length (2 bytes), data; all little-endian
+
+ReplayTransport feeds a log back to ApsYc600. Received data is released
+once the library has written the request that preceded it in the
+capture, either at original speed or immediately. Logs are read through
+mmap so large captures are not loaded into memory.
+
+    with RecordingTransport(serial_port, serial_port, 'capture.bin') as port:
+        inverter = ApsYc600(port, port)
+        ...
+    inverter = ApsYc600(*ReplayTransport('capture.bin').pair())
+'''
+import mmap
+import struct
+import time
+
+LOG_MAGIC = b'APSR\x01'
+RECORD_HEADER = struct.Struct('<QBH')
+DIRECTION_RX = 0
+DIRECTION_TX = 1
+
+
+def records(log):
+    '''
+    Generator yielding (time_ns, direction, data) for every record in
+    mmap / bytes log, data is a memoryview into the log
+    '''
+    if bytes(log[:len(LOG_MAGIC)]) != LOG_MAGIC:
+        raise Exception('Not a serial capture')
+    view = memoryview(log)
+    pos = len(LOG_MAGIC)
+    try:
+        while pos + RECORD_HEADER.size <= len(log):
+            time_ns, direction, length = RECORD_HEADER.unpack_from(log, pos)
+            pos += RECORD_HEADER.size
+            if pos + length > len(log):
+                # Capture was cut off while writing
+                return
+            yield time_ns, direction, view[pos:pos + length]
+            pos += length
+    finally:
+        # The mmap can only be closed without exported views
+        view.release()
+
+
+def open_log(path):
+    '''
+    Map capture file into memory (read-only)
+    '''
+    with open(path, 'rb') as log_file:
+        return mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class RecordingTransport:
+    '''
+    Reader / writer wrapper logging all traffic to a file
+    '''
+
+    def __init__(self, reader, writer, path):
+        self.reader = reader
+        self.writer = writer
+        self.log = open(path, 'ab')
+        if self.log.tell() == 0:
+            self.log.write(LOG_MAGIC)
+
+    def __dir__(self):
+        # ApsYc600 checks dir() for in_waiting
+        return sorted(set(dir(type(self)) + list(self.__dict__) + dir(self.reader)))
+
+    def __getattr__(self, name):
+        # Everything else (in_waiting, baudrate, ...) is the reader's
+        return getattr(self.reader, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __record(self, direction, data):
+        '''
+        Append chunk to log
+        '''
+        data = bytes(data)
+        for pos in range(0, len(data), 0xFFFF):
+            chunk = data[pos:pos + 0xFFFF]
+            self.log.write(RECORD_HEADER.pack(time.monotonic_ns(), direction, len(chunk)))
+            self.log.write(chunk)
+
+    def read(self, *args):
+        '''
+        Read from reader and log received data
+        '''
+        data = self.reader.read(*args)
+        if data:
+            self.__record(DIRECTION_RX, data)
+        return data
+
+    def readinto(self, buffer, *args):
+        '''
+        Read into buffer and log received data
+        '''
+        count = self.reader.readinto(buffer, *args)
+        if count:
+            self.__record(DIRECTION_RX, memoryview(buffer)[:count])
+        return count
+
+    def write(self, data):
+        '''
+        Log and write data
+        '''
+        self.__record(DIRECTION_TX, data)
+        return self.writer.write(data)
+
+    def flush(self):
+        '''
+        Flush log to disk
+        '''
+        self.log.flush()
+
+    def close(self):
+        '''
+        Close log, the serial port is left open
+        '''
+        if not self.log.closed:
+            self.log.close()
+
+
+class ReplayTransport:
+    '''
+    Serial port stand-in replaying a capture
+    '''
+
+    def __init__(self, path, realtime=True, speed=1.0, serial_api=True):
+        '''
+        realtime: keep original timing between request and responses
+        (divided by speed), otherwise responses are available immediately
+        serial_api: offer in_waiting like python3-serial, else read()
+        returns None when no data is available and any() counts the
+        available bytes (micropython UART, enough for poll_into)
+        '''
+        self.log = open_log(path)
+        self.realtime = realtime
+        self.speed = speed
+        self.serial_api = serial_api
+        self.__records = records(self.log)
+        self.__next = next(self.__records, None)
+        self.__pending = bytearray()
+        # Written requests not yet matched with a TX record: wall times
+        self.__writes = []
+        # Time in capture / wall time the replay clock is anchored to
+        self.__anchor = (self.__next[0] if self.__next else 0, time.monotonic_ns())
+        # Written data not equal to the capture
+        self.mismatches = 0
+
+    def __dir__(self):
+        names = dir(type(self)) + list(self.__dict__)
+        if not self.serial_api:
+            names.remove('in_waiting')
+        return sorted(set(names))
+
+    def pair(self):
+        '''
+        Return (reader, writer) for ApsYc600
+        '''
+        return self, self
+
+    def __advance(self):
+        '''
+        Move received data that is due into pending buffer
+        '''
+        while self.__next is not None:
+            time_ns, direction, data = self.__next
+            if direction == DIRECTION_TX:
+                # Wait until the library sent this request
+                if not self.__writes:
+                    return
+                written = self.__writes.pop(0)
+                if bytes(data) != written[1]:
+                    self.mismatches += 1
+                self.__anchor = (time_ns, written[0])
+            else:
+                if self.realtime:
+                    due = self.__anchor[1] + (time_ns - self.__anchor[0]) / self.speed
+                    if time.monotonic_ns() < due:
+                        return
+                self.__pending.extend(data)
+            self.__next = next(self.__records, None)
+
+    @property
+    def in_waiting(self):
+        '''
+        Number of received bytes available
+        '''
+        self.__advance()
+        return len(self.__pending)
+
+    def any(self):
+        '''
+        Number of received bytes available (micropython UART)
+        '''
+        return self.in_waiting
+
+    @property
+    def finished(self):
+        '''
+        True when the whole capture has been replayed
+        '''
+        self.__advance()
+        return self.__next is None and not self.__pending
+
+    def read(self, size=None):
+        '''
+        Read available data (at most size bytes)
+        '''
+        self.__advance()
+        if not self.__pending:
+            return b'' if self.serial_api else None
+        if size is None:
+            size = len(self.__pending)
+        data = bytes(self.__pending[:size])
+        del self.__pending[:size]
+        return data
+
+    def readinto(self, buffer):
+        '''
+        Read available data into buffer, returns number of bytes (or None)
+        '''
+        self.__advance()
+        if not self.__pending:
+            return None
+        count = min(len(buffer), len(self.__pending))
+        buffer[:count] = self.__pending[:count]
+        del self.__pending[:count]
+        return count
+
+    def write(self, data):
+        '''
+        Accept request, releases the responses recorded after it
+        '''
+        self.__writes.append((time.monotonic_ns(), bytes(data)))
+        return len(data)
+
+    def close(self):
+        '''
+        Unmap capture, also when it was not replayed completely
+        '''
+        self.__next = None
+        self.__records.close()
+        self.log.close()
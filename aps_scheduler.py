@@ -0,0 +1,210 @@
+'''
+Adaptive poll scheduler for ApsYc600
+
+Instead of polling every inverter at a fixed interval, every inverter
+gets its own next poll time:
+- producing inverters (recent power above idle_power) every interval
+- idle inverters (night, heavy clouds) every idle_interval
+- after a timeout or NoRoute the wait doubles each failure (up to
+  max_backoff), with random jitter so inverters drift apart
+
+The coordinator sends at most max_polls requests per budget_window
+seconds. When more inverters are due, the ones with the highest recent
+power go first.
+
+    scheduler = Scheduler(inverter)
+    scheduler.run_forever(lambda index, result: print(index, result))
+
+Works with micropython (time.time() in seconds).
+'''
+import time
+try:
+    from random import random
+except ImportError:
+    from urandom import random
+
+
+class InverterSchedule:
+    '''
+    Scheduling state of one inverter
+    '''
+    __slots__ = ('due', 'power', 'failures', 'last_error')
+
+    def __init__(self, due):
+        self.due = due
+        self.power = None
+        self.failures = 0
+        self.last_error = None
+
+
+class Scheduler:
+    '''
+    Decide which inverter to poll next, see module docstring
+    '''
+
+    def __init__(self, api, interval=30, idle_interval=300, idle_power=1.0,
+                 timeout_backoff=15, noroute_backoff=60, max_backoff=1800,
+                 jitter=0.1, max_polls=20, budget_window=60, timeout=2000,
+                 max_in_flight=4):
+        '''
+        api: ApsYc600 (or anything with inv_data and poll_all)
+        Intervals and backoffs in seconds, timeout in ms (per poll)
+        '''
+        self.api = api
+        self.interval = interval
+        self.idle_interval = idle_interval
+        self.idle_power = idle_power
+        self.timeout_backoff = timeout_backoff
+        self.noroute_backoff = noroute_backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.max_polls = max_polls
+        self.budget_window = budget_window
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        # Inverter index -> InverterSchedule
+        self.schedule = {}
+        # Send times of recent polls, oldest first
+        self.sent = []
+        self.running = False
+
+    def __state(self, inverter_index, now):
+        '''
+        Schedule of inverter, new inverters are due immediately
+        '''
+        state = self.schedule.get(inverter_index)
+        if state is None:
+            state = InverterSchedule(now)
+            self.schedule[inverter_index] = state
+        return state
+
+    def __jitter(self, delay):
+        '''
+        Spread delay randomly by +/- jitter
+        '''
+        return delay * (1 + self.jitter * (random() * 2 - 1))
+
+    def __budget_free(self, now):
+        '''
+        Number of polls allowed right now
+        '''
+        window_start = now - self.budget_window
+        while self.sent and self.sent[0] <= window_start:
+            self.sent.pop(0)
+        return self.max_polls - len(self.sent)
+
+    @staticmethod
+    def power(result):
+        '''
+        Total power (W) of a successful poll result
+        '''
+        data = result['data']
+        return sum(data[key] for key in data if key.startswith('watt_panel'))
+
+    def record(self, inverter_index, result, now=None):
+        '''
+        Plan next poll of inverter from its poll result
+        '''
+        if now is None:
+            now = time.time()
+        state = self.__state(inverter_index, now)
+        error = result.get('error')
+        if error is None:
+            state.failures = 0
+            state.last_error = None
+            state.power = self.power(result)
+            if state.power >= self.idle_power:
+                delay = self.interval
+            else:
+                delay = self.idle_interval
+        else:
+            state.failures += 1
+            state.last_error = error
+            if error == 'NoRoute':
+                delay = self.noroute_backoff
+            else:
+                delay = self.timeout_backoff
+            delay = min(self.max_backoff, delay * 2 ** (state.failures - 1))
+        state.due = now + self.__jitter(delay)
+
+    def due(self, now=None):
+        '''
+        Inverter indexes to poll now, highest recent power first, limited by the budget
+        '''
+        if now is None:
+            now = time.time()
+        ready = []
+        for inverter_index in range(len(self.api.inv_data)):
+            state = self.__state(inverter_index, now)
+            if state.due <= now:
+                # Unknown power first, then producing inverters
+                power = state.power
+                if power is None:
+                    power = float('inf')
+                ready.append((-power, state.due, inverter_index))
+        ready.sort()
+        free = self.__budget_free(now)
+        if free < 0:
+            free = 0
+        return [item[2] for item in ready[:free]]
+
+    def next_due(self, now=None):
+        '''
+        Returns (time, inverter index) of the next poll, (None, None) without inverters
+        Time is never earlier than the budget allows.
+        '''
+        if now is None:
+            now = time.time()
+        best = (None, None)
+        for inverter_index in range(len(self.api.inv_data)):
+            state = self.__state(inverter_index, now)
+            if best[0] is None or state.due < best[0]:
+                best = (state.due, inverter_index)
+        if best[0] is not None and self.__budget_free(now) <= 0:
+            # Wait until the oldest poll leaves the budget window
+            best = (max(best[0], self.sent[0] + self.budget_window), best[1])
+        return best
+
+    def poll_due(self, now=None):
+        '''
+        Poll all inverters that are due, returns dict of inverter index to result
+        '''
+        use_clock = now is None
+        if use_clock:
+            now = time.time()
+        indexes = self.due(now)
+        if not indexes:
+            return {}
+        self.sent.extend([now] * len(indexes))
+        results = self.api.poll_all(indexes, self.timeout, self.max_in_flight)
+        if use_clock:
+            # Plan from the moment the answers came in
+            now = time.time()
+        for inverter_index in results:
+            self.record(inverter_index, results[inverter_index], now)
+        return results
+
+    def run_forever(self, callback=None):
+        '''
+        Poll inverters when they are due until stop() is called
+        callback(inverter index, result) is called for every poll
+        '''
+        self.running = True
+        while self.running:
+            results = self.poll_due()
+            if callback is not None:
+                for inverter_index in results:
+                    callback(inverter_index, results[inverter_index])
+            when = self.next_due()[0]
+            if when is None:
+                delay = self.interval
+            else:
+                delay = when - time.time()
+            if delay > 0:
+                time.sleep(min(delay, 1))
+
+    def stop(self):
+        '''
+        Stop run_forever
+        '''
+        self.running = False
@@ -0,0 +1,218 @@
+'''
+HTTP/JSON server with the latest reading of every inverter
+
+Only this process talks to the radio. Readings are kept in a cache for
+ttl seconds; a request for an older (or missing) reading polls the
+inverter once, concurrent requests for the same inverter wait for that
+one poll instead of starting their own. Every response tells the age of
+the reading, so consumers can be added without adding radio load.
+
+    cache = ReadingCache(inverter, ttl=30)
+    server = CacheServer(cache, port=8080)
+    server.serve_forever()
+
+GET /inverters            cached readings of all inverters (never polls)
+GET /inverters/<index>    reading of one inverter, ?max_age=<s> overrides ttl
+
+Python 3 only (http.server, threads).
+'''
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+class ReadingCache:
+    '''
+    TTL cache of poll results with one poll in flight per inverter
+    '''
+
+    def __init__(self, api, ttl=30, timeout=2000):
+        '''
+        api: ApsYc600, polls wait for other users of the serial port
+        ttl: seconds a reading is served without polling, timeout (ms) per poll
+        '''
+        self.api = api
+        self.ttl = ttl
+        self.timeout = timeout
+        # inverter index -> (time.monotonic(), poll result)
+        self.entries = {}
+        # inverter index -> [threading.Event, result] of the poll in flight
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.polls = 0
+
+    def update(self, inverter_index, result):
+        '''
+        Store successful poll result (e.g. from a scheduler polling anyway)
+        '''
+        if 'error' not in result:
+            with self.lock:
+                self.entries[inverter_index] = (time.monotonic(), result)
+
+    def cached(self, inverter_index):
+        '''
+        Returns (poll result, age in seconds) or (None, None)
+        '''
+        with self.lock:
+            entry = self.entries.get(inverter_index)
+        if entry is None:
+            return None, None
+        return entry[1], time.monotonic() - entry[0]
+
+    def get(self, inverter_index, max_age=None):
+        '''
+        Reading at most max_age (default ttl) seconds old, polls when needed
+        Returns (poll result, age in seconds, polled). When the poll fails the
+        result is the error, with the last good reading under 'cached' (if any).
+        '''
+        if max_age is None:
+            max_age = self.ttl
+        result, age = self.cached(inverter_index)
+        if result is not None and age <= max_age:
+            return result, age, False
+        with self.lock:
+            flight = self.in_flight.get(inverter_index)
+            leader = flight is None
+            if leader:
+                flight = [threading.Event(), None]
+                self.in_flight[inverter_index] = flight
+        if leader:
+            try:
+                self.polls += 1
+                polled = self.api.poll_inverter(inverter_index, self.timeout)
+            except Exception as poll_error:
+                # e.g. the serial port was not free within command_timeout
+                polled = {'error': str(poll_error)}
+            self.update(inverter_index, polled)
+            flight[1] = polled
+            with self.lock:
+                del self.in_flight[inverter_index]
+            flight[0].set()
+            if 'error' in polled:
+                return self.__error(inverter_index, polled), None, True
+            return polled, 0.0, True
+        # Coalesce with the poll in flight
+        flight[0].wait()
+        if 'error' in flight[1]:
+            return self.__error(inverter_index, flight[1]), None, False
+        result, age = self.cached(inverter_index)
+        return result, age, False
+
+    def __error(self, inverter_index, error):
+        '''
+        Error result with the last good reading (if any)
+        '''
+        result, age = self.cached(inverter_index)
+        error = {'error': error['error']}
+        if result is not None:
+            error['cached'] = result
+            error['age'] = age
+        return error
+
+
+class CacheServer:
+    '''
+    HTTP/JSON front-end of a ReadingCache
+    '''
+
+    def __init__(self, cache, host='0.0.0.0', port=8080):
+        self.cache = cache
+        handler = type('Handler', (_Handler,), {'cache': cache})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self):
+        '''
+        Listening port (useful with port=0)
+        '''
+        return self.httpd.server_address[1]
+
+    def serve_forever(self):
+        '''
+        Serve requests in the calling thread
+        '''
+        self.httpd.serve_forever()
+
+    def start(self):
+        '''
+        Serve requests in a background thread
+        '''
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Stop serving and close the socket
+        '''
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    '''
+    Request handler, cache is set by CacheServer
+    '''
+    cache = None
+    protocol_version = 'HTTP/1.1'
+
+    def __reply(self, status, body, age=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        if age is not None:
+            self.send_header('Age', str(int(age)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def __describe(self, inverter_index, result, age):
+        inverter = self.cache.api.inv_data[inverter_index]
+        body = {'inverter': inverter_index, 'serial': inverter.serial, 'age': age}
+        body.update(result)
+        return body
+
+    def do_GET(self):
+        '''
+        Routes, see module docstring
+        '''
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        inverters = self.cache.api.inv_data
+        if parts == ['inverters']:
+            body = []
+            for inverter_index in range(len(inverters)):
+                result, age = self.cache.cached(inverter_index)
+                body.append(self.__describe(inverter_index, result or {}, age))
+            self.__reply(200, body)
+            return
+        if len(parts) != 2 or parts[0] != 'inverters' or not parts[1].isdigit():
+            self.__reply(404, {'error': 'not found'})
+            return
+        inverter_index = int(parts[1])
+        if inverter_index >= len(inverters):
+            self.__reply(404, {'error': 'unknown inverter'})
+            return
+        max_age = None
+        query = parse_qs(url.query)
+        if 'max_age' in query:
+            try:
+                max_age = float(query['max_age'][0])
+            except ValueError:
+                self.__reply(400, {'error': 'invalid max_age'})
+                return
+        result, age, polled = self.cache.get(inverter_index, max_age)
+        body = self.__describe(inverter_index, result, age)
+        body['polled'] = polled
+        if 'error' in result:
+            self.__reply(503, body, result.get('age'))
+        else:
+            self.__reply(200, body, age)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        '''
+        Quiet, requests are not logged
+        '''
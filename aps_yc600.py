@@ -8,14 +8,931 @@ Based on work from:
 I'm trying to keep this compatible with micropython for ESP32 & python3-serial
 '''
 import time
+from array import array
+try:
+    from binascii import hexlify, unhexlify
+except ImportError:
+    from ubinascii import hexlify, unhexlify
+try:
+    import _thread
+except ImportError:
+    # Port without threads, commands run directly
+    _thread = None
+
+# Every ZNP frame starts with this byte (SOF)
+FRAME_SOF = 0xFE
+# Longest data field the ZNP interface allows
+FRAME_MAX_DATA = 250
+
+# Layout and scaling of poll responses (AF_INCOMING_MSG)
+# Values start at this offset in the frame
+POLL_DATA_OFFSET = 19
+# Offsets in poll data per panel: DC current low byte, shared nibbles byte,
+# DC voltage high byte (both values are 12 bits)
+PANEL_OFFSETS = ((24, 25, 26), (27, 28, 29), (17, 18, 19), (14, 15, 16))
+# Offsets of the 24 bit energy counter per panel
+ENERGY_OFFSETS = (44, 39, 49, 54)
+TEMPERATURE_OFFSET = -258.7
+TEMPERATURE_SCALE = 0.2752
+FREQUENCY_BASE = 50000000
+CURRENT_DC_SCALE = 27.5 / 4096
+VOLTAGE_DC_SCALE = 82.5 / 4096
+# AC voltage is multiplied by this and divided by 4
+VOLTAGE_AC_SCALE = 1 / 1.3277
+ENERGY_SCALE = 8.311 / 3600
+
+def frame_fcs(buf):
+    '''
+    Calculate frame check sequence (XOR of all bytes)
+    Input: bytes, bytearray or memoryview
+    Output: int
+    '''
+    fcs = 0
+    for byte in buf:
+        fcs ^= byte
+    return fcs
+
+def build_frame(cmd):
+    '''
+    Wrap command (2 cmd bytes + payload) in a ZNP frame:
+    SOF, length, cmd, payload, FCS
+    '''
+    frame = bytearray(len(cmd) + 3)
+    frame[0] = FRAME_SOF
+    # Length of message is total length minus cmd (2 bytes)
+    frame[1] = len(cmd) - 2
+    frame[2:-1] = cmd
+    frame[-1] = frame_fcs(memoryview(frame)[1:-1])
+    return frame
+
+def frame_from_hex(cmd):
+    '''
+    Build complete frame from hex string command, returns immutable bytes
+    '''
+    return bytes(build_frame(unhexlify(cmd)))
+
+# Frames without variable parts
+PING_FRAME = frame_from_hex('2101')
+DEVICE_INFO_FRAME = frame_from_hex('2700')
+# ZDO_STATE_CHANGE_IND: started as coordinator
+COORDINATOR_STARTED_FRAME = frame_from_hex('45C009')
+COORDINATOR_START_TIMEOUT = 5000
+
+# Coordinator start steps (in order of _coordinator_frames) with response timeout (ms)
+COORDINATOR_STEPS = (
+    ('startup_option', 1000),
+    ('reset', 3000),
+    ('ieee_address', 1000),
+    ('logical_type', 1000),
+    ('pan_id', 1000),
+    ('channels', 1000),
+    ('af_register', 1000),
+    ('zb_start', 1000),
+    ('device_info', 1000),
+    ('announce', 1000))
+
+# Command priorities for the serial port, lower runs first (see CommandQueue)
+PRIORITY_RECOVERY = 0
+PRIORITY_PAIRING = 1
+PRIORITY_POLLING = 2
+PRIORITY_DIAGNOSTICS = 3
+
+def to_hex(buf):
+    '''
+    Convert bytes to upper-case hex string (compatibility with hex API)
+    '''
+    return hexlify(buf).decode().upper()
+
+_NUMPY = []
+
+def _numpy():
+    '''
+    NumPy module when available (imported on first use), else None
+    '''
+    if not _NUMPY:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _NUMPY.append(numpy)
+    return _NUMPY[0]
+
+def _ticks_ms():
+    '''
+    Milliseconds counter, micropython has no float for time...
+    '''
+    return time.time_ns() // 1000000
+
+def _ticks_us():
+    '''
+    Microseconds counter for stage timings
+    '''
+    return time.time_ns() // 1000
+
+if hasattr(time, 'ticks_ms'):
+    # micropython: small int ticks, time_ns() would allocate a big int
+    def _deadline(timeout):
+        '''
+        Deadline timeout (ms) from now, see _expired
+        '''
+        return time.ticks_add(time.ticks_ms(), timeout)
+
+    def _expired(deadline):
+        '''
+        True when deadline has passed
+        '''
+        return time.ticks_diff(deadline, time.ticks_ms()) <= 0
+else:
+    def _deadline(timeout):
+        '''
+        Deadline timeout (ms) from now, see _expired
+        '''
+        return _ticks_ms() + timeout
+
+    def _expired(deadline):
+        '''
+        True when deadline has passed
+        '''
+        return _ticks_ms() >= deadline
+
+def _wait_lock(lock, timeout):
+    '''
+    Acquire lock, give up after timeout (ms, None waits forever)
+    micropython ignores the timeout argument of acquire, so poll for it
+    '''
+    if timeout is None:
+        lock.acquire()
+        return
+    deadline = _deadline(timeout)
+    while not lock.acquire(0):
+        if _expired(deadline):
+            return
+        time.sleep(0.005)
+
+def _uint_be(buf, start, end):
+    '''
+    Read big-endian unsigned int from buf[start:end] without slicing
+    '''
+    value = 0
+    for i in range(start, end):
+        value = (value << 8) | buf[i]
+    return value
+
+class FrameParser:
+    '''
+    Resumable parser for ZNP frames
+
+    Serial data is fed in arbitrary chunks into a ring buffer, frames()
+    yields every complete frame with a valid FCS. Bytes before a FE
+    (SOF) marker are skipped, on a bad FCS or an impossible length the
+    parser resyncs at the next FE. Incomplete frames stay in the buffer
+    until the next feed(), unless a complete frame follows them (then the
+    start was a stray FE).
+    '''
+
+    def __init__(self, size=512):
+        '''
+        Create parser, size must fit the largest frame (255 + 5 bytes)
+        '''
+        if size < 260:
+            raise Exception('Buffer too small for ZNP frames')
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.size = size
+        self.start = 0
+        self.count = 0
+        # Statistics
+        self.crc_errors = 0
+        self.length_errors = 0
+        self.skipped_bytes = 0
+
+    def reset(self):
+        '''
+        Drop all buffered data
+        '''
+        self.start = 0
+        self.count = 0
+
+    def feed(self, chunk):
+        '''
+        Append chunk (bytes, bytearray or memoryview) to ring buffer.
+        When the buffer overflows the oldest data is dropped.
+        '''
+        chunk = memoryview(chunk)
+        if len(chunk) > self.size:
+            self.skipped_bytes += len(chunk) - self.size
+            chunk = chunk[len(chunk) - self.size:]
+        overflow = self.count + len(chunk) - self.size
+        if overflow > 0:
+            self.__consume(overflow)
+            self.skipped_bytes += overflow
+        end = (self.start + self.count) % self.size
+        first = min(len(chunk), self.size - end)
+        self.buffer[end:end + first] = chunk[:first]
+        if first < len(chunk):
+            self.buffer[:len(chunk) - first] = chunk[first:]
+        self.count += len(chunk)
+
+    def space(self, limit=None):
+        '''
+        Free part of the ring buffer after the buffered data as memoryview
+        (at most limit bytes), fill it and call commit() to add it without copying
+        '''
+        end = (self.start + self.count) % self.size
+        space = min(self.size - self.count, self.size - end)
+        if limit is not None:
+            space = min(space, limit)
+        return self.view[end:end + space]
+
+    def commit(self, length):
+        '''
+        Add length bytes written into space()
+        '''
+        if length:
+            self.count += length
+
+    def fill(self, reader, limit=None):
+        '''
+        Read from reader straight into the ring buffer with reader.readinto
+        limit: bytes available (UART.any() / in_waiting), returns number of bytes read
+        '''
+        if self.count == self.size or limit == 0:
+            return 0
+        length = reader.readinto(self.space(limit))
+        if not length:
+            return 0
+        self.count += length
+        return length
+
+    def next_frame(self, out):
+        '''
+        Copy next complete, validated frame into out (bytearray of at least
+        FRAME_MAX_DATA + 5 bytes) and return its length, 0 when there is none.
+        Unlike frames() this does not allocate.
+        '''
+        buffer = self.buffer
+        size = self.size
+        while self.count > 0:
+            # Resync on SOF marker
+            if buffer[self.start] != FRAME_SOF:
+                self.__consume(1)
+                self.skipped_bytes += 1
+                continue
+            if self.count < 5:
+                return 0
+            data_len = self.__peek(1)
+            if data_len > FRAME_MAX_DATA:
+                # Corrupt length byte, not a real frame start
+                self.length_errors += 1
+                self.__consume(1)
+                continue
+            frame_len = data_len + 5 # FE XX XXXX ... XX
+            if frame_len > self.count:
+                skip = self.__later_frame()
+                if not skip:
+                    # Wait for rest of frame
+                    return 0
+                self.__consume(skip)
+                self.skipped_bytes += skip
+                continue
+            pos = self.start
+            fcs = 0
+            for index in range(frame_len):
+                byte = buffer[pos]
+                out[index] = byte
+                fcs ^= byte
+                pos += 1
+                if pos == size:
+                    pos = 0
+            # XOR over LEN .. FCS is 0 for a valid frame (SOF 0xFE included)
+            if fcs != FRAME_SOF:
+                # Not a real frame start, try next FE
+                self.crc_errors += 1
+                self.__consume(1)
+                continue
+            self.__consume(frame_len)
+            return frame_len
+        return 0
+
+    def __peek(self, offset):
+        '''
+        Return byte at offset from start of buffered data
+        '''
+        return self.buffer[(self.start + offset) % self.size]
+
+    def __later_frame(self):
+        '''
+        Offset of a complete, valid frame after the incomplete one at the
+        start, 0 when there is none. A stray FE with a large length byte
+        would otherwise hide the frames behind it until the length is filled.
+        '''
+        for offset in range(1, self.count - 4):
+            if self.__peek(offset) != FRAME_SOF:
+                continue
+            frame_len = self.__peek(offset + 1) + 5
+            end = offset + frame_len
+            if frame_len > FRAME_MAX_DATA + 5 or end > self.count:
+                continue
+            # Real frames are back to back, this makes a match inside data unlikely
+            if end < self.count and self.__peek(end) != FRAME_SOF:
+                continue
+            # XOR over LEN .. FCS is 0 for a valid frame
+            fcs = 0
+            for index in range(offset + 1, offset + frame_len):
+                fcs ^= self.__peek(index)
+            if fcs == 0:
+                return offset
+        return 0
+
+    def __consume(self, length):
+        '''
+        Drop length bytes from start of buffered data
+        '''
+        self.start = (self.start + length) % self.size
+        self.count -= length
+
+    def __copy(self, length):
+        '''
+        Copy length bytes from start of buffered data
+        '''
+        end = self.start + length
+        if end <= self.size:
+            return bytes(memoryview(self.buffer)[self.start:end])
+        return bytes(self.buffer[self.start:]) + bytes(self.buffer[:end - self.size])
+
+    def frames(self):
+        '''
+        Generator yielding complete, validated frames as bytes
+        '''
+        while self.count > 0:
+            # Resync on SOF marker
+            if self.__peek(0) != FRAME_SOF:
+                self.__consume(1)
+                self.skipped_bytes += 1
+                continue
+            if self.count < 5:
+                return
+            if self.__peek(1) > FRAME_MAX_DATA:
+                # Corrupt length byte, not a real frame start
+                self.length_errors += 1
+                self.__consume(1)
+                continue
+            frame_len = self.__peek(1) + 5 # FE XX XXXX ... XX
+            if frame_len > self.count:
+                skip = self.__later_frame()
+                if not skip:
+                    # Wait for rest of frame
+                    return
+                self.__consume(skip)
+                self.skipped_bytes += skip
+                continue
+            frame = self.__copy(frame_len)
+            if frame_fcs(memoryview(frame)[1:-1]) != frame[-1]:
+                # Not a real frame start, try next FE
+                self.crc_errors += 1
+                self.__consume(1)
+                continue
+            self.__consume(frame_len)
+            yield frame
+
+    def parse(self, data):
+        '''
+        Generator feeding data of any length and yielding all complete frames
+        '''
+        data = memoryview(data)
+        pos = 0
+        while pos < len(data):
+            # After frames() at most one incomplete frame is left in the buffer
+            space = self.size - self.count
+            self.feed(data[pos:pos + space])
+            pos += space
+            for frame in self.frames():
+                yield frame
+
+
+class Inverter:
+    '''
+    Registered inverter
+    '''
+    __slots__ = ('serial', 'inv_id', 'panels', 'serial_bytes', 'addr',
+                 'poll_frame', 'pair_frames')
+
+    def __init__(self, inv_serial, inv_id, num_panels):
+        '''
+        serial and inv_id as hex strings, num_panels 2 (YC600) or 4 (QS1)
+        A serial that is not 12 hex characters is accepted for polling only
+        '''
+        self.serial = inv_serial
+        try:
+            self.serial_bytes = unhexlify(inv_serial)
+        except ValueError:
+            self.serial_bytes = b''
+        if len(self.serial_bytes) != 6:
+            print('Inverter serial should be 12 hex characters, pairing will not work')
+            self.serial_bytes = b''
+        self.panels = num_panels
+        self.inv_id = None
+        self.addr = None
+        # Request frames, built by ApsYc600 once they are needed
+        self.poll_frame = None
+        self.pair_frames = None
+        self.set_id(inv_id)
+
+    def set_id(self, inv_id):
+        '''
+        Set inverter ID (short address), stored as int too for frame lookups
+        '''
+        if len(inv_id) != 4:
+            raise Exception('Inverter ID must be 4 hex characters')
+        self.inv_id = inv_id
+        self.addr = int(inv_id, 16)
+        # Poll request contains inverter ID
+        self.poll_frame = None
+
+    def __getitem__(self, key):
+        '''
+        Dict style access, inv_data used to contain dicts
+        '''
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+
+class InverterRegistry:
+    '''
+    Inverters of one coordinator, indexed by position, serial and inverter ID
+    '''
+    __slots__ = ('inverters', 'by_serial', 'by_addr')
+
+    def __init__(self):
+        self.inverters = []
+        # serial (bytes) -> index
+        self.by_serial = {}
+        # inverter ID / short address (int) -> index, unpaired (0000) excluded
+        self.by_addr = {}
+
+    def __len__(self):
+        return len(self.inverters)
+
+    def __getitem__(self, index):
+        return self.inverters[index]
+
+    def __iter__(self):
+        return iter(self.inverters)
+
+    def append(self, inverter):
+        '''
+        Add Inverter, returns its index
+        '''
+        self.__check_addr(inverter.addr, -1)
+        index = len(self.inverters)
+        self.inverters.append(inverter)
+        if inverter.serial_bytes:
+            self.by_serial[inverter.serial_bytes] = index
+        if inverter.addr:
+            self.by_addr[inverter.addr] = index
+        return index
+
+    def __check_addr(self, addr, index):
+        '''
+        Replies are routed by inverter ID, so it must be unique (0000 is not paired yet)
+        '''
+        if addr and self.by_addr.get(addr, index) != index:
+            raise Exception('Inverter ID already registered')
+
+    def set_id(self, index, inv_id):
+        '''
+        Change inverter ID of inverter at index
+        '''
+        inverter = self.inverters[index]
+        self.__check_addr(int(inv_id, 16), index)
+        if self.by_addr.get(inverter.addr) == index:
+            del self.by_addr[inverter.addr]
+        inverter.set_id(inv_id)
+        if inverter.addr:
+            self.by_addr[inverter.addr] = index
+
+    def index_by_addr(self, frame):
+        '''
+        Index of inverter sending AF_INCOMING_MSG frame (source address), or -1
+        '''
+        return self.by_addr.get(frame[8] | (frame[9] << 8), -1)
+
+    def index_by_serial(self, frame):
+        '''
+        Index of first registered inverter whose serial is in frame, or -1
+        Lookup time depends on frame length, not on the number of inverters
+        '''
+        if not self.by_serial:
+            return -1
+        for pos in range(len(frame) - 5):
+            index = self.by_serial.get(bytes(frame[pos:pos + 6]))
+            if index is not None:
+                return index
+        return -1
+
+
+class EnergyAccumulator:
+    '''
+    Energy history of all inverters to detect inverter resets
+
+    Last values and offsets are kept in flat arrays, PANEL_SLOTS entries
+    per inverter (unused panels stay 0). In case of inverter restart the
+    energy counters continue (using offset) instead of restarting from 0.
+    '''
+    PANEL_SLOTS = 4
+
+    def __init__(self):
+        self.last = array('d')
+        self.offset = array('d')
+        self.panels = array('B')
+
+    def __len__(self):
+        return len(self.panels)
+
+    def append(self, num_panels):
+        '''
+        Add inverter with num_panels, returns its index
+        '''
+        self.panels.append(num_panels)
+        for _ in range(self.PANEL_SLOTS):
+            self.last.append(0.0)
+            self.offset.append(0.0)
+        return len(self.panels) - 1
+
+    def view(self, index):
+        '''
+        Last values and offsets of inverter (memoryviews into the arrays)
+        '''
+        start = index * self.PANEL_SLOTS
+        end = start + self.panels[index]
+        return memoryview(self.last)[start:end], memoryview(self.offset)[start:end]
+
+    def restore(self, index, last, offsets):
+        '''
+        Set last values and offsets of inverter (e.g. from energy store)
+        '''
+        start = index * self.PANEL_SLOTS
+        for panel in range(self.panels[index]):
+            self.last[start + panel] = last[panel]
+            self.offset[start + panel] = offsets[panel]
+
+    def copy_from(self, other, index):
+        '''
+        Copy history of inverter at index from other accumulator
+        '''
+        last, offsets = other.view(index)
+        self.restore(index, last, offsets)
+
+    def reset(self, index=None):
+        '''
+        Clear history of one inverter, or of all inverters in one pass
+        '''
+        if index is None:
+            zeros = array('d', bytes(8 * len(self.last)))
+            self.last[:] = zeros
+            self.offset[:] = zeros
+            return
+        start = index * self.PANEL_SLOTS
+        for pos in range(start, start + self.PANEL_SLOTS):
+            self.last[pos] = 0.0
+            self.offset[pos] = 0.0
+
+    def update(self, index, energy, out=None):
+        '''
+        Apply offsets to energy values of inverter, returns continued values
+        When out (e.g. an array, may be energy itself) is given the values
+        are written into it instead of a new list.
+        '''
+        start = index * self.PANEL_SLOTS
+        num_panels = self.panels[index]
+        last_energy = 0
+        curr_energy = 0
+        offset_energy = 0
+        for panel in range(num_panels):
+            last_energy += self.last[start + panel]
+            curr_energy += energy[panel]
+            offset_energy += self.offset[start + panel]
+        # If offset + current becomes smaller than last value then update offsets
+        if (curr_energy + offset_energy) < last_energy:
+            # Reset of inverter: update offset
+            for panel in range(num_panels):
+                self.offset[start + panel] = self.last[start + panel]
+        # Return offset + current value & update last value
+        result = [] if out is None else out
+        for panel in range(num_panels):
+            new_energy = self.offset[start + panel] + energy[panel]
+            self.last[start + panel] = new_energy
+            if out is None:
+                result.append(new_energy)
+            else:
+                out[panel] = new_energy
+        return result
+
+    def update_many(self, indexes, energies):
+        '''
+        update() for a whole sweep (unique indexes), vectorized when NumPy is available
+        Returns list of continued values per inverter
+        '''
+        numpy = _numpy() if len(indexes) > 1 else None
+        if numpy is None:
+            return [self.update(index, energy) for index, energy in zip(indexes, energies)]
+        slots = self.PANEL_SLOTS
+        last = numpy.frombuffer(self.last, dtype=numpy.float64).reshape(-1, slots)
+        offset = numpy.frombuffer(self.offset, dtype=numpy.float64).reshape(-1, slots)
+        rows = numpy.array(indexes, dtype=numpy.intp)
+        current = numpy.zeros((len(rows), slots))
+        for row, energy in enumerate(energies):
+            current[row, :len(energy)] = energy
+        restart = current.sum(axis=1) + offset[rows].sum(axis=1) < last[rows].sum(axis=1)
+        offset[rows[restart]] = last[rows[restart]]
+        new_energy = offset[rows] + current
+        last[rows] = new_energy
+        return [new_energy[row, :self.panels[index]].tolist() for row, index in enumerate(rows)]
+
+    def total(self):
+        '''
+        Sum of energy of all inverters (site total)
+        '''
+        return sum(self.last)
+
+
+class PollReading:
+    '''
+    Reusable poll result for the low allocation path (ApsYc600.poll_into)
+
+    Register values are kept as ints in an array, scaled values are only
+    calculated when asked for. Energy holds the continued energy per
+    panel (Wh) after poll_into, the daily counter after decode().
+    '''
+    # raw: temperature, AC frequency, AC voltage, DC current x4, DC voltage x4, energy x4
+    RAW_CURRENT = 3
+    RAW_VOLTAGE = 7
+    RAW_ENERGY = 11
+
+    def __init__(self):
+        self.inverter_index = -1
+        self.num_panels = 0
+        self.raw = array('i', (0 for _ in range(15)))
+        self.energy = array('d', (0.0 for _ in range(4)))
+
+    def decode(self, frame, num_panels):
+        '''
+        Fill registers from poll response frame (bytes, bytearray or memoryview)
+        '''
+        raw = self.raw
+        base = POLL_DATA_OFFSET
+        self.num_panels = num_panels
+        raw[0] = _uint_be(frame, base + 12, base + 14)
+        raw[1] = _uint_be(frame, base + 14, base + 17)
+        raw[2] = _uint_be(frame, base + 30, base + 32)
+        for panel in range(num_panels):
+            curr_pos, shared_pos, volt_pos = PANEL_OFFSETS[panel]
+            shared = frame[base + shared_pos]
+            # DC Current (12 bits, high nibble in low half of shared byte)
+            raw[self.RAW_CURRENT + panel] = frame[base + curr_pos] + ((shared & 0x0F) << 8)
+            # DC Volts (12 bits, low nibble in high half of shared byte)
+            raw[self.RAW_VOLTAGE + panel] = (frame[base + volt_pos] << 4) + (shared >> 4)
+            # Energy counter (daily reset), swapped panel 1 and 2 as reported in
+            # https://github.com/No13/ApsYc600-Pythonlib/issues/1
+            energy_pos = base + ENERGY_OFFSETS[panel]
+            raw[self.RAW_ENERGY + panel] = _uint_be(frame, energy_pos, energy_pos + 3)
+            self.energy[panel] = round(raw[self.RAW_ENERGY + panel] * ENERGY_SCALE, 3)
+
+    def temperature(self):
+        '''
+        Inverter temperature
+        '''
+        return round(TEMPERATURE_OFFSET + self.raw[0] * TEMPERATURE_SCALE, 2)
+
+    def freq_ac(self):
+        '''
+        AC frequency
+        '''
+        return round(FREQUENCY_BASE / self.raw[1], 2)
+
+    def voltage_ac(self):
+        '''
+        AC voltage
+        '''
+        return round((self.raw[2] * VOLTAGE_AC_SCALE) / 4, 2)
+
+    def current_dc(self, panel):
+        '''
+        DC current of panel (0 based)
+        '''
+        return round(self.raw[self.RAW_CURRENT + panel] * CURRENT_DC_SCALE, 2)
+
+    def voltage_dc(self, panel):
+        '''
+        DC voltage of panel (0 based)
+        '''
+        return round(self.raw[self.RAW_VOLTAGE + panel] * VOLTAGE_DC_SCALE, 2)
+
+    def watt(self, panel):
+        '''
+        DC power of panel (0 based)
+        '''
+        return round((self.raw[self.RAW_CURRENT + panel] * CURRENT_DC_SCALE) *
+                     (self.raw[self.RAW_VOLTAGE + panel] * VOLTAGE_DC_SCALE), 2)
+
+    def valid(self):
+        '''
+        False when the DC voltages show the response is not usable
+        '''
+        return self.voltage_dc(0) + self.voltage_dc(1) >= 0.1
+
+    def as_dict(self):
+        '''
+        Values as poll_inverter returns them in 'data'
+        '''
+        panels = range(self.num_panels)
+        values = {'temperature': self.temperature(), 'freq_ac': self.freq_ac()}
+        for panel in panels:
+            values['current_dc%d' % (panel + 1)] = self.current_dc(panel)
+        for panel in panels:
+            values['voltage_dc%d' % (panel + 1)] = self.voltage_dc(panel)
+        values['voltage_ac'] = self.voltage_ac()
+        for panel in panels:
+            values['energy_panel%d' % (panel + 1)] = self.energy[panel]
+        for panel in panels:
+            values['watt_panel%d' % (panel + 1)] = self.watt(panel)
+        return values
+
+
+class Command:
+    '''
+    Request to own the serial port, use as context manager:
+
+        command = api.command(PRIORITY_POLLING, timeout=5000)
+        with command:
+            api.poll_inverter(0)
+
+    Another thread may cancel() it while it waits.
+    state: new, waiting, running, cancelled or timeout
+    '''
+
+    def __init__(self, queue, priority, timeout=None):
+        self.queue = queue
+        self.priority = priority
+        self.timeout = timeout
+        self.state = 'new'
+        self.thread = None
+        self.wake = None
+
+    def __enter__(self):
+        self.queue.acquire(self.priority, self.timeout, self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.queue.release()
+        return False
+
+    def cancel(self):
+        '''
+        Stop waiting for the port, returns False when it already runs
+        '''
+        return self.queue.cancel(self)
+
+
+class CommandQueue:
+    '''
+    One request/response exchange on the serial port at a time
+
+    Commands waiting for the port run in order of priority, then arrival.
+    The thread owning the port may start nested commands (pair_inverter
+    starts the coordinator), they run at once.
+    '''
+
+    def __init__(self):
+        self.__lock = _thread.allocate_lock() if _thread is not None else None
+        # Commands waiting for the port, in the order they will run
+        self.waiting = []
+        # Thread owning the port and its nesting depth
+        self.owner = None
+        self.depth = 0
+
+    def acquire(self, priority, timeout=None, command=None):
+        '''
+        Own the port, waits for the running command and those before it
+        timeout (ms, None waits forever)
+        Raises Exception when the command timed out or was cancelled
+        '''
+        lock = self.__lock
+        if lock is None:
+            return
+        ident = _thread.get_ident()
+        with lock:
+            if command is not None and command.state == 'cancelled':
+                raise Exception('Command cancelled')
+            if self.owner == ident or (self.owner is None and not self.waiting):
+                self.owner = ident
+                self.depth += 1
+                if command is not None:
+                    command.state = 'running'
+                return
+            # Only commands that wait need a Command (keeps uncontended calls small)
+            if command is None:
+                command = Command(self, priority, timeout)
+            command.thread = ident
+            command.state = 'waiting'
+            command.wake = _thread.allocate_lock()
+            command.wake.acquire()
+            position = len(self.waiting)
+            while position and self.waiting[position - 1].priority > command.priority:
+                position -= 1
+            self.waiting.insert(position, command)
+        _wait_lock(command.wake, timeout)
+        with lock:
+            if command.state == 'waiting':
+                self.waiting.remove(command)
+                command.state = 'timeout'
+            state = command.state
+        if state != 'running':
+            raise Exception('Command ' + state)
+
+    def release(self):
+        '''
+        End of exchange, hands the port to the next waiting command
+        '''
+        lock = self.__lock
+        if lock is None:
+            return
+        with lock:
+            self.depth -= 1
+            if self.depth > 0:
+                return
+            self.owner = None
+            if self.waiting:
+                command = self.waiting.pop(0)
+                self.owner = command.thread
+                self.depth = 1
+                command.state = 'running'
+                command.wake.release()
+
+    def cancel(self, command):
+        '''
+        Cancel command that did not start, returns False when it already runs
+        '''
+        lock = self.__lock
+        if lock is None:
+            return False
+        with lock:
+            if command.state == 'new':
+                command.state = 'cancelled'
+                return True
+            if command.state != 'waiting':
+                return False
+            self.waiting.remove(command)
+            command.state = 'cancelled'
+            command.wake.release()
+            return True
+
+    def cancel_waiting(self, priority=PRIORITY_DIAGNOSTICS):
+        '''
+        Cancel all waiting commands of priority or less urgent
+        Returns number of cancelled commands
+        '''
+        cancelled = 0
+        for command in list(self.waiting):
+            if command.priority >= priority and self.cancel(command):
+                cancelled += 1
+        return cancelled
+
+
+def _exclusive(priority):
+    '''
+    Method decorator: the method owns the serial port (ApsYc600.commands)
+    while it runs, waiting at most command_timeout (ms)
+    '''
+    def decorate(method):
+        def exclusive(self, *args, **kwargs):
+            self.commands.acquire(priority, self.command_timeout)
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.commands.release()
+        try:
+            exclusive.__doc__ = method.__doc__
+            exclusive.__name__ = method.__name__
+        except AttributeError:
+            # micropython functions have no writable attributes
+            pass
+        return exclusive
+    return decorate
+
 
 class ApsYc600:
     '''
     Class to communicate with YC600 inverters
+
+    Methods using the serial port own it for their whole exchange, calls
+    from several threads wait for each other (see CommandQueue) and run by
+    priority: coordinator recovery, pairing, polling, diagnostics.
     '''
 
-    # struct to store all inverter data
-    inv_data = []
+    # struct to store all inverter data (InverterRegistry, per instance)
+    inv_data = None
 
     # identification for this ECU / controller
     controller_id = ""
@@ -25,21 +942,58 @@ class ApsYc600:
     writer = None
     system_type = None
 
-    # History data to detect inverter resets
-    energy_data = []
+    # History data to detect inverter resets (EnergyAccumulator, per instance)
+    energy = None
+
+    # Optional instrumentation (see aps_metrics)
+    metrics = None
+
+    # Serial port ownership (CommandQueue) and default wait for it (ms, None: forever)
+    commands = None
+    command_timeout = None
 
     ### Internal helper fuctions
 
-    def __init__(self, reader, writer, controller_id='D8A3011B9780'):
+    def __init__(self, reader, writer, controller_id='D8A3011B9780', energy_store=None,
+                 metrics=None, command_timeout=None):
         '''
         Create controller, default controller ID is supplied
+        energy_store (see aps_energy_store) keeps energy offsets across restarts
+        metrics (see aps_metrics) records stage timings and error counters
+        command_timeout (ms) limits the wait for the serial port, then an Exception is raised
         '''
         if len(controller_id) != 12:
             raise Exception('Controller ID must be 12 hex characters')
         self.controller_id = controller_id
+        self.__controller_rev = self.__reverse_byte_str(controller_id)
+        # Coordinator start frames and steps per pair_mode
+        self.__coordinator_frames = {}
+        self.__coordinator_steps = {}
         self.reader = reader
         self.writer = writer
+        # Each radio keeps its own inverters
+        self.inv_data = InverterRegistry()
+        self.energy = EnergyAccumulator()
+        self.energy_store = energy_store
+        self.__energy_state = {}
+        if energy_store is not None:
+            self.__energy_state = energy_store.load()
+        self.__parser = FrameParser()
+        # Preallocated for poll_into and decoding
+        self.__frame = bytearray(FRAME_MAX_DATA + 5)
+        # Parser and frame buffer of poll_into_async, created on first use
+        self.__async_parser = None
+        self.__async_frame = None
+        self.__reading = PollReading()
+        self.metrics = metrics
+        self.commands = CommandQueue()
+        self.command_timeout = command_timeout
+        # Parser statistics already counted in metrics
+        self.__parser_seen = (0, 0, 0)
 
+        # Subclasses with their own transport set system_type themselves
+        if self.system_type is not None:
+            return
         # Try and test the reader for 'in_waiting' function
         if 'in_waiting' in dir(self.reader):
             print('Found python3-serial module')
@@ -61,67 +1015,25 @@ class ApsYc600:
             out_str = ''.join((out_str, in_str[i-2], in_str[i-1]))
         return out_str
 
-    @staticmethod
-    def __crc(in_str):
+    def __send_frame(self, frame):
         '''
-        Calculate CRC
-        Input: string containing hex characters
-        Output: hex value
+        Send complete (prebuilt) frame
         '''
-        if len(in_str) % 2 > 0:
-            raise Exception('Input is not an even number of characters')
-        crc_res = 0
-        for i in range(0, len(in_str), 2):
-            # Calculate crc
-            crc_res = crc_res ^ int(in_str[i:i+2], 16)
-        # Return as hex value
-        return hex(crc_res)
-
-    def __crc_check(self, in_str):
-        '''
-        Check CRC in message
-        '''
-        # Convert message to upper-case for string compare later
-        in_str = in_str.upper()
-        # Only messages starting with FE are valid
-        if in_str[:2] != 'FE':
-            raise Exception('Data corrupt')
-        # Strip CRC and FE header
-        data_check = in_str[2:][:-2]
-        # Assemble CRC in message
-        crc_to_check = ''.join(('0X', in_str[-2:]))
-        # Calculate CRC For message
-        crc_calc = str(self.__crc(data_check)).upper()
-        # Return compare
-        return crc_calc == crc_to_check
-
-    def __send_cmd(self, cmd):
-        '''
-        Send cmd
-        '''
-        # All commands are prefixed with 0xFE
-        prefix_cmd = 'FE'
-        # Length of message is total length / 2 minus cmd (2 bytes) (and strip '0x')
-        cmdlen = hex(int(len(cmd) / 2) - 2)[2:]
-        # Pad length to 2 bytes
-        if len(cmdlen) == 1:
-            cmdlen = ''.join(('0', str(cmdlen)))
-        # Assemble and add CRC
-        cmd = ''.join((prefix_cmd, cmdlen, cmd, self.__crc(cmdlen+cmd)[2:]))
-        # Send each set of two characters as byte
-        for i in range(0, len(cmd), 2):
-            new_char = int(cmd[i:i+2], 16).to_bytes(1, 'big')
-            self.writer.write(new_char)
+        if self.metrics is None:
+            self.writer.write(frame)
+            return
+        start = _ticks_us()
+        self.writer.write(frame)
+        self.metrics.observe('send', (_ticks_us() - start) / 1000000)
 
     def __listen(self, timeout=1000):
         '''
         Listen for serial output
-        When serial buffer is empty after timeout, return ''
+        When serial buffer is empty after timeout, return b''
 
         When reader has no in_waiting function assume read() is non-blocking.
-        TODO: Convert str to bytearray
         '''
-        out_str = ""
+        buffer = bytearray()
         # micropython has no float for time...
         end_time_ms = (time.time_ns() // 1000000) + timeout
         if self.system_type == 'python3-serial':
@@ -130,36 +1042,146 @@ class ApsYc600:
             time.sleep(0.1)
             # Only read characters when serial buffer is not empty
             while self.reader.in_waiting > 0:
-                new_char = self.reader.read()
-                hex_char = new_char.hex()
-                if len(hex_char) == 1:
-                    hex_char = '0'+hex_char
-                out_str += hex_char
+                buffer.extend(self.reader.read(self.reader.in_waiting))
         else:
             # micropython seems to be slow;
             time.sleep(0.5)
             # Read current buffer
-            buffer = self.reader.read()
+            chunk = self.reader.read()
             # While buffer is empty, retry until buffer is not, or timeout expires
-            while (buffer is None) and ((time.time_ns() // 1000000) < end_time_ms):
+            while (chunk is None) and ((time.time_ns() // 1000000) < end_time_ms):
                 time.sleep(0.1)
-                buffer = self.reader.read()
+                chunk = self.reader.read()
             # After first characters are received, wait short time and read the rest.
             time.sleep(0.2)
-            temp_str = b""
-            while buffer is not None:
-                temp_str += buffer
+            while chunk is not None:
+                buffer.extend(chunk)
                 time.sleep(0.1)
-                buffer = self.reader.read()
-            # Convert binary string to hex-string
-            for i in temp_str:
-                temp_char = hex(i)[2:]
-                if len(temp_char) == 1:
-                    temp_char = '0'+temp_char
-                out_str += temp_char
-        return out_str
+                chunk = self.reader.read()
+        return bytes(buffer)
+
+    def __read_available(self):
+        '''
+        Read all bytes currently in the serial buffer without waiting
+        Returns None when buffer is empty
+        '''
+        if self.system_type == 'python3-serial':
+            waiting = self.reader.in_waiting
+            if waiting == 0:
+                return None
+            return self.reader.read(waiting)
+        return self.reader.read()
+
+    def _metric_label(self, inverter_index):
+        '''
+        Metrics label of inverter, '' when not known
+        '''
+        if 0 <= inverter_index < len(self.inv_data):
+            return self.inv_data[inverter_index].serial
+        return ''
+
+    def _count(self, name, inverter_index=-1):
+        '''
+        Increment metrics counter for inverter (when metrics are enabled)
+        '''
+        if self.metrics is not None:
+            self.metrics.inc(name, self._metric_label(inverter_index))
+
+    def __count_parser(self, label):
+        '''
+        Move new parser error statistics to metrics
+        '''
+        parser = self.__parser
+        seen = self.__parser_seen
+        current = (parser.crc_errors, parser.length_errors, parser.skipped_bytes)
+        if current == seen:
+            return
+        for name, now, before in zip(
+                ('crc_errors', 'length_errors', 'skipped_bytes'), current, seen):
+            if now > before:
+                self.metrics.inc(name, label, now - before)
+        self.__parser_seen = current
 
-    def __decode(self, in_str, inverter_index):
+    def __timed_frames(self, buffer, label):
+        '''
+        Generator like FrameParser.parse, recording parse time and errors
+        '''
+        frames = self.__parser.parse(buffer)
+        while True:
+            start = _ticks_us()
+            try:
+                frame = next(frames)
+            except StopIteration:
+                self.__count_parser(label)
+                return
+            self.metrics.observe('parse', (_ticks_us() - start) / 1000000, label)
+            self.__count_parser(label)
+            yield frame
+
+    def __receive(self, label=''):
+        '''
+        Read serial buffer without waiting
+        Returns None when it was empty, otherwise a generator of complete frames
+        '''
+        if self.metrics is None:
+            buffer = self.__read_available()
+            if not buffer:
+                return None
+            return self.__parser.parse(buffer)
+        start = _ticks_us()
+        buffer = self.__read_available()
+        if not buffer:
+            return None
+        self.metrics.observe('read', (_ticks_us() - start) / 1000000, label)
+        return self.__timed_frames(buffer, label)
+
+    def __wait_for_request(self, frame, match, timeout=1000):
+        '''
+        Send frame and wait for response, see __wait_for
+        '''
+        self.__send_frame(frame)
+        return self.__wait_for(match, timeout)
+
+    def __drain(self):
+        '''
+        Discard everything received so far, including partial frames
+        '''
+        # A noisy line never gets empty, stop after a few reads
+        for _ in range(8):
+            if not self.__read_available():
+                break
+        self.__parser.reset()
+
+    def __wait_for(self, match, timeout=1000, inverter_index=-1):
+        '''
+        Read and decode frames until match(frame) is True or timeout (ms) expires
+        Returns the decoded matching frame (or None) and all decoded frames
+        '''
+        decoded_cmd = []
+        label = self._metric_label(inverter_index)
+        waiting = self.metrics is not None
+        start = _ticks_us()
+        end_time_ms = _ticks_ms() + timeout
+        # Complete frames left in the parser by an earlier match come first
+        frames = self.__parser.frames()
+        while True:
+            for frame in frames:
+                response = self._decode(frame, inverter_index)
+                decoded_cmd.append(response)
+                if match(frame):
+                    return response, decoded_cmd
+            # Checked every round, noise or other frames may keep arriving
+            if _ticks_ms() >= end_time_ms:
+                return None, decoded_cmd
+            frames = self.__receive(label)
+            if frames is None:
+                frames = ()
+                time.sleep(0.005)
+            elif waiting:
+                self.metrics.observe('first_byte', (_ticks_us() - start) / 1000000, label)
+                waiting = False
+
+    def _decode(self, frame, inverter_index):
         '''
         Decode message type, start decoding of received information
         Called by: parse
@@ -182,112 +1204,53 @@ class ApsYc600:
             '6700': 'StartCoordinatorResp'}
 
         # Replace code with string when available
-        cmd_code = in_str[4:8]
+        cmd_code = to_hex(frame[2:4])
         if cmd_code in known_cmds:
             cmd_code = known_cmds.get(cmd_code)
 
-        data = in_str[8:-2]
+        data = None
+        if cmd_code == 'AF_INCOMING_MSG':
+            # Can be answer to poll request or pair request
+            if len(frame) < 111:
+                if self.inv_data.index_by_serial(frame) >= 0:
+                    # Decode pair request is done in pair_inverter function
+                    data = to_hex(frame)
+            elif inverter_index >= 0:
+                # Decode inverter poll response
+                if self.metrics is None:
+                    data = self.__decode_inverter_values(frame, inverter_index)
+                else:
+                    start = _ticks_us()
+                    data = self.__decode_inverter_values(frame, inverter_index)
+                    self.metrics.observe('decode', (_ticks_us() - start) / 1000000,
+                                         self._metric_label(inverter_index))
+        if data is None:
+            data = to_hex(frame[4:-1])
+        # FrameParser only returns frames with a valid CRC
+        return {'cmd': cmd_code, 'crc': True, 'data': data}
 
-        # Check CRC
-        crc = self.__crc_check(in_str)
+    def __decode_inverter_values(self, frame, inverter_index):
+        '''
+        Transform poll response frame to values
+        called by: _decode
+        '''
+        reading = self.__reading
+        reading.decode(frame, self.inv_data[inverter_index].panels)
+        return reading.as_dict()
 
-        if cmd_code == 'AF_INCOMING_MSG' and crc:
-            # Can be answer to poll request or pair request
-            pair = False
-            if len(in_str) < 222:
-                for inverter in self.inv_data:
-                    if inverter['serial'] in in_str:
-                        # Decode pair request is done in pair_inverter function
-                        data = in_str
-                        pair = True
-                        break
-            else:
-                if not pair and (inverter_index >= 0):
-                    # Decode inverter poll response
-                    data = self.__decode_inverter_values(in_str, inverter_index)
-        return {'cmd': cmd_code, 'crc': crc, 'data': data}
-
-    def __decode_inverter_values(self, in_str, inverter_index):
-        '''
-        Transform byte string of poll response to values
-        called by: __decode
-        '''
-        # We do not need the first 38 bytes apparently
-        data = in_str[38:]
-        voltdc = []
-        currdc = []
-        en_pan = []
-        num_panels = self.inv_data[inverter_index]['panels']
-        invtemp = -258.7 + (int(data[24:28], 16) * 0.2752) # Inverter temperature
-        freq_ac = 50000000 / int(data[28:34], 16) # AC Fequency
-        # DC Current for panel 1
-        currdc.append((int(data[48:50], 16) + (int(data[51], 16) * 256)) * (27.5 / 4096))
-        # DC Volts for panel 1
-        voltdc.append((int(data[52:54], 16) * 16 + int(data[50], 16)) * (82.5 / 4096))
-        currdc.append((int(data[54:56], 16) + (int(data[57], 16) * 256)) * (27.5 / 4096))
-        voltdc.append((int(data[58:60], 16) * 16 + int(data[56], 16)) * (82.5 / 4096))
-        volt_ac = (int(data[60:64], 16) * (1 / 1.3277)) / 4
-        # Energy counter (daily reset), swapped panel 1 and 2 as reported in
-        # https://github.com/No13/ApsYc600-Pythonlib/issues/1
-        en_pan.append(int(data[88:94], 16) * (8.311 / 3600))
-        en_pan.append(int(data[78:84], 16) * (8.311 / 3600))
-        if num_panels == 4:
-            currdc.append((int(data[34:36], 16) + (int(data[37], 16) * 256)) *(27.5 / 4096))
-            voltdc.append((int(data[38:40], 16) * 16 + int(data[36], 16)) * (82.5 / 4096))
-            currdc.append((int(data[28:30], 16) + (int(data[31], 16) * 256)) *(27.5 / 4096))
-            voltdc.append((int(data[32:34], 16) * 16 + int(data[30], 16)) * (82.5 / 4096))
-            en_pan.append(int(data[98:104], 16) * (8.311 / 3600))
-            en_pan.append(int(data[108:114], 16) * (8.311 / 3600))
-            return {
-                'temperature': round(invtemp, 2),
-                'freq_ac': round(freq_ac, 2),
-                'current_dc1': round(currdc[0], 2),
-                'current_dc2': round(currdc[1], 2),
-                'current_dc3': round(currdc[2], 2),
-                'current_dc4': round(currdc[3], 2),
-                'voltage_dc1': round(voltdc[0], 2),
-                'voltage_dc2': round(voltdc[1], 2),
-                'voltage_dc3': round(voltdc[2], 2),
-                'voltage_dc4': round(voltdc[3], 2),
-                'voltage_ac': round(volt_ac, 2),
-                'energy_panel1': round(en_pan[0], 3),
-                'energy_panel2': round(en_pan[1], 3),
-                'energy_panel3': round(en_pan[2], 3),
-                'energy_panel4': round(en_pan[3], 3),
-                'watt_panel1': round(currdc[0] * voltdc[0], 2),
-                'watt_panel2': round(currdc[1] * voltdc[1], 2),
-                'watt_panel3': round(currdc[2] * voltdc[2], 2),
-                'watt_panel4': round(currdc[3] * voltdc[3], 2)}
-
-        return {
-            'temperature': round(invtemp, 2),
-            'freq_ac': round(freq_ac, 2),
-            'current_dc1': round(currdc[0], 2),
-            'current_dc2': round(currdc[1], 2),
-            'voltage_dc1': round(voltdc[0], 2),
-            'voltage_dc2': round(voltdc[1], 2),
-            'voltage_ac': round(volt_ac, 2),
-            'energy_panel1': round(en_pan[0], 3),
-            'energy_panel2': round(en_pan[1], 3),
-            'watt_panel1': round(currdc[0] * voltdc[0], 2),
-            'watt_panel2': round(currdc[1] * voltdc[1], 2)}
-
-    def __parse(self, in_str, inverter_index=-1):
+    def __parse(self, buffer, inverter_index=-1):
         '''
         Parse incoming messages
-            Split multiple messages, decode them and return the output
+            Feed data to frame parser, decode all complete frames and return the output
+            Incomplete frames are kept for the next call
         '''
-        in_str = in_str.upper()
         decoded_cmd = []
-        while in_str[:2] == 'FE':
-            # New command found
-            str_len = int(in_str[2:4], 16) # Decode cmd len
-            min_len = int((len(in_str) - 10) / 2) # FE XX XXXX ... XX
-            if str_len > min_len: # Check if data is sufficient for found str_len
-                raise Exception('Data corrupt, length field does not match actual length')
-            cmd = in_str[:(10 + str_len * 2)] # Copy command to str
-            in_str = in_str[10 + (str_len * 2):]
-            decoded_cmd.append(self.__decode(cmd, inverter_index))
+        if self.metrics is None:
+            frames = self.__parser.parse(buffer)
+        else:
+            frames = self.__timed_frames(buffer, self._metric_label(inverter_index))
+        for frame in frames:
+            decoded_cmd.append(self._decode(frame, inverter_index))
         return decoded_cmd
 
     # Public functions
@@ -301,30 +1264,13 @@ class ApsYc600:
         '''
         if num_panels not in (2, 4):
             raise Exception("Only 2 or 4 panels supported")
-        inverter = {
-            'serial': inv_serial,
-            'inv_id': inv_id,
-            'panels': num_panels}
-        self.inv_data.append(inverter)
-        inverter_index = len(self.inv_data) -1
-        if num_panels == 2:
-            self.energy_data.append(
-                {
-                    'last_energy_p1': 0,
-                    'last_energy_p2': 0,
-                    'energy_offset_p1': 0,
-                    'energy_offset_p2': 0})
-        else:
-            self.energy_data.append(
-                {
-                    'last_energy_p1': 0,
-                    'last_energy_p2': 0,
-                    'last_energy_p3': 0,
-                    'last_energy_p4': 0,
-                    'energy_offset_p1': 0,
-                    'energy_offset_p2': 0,
-                    'energy_offset_p3': 0,
-                    'energy_offset_p4': 0})
+        inverter_index = self.inv_data.append(Inverter(inv_serial, inv_id, num_panels))
+        self._poll_frame(inverter_index)
+        self.energy.append(num_panels)
+        # Continue counters stored before a restart
+        stored = self.__energy_state.get(inv_serial.upper())
+        if stored is not None:
+            self.energy.restore(inverter_index, stored[0], stored[1])
         return inverter_index # Return index for last inverter
 
     def set_inverter_id(self, inv_index, inv_id):
@@ -333,20 +1279,98 @@ class ApsYc600:
         '''
         if len(self.inv_data) <= inv_index:
             raise Exception('Invalid inverter index')
-        self.inv_data[inv_index]['inv_id'] = inv_id
+        self.inv_data.set_id(inv_index, inv_id)
+        self._poll_frame(inv_index)
         return True
 
-    def reset_counters(self, inverter_index):
+    @property
+    def energy_data(self):
+        '''
+        History data as list of dicts (a copy, see self.energy)
+        Changing the dicts has no effect, assign the whole list instead
+        '''
+        result = []
+        for inverter_index in range(len(self.energy)):
+            last, offsets = self.energy.view(inverter_index)
+            energy = {}
+            for panel in range(len(last)):
+                energy['last_energy_p%d' % (panel + 1)] = last[panel]
+                energy['energy_offset_p%d' % (panel + 1)] = offsets[panel]
+            result.append(energy)
+        return result
+
+    @energy_data.setter
+    def energy_data(self, energy_data):
+        '''
+        Restore history data from a list of dicts as energy_data returns
+        (compatibility with the former list attribute)
+        '''
+        for inverter_index, energy in enumerate(energy_data):
+            panels = range(self.inv_data[inverter_index].panels)
+            self.energy.restore(
+                inverter_index,
+                [energy.get('last_energy_p%d' % (panel + 1), 0) for panel in panels],
+                [energy.get('energy_offset_p%d' % (panel + 1), 0) for panel in panels])
+
+    def store_energy(self, inverter_index):
+        '''
+        Save history data of inverter in energy store (if any)
+        '''
+        if self.energy_store is None:
+            return
+        last, offsets = self.energy.view(inverter_index)
+        self.energy_store.save(self.inv_data[inverter_index].serial, last, offsets)
+
+    def reset_counters(self, inverter_index=None):
         '''
-        Reset historical data
+        Reset historical data of one inverter, or of all inverters
         '''
-        self.energy_data[inverter_index] = {
-            'last_energy_p1': 0,
-            'last_energy_p2': 0,
-            'energy_offset_p1': 0,
-            'energy_offset_p2': 0}
+        self.energy.reset(inverter_index)
+        if inverter_index is None:
+            for index in range(len(self.energy)):
+                self.store_energy(index)
+        else:
+            self.store_energy(inverter_index)
+
+    @staticmethod
+    def _trans_id(inverter_index):
+        '''
+        Transaction ID for poll requests to inverter (1-255)
+        Used to match AF_DATA_CONFIRM (NoRoute) to the request
+        '''
+        return (inverter_index % 255) + 1
+
+    def _poll_frame(self, inverter_index):
+        '''
+        Poll request frame for inverter, built once per inverter ID
+        '''
+        inverter = self.inv_data[inverter_index]
+        if inverter.poll_frame is None:
+            inverter.poll_frame = frame_from_hex(''.join(
+                ('2401', self.__reverse_byte_str(inverter.inv_id),
+                 '14140600', '%02X' % self._trans_id(inverter_index), '000F13',
+                 self.__controller_rev, 'FBFB06BB000000000000C1FEFE')))
+        return inverter.poll_frame
+
+    def _poll_answer(self, inverter_index):
+        '''
+        Return function matching the poll response from inverter or NoRoute
+        '''
+        addr = self.inv_data[inverter_index].addr
+        trans_id = self._trans_id(inverter_index)
+
+        def poll_answer(frame):
+            '''
+            Poll response from this inverter or NoRoute for this request
+            '''
+            if frame[2] == 0x44 and frame[3] == 0x81:
+                return len(frame) >= 111 and (frame[8] | (frame[9] << 8)) == addr
+            return (frame[2] == 0x44 and frame[3] == 0x80 and frame[4] == 0xCD
+                    and frame[6] == trans_id)
+        return poll_answer
 
-    def poll_inverter(self, inverter_index):
+    @_exclusive(PRIORITY_POLLING)
+    def poll_inverter(self, inverter_index, timeout=2000, retries=0):
         '''
         Get values from inverter.
 
@@ -355,188 +1379,491 @@ class ApsYc600:
         instead of restarting from 0.
 
         This will require you to reset_counters every day to begin a new day at 0.
+
+        Returns as soon as the inverter answered, or after timeout (ms)
+        A timeout or NoRoute is retried up to retries times.
         '''
-        # Clear serial buffer
-        self.clear_buffer()
         if inverter_index > len(self.inv_data) -1:
             raise Exception('Invalid inverter')
-        num_panels = self.inv_data[inverter_index]['panels']
+        while True:
+            result = self.__poll_once(inverter_index, timeout)
+            if retries <= 0 or result.get('error') not in ('timeout', 'NoRoute'):
+                return result
+            retries -= 1
+            self._count('retries', inverter_index)
+
+    def __poll_once(self, inverter_index, timeout):
+        '''
+        Single poll request, see poll_inverter
+        '''
+        self._count('polls', inverter_index)
+        # Clear serial buffer
+        self.__drain()
+        start = _ticks_us()
         # Send poll request
-        self.__send_cmd(''.join(
-            ('2401', self.__reverse_byte_str(self.inv_data[inverter_index]['inv_id']),
-             '1414060001000F13', self.__reverse_byte_str(self.controller_id),
-             'FBFB06BB000000000000C1FEFE')))
-        time.sleep(1)
+        self.__send_frame(self._poll_frame(inverter_index))
         # Check poll response
-        return_str = self.__listen()
-        response_data = self.__parse(return_str, inverter_index)
-        # Check if correct response is found...
-        for response in response_data:
-            if response['cmd'] == '4480' and 'CD' in response['data']:
-                return {'error': 'NoRoute'}
-            if response['cmd'] == 'AF_INCOMING_MSG':
-                # Calculate energy
-                if not 'data' in response:
-                    return {'error': 'incomplete'}
-                if not 'energy_panel1' in response['data']:
-                    return {'error': 'incomplete', 'data': response}
-                if response['data']['voltage_dc1'] + response['data']['voltage_dc2'] < 0.1:
-                    return {'error': 'data error', 'data': response}
-                # Retrieve last energy values
-                last_energy = self.energy_data[inverter_index]['last_energy_p1']
-                last_energy += self.energy_data[inverter_index]['last_energy_p2']
-                # Retrieve current energy values
-                curr_energy = response['data']['energy_panel1']
-                curr_energy += response['data']['energy_panel2']
-                # Retrieve offset energy
-                offset_energy = self.energy_data[inverter_index]['energy_offset_p1']
-                offset_energy += self.energy_data[inverter_index]['energy_offset_p2']
-                if num_panels == 4:
-                    last_energy += self.energy_data[inverter_index]['last_energy_p3']
-                    last_energy += self.energy_data[inverter_index]['last_energy_p4']
-                    curr_energy += response['data']['energy_panel3']
-                    curr_energy += response['data']['energy_panel4']
-                    offset_energy += self.energy_data[inverter_index]['energy_offset_p3']
-                    offset_energy += self.energy_data[inverter_index]['energy_offset_p4']
-                # If offset + current becomes smaller than last value then update offsets
-                if (curr_energy + offset_energy) < last_energy:
-                    # Reset of inverter: update offset
-                    new_offset = self.energy_data[inverter_index]['last_energy_p1']
-                    self.energy_data[inverter_index]['energy_offset_p1'] = new_offset
-                    new_offset = self.energy_data[inverter_index]['last_energy_p2']
-                    self.energy_data[inverter_index]['energy_offset_p2'] = new_offset
-                    if num_panels == 4:
-                        new_offset = self.energy_data[inverter_index]['last_energy_p3']
-                        self.energy_data[inverter_index]['energy_offset_p3'] = new_offset
-                        new_offset = self.energy_data[inverter_index]['last_energy_p4']
-                        self.energy_data[inverter_index]['energy_offset_p4'] = new_offset
-                # Return offset + current value & update last value
-                new_energy = self.energy_data[
-                    inverter_index]['energy_offset_p1'] + response['data']['energy_panel1']
-                self.energy_data[
-                    inverter_index]['last_energy_p1'] = new_energy
-                response['data']['energy_panel1'] = new_energy
-
-                new_energy = self.energy_data[
-                    inverter_index]['energy_offset_p2'] + response['data']['energy_panel2']
-                self.energy_data[
-                    inverter_index]['last_energy_p2'] = new_energy
-                response['data']['energy_panel2'] = new_energy
-
-                if num_panels == 4:
-                    new_energy = self.energy_data[
-                        inverter_index]['energy_offset_p3'] + response['data']['energy_panel3']
-                    self.energy_data[
-                        inverter_index]['last_energy_p3'] = new_energy
-                    response['data']['energy_panel3'] = new_energy
-
-                    new_energy = self.energy_data[
-                        inverter_index]['energy_offset_p4'] + response['data']['energy_panel4']
-                    self.energy_data[
-                        inverter_index]['last_energy_p4'] = new_energy
-                    response['data']['energy_panel4'] = new_energy
-
-                return response
-        return {'error': 'timeout', 'data': response_data}
-
-    def ping_radio(self):
+        response, response_data = self.__wait_for(
+            self._poll_answer(inverter_index), timeout, inverter_index)
+        if response is None:
+            self._count('timeouts', inverter_index)
+            return {'error': 'timeout', 'data': response_data}
+        if response['cmd'] == '4480':
+            self._count('noroute', inverter_index)
+            return {'error': 'NoRoute'}
+        if self.metrics is not None:
+            self.metrics.observe('response', (_ticks_us() - start) / 1000000,
+                                 self._metric_label(inverter_index))
+        return self._process_poll_response(inverter_index, response)
+
+    def __poll_frame_kind(self, frame, inverter_index, length):
+        '''
+        Kind of frame (frame buffer holding length bytes) for a poll of inverter:
+        1 poll response, 2 NoRoute, 0 anything else
+        '''
+        if frame[2] != 0x44:
+            return 0
+        if frame[3] == 0x81:
+            if length >= 111 and (
+                    frame[8] | (frame[9] << 8)) == self.inv_data[inverter_index].addr:
+                return 1
+        elif frame[3] == 0x80 and frame[4] == 0xCD:
+            if frame[6] == self._trans_id(inverter_index):
+                return 2
+        return 0
+
+    def __finish_poll_into(self, frame, inverter_index, reading):
+        '''
+        Decode poll response in frame buffer into reading, apply energy offsets
+        Returns None or error
+        '''
+        reading.inverter_index = inverter_index
+        reading.decode(frame, self.inv_data[inverter_index].panels)
+        if not reading.valid():
+            return 'data error'
+        self.energy.update(inverter_index, reading.energy, reading.energy)
+        self.store_energy(inverter_index)
+        return None
+
+    @_exclusive(PRIORITY_POLLING)
+    def poll_into(self, inverter_index, reading, timeout=2000):
+        '''
+        Low allocation poll_inverter for micropython (reader needs readinto)
+
+        Reads with readinto straight into the frame parser, frames are copied
+        into a preallocated buffer and decoded into reading (a PollReading
+        that is reused for every poll). Returns None when reading was
+        filled, else 'timeout', 'NoRoute' or 'data error'.
+        Allocation per poll is bounded, not zero: the call itself (port
+        ownership) and the float math of the energy update create a few
+        small objects, no buffers or dicts.
+        '''
+        if inverter_index > len(self.inv_data) -1:
+            raise Exception('Invalid inverter')
+        parser = self.__parser
+        frame = self.__frame
+        reader = self.reader
+        serial = self.system_type == 'python3-serial'
+        # Clear serial buffer, a noisy line never gets empty
+        for _ in range(8):
+            if not parser.fill(reader, reader.in_waiting if serial else reader.any()):
+                break
+            parser.reset()
+        parser.reset()
+        self.writer.write(self._poll_frame(inverter_index))
+        deadline = _deadline(timeout)
+        while True:
+            length = parser.next_frame(frame)
+            if length:
+                kind = self.__poll_frame_kind(frame, inverter_index, length)
+                if kind == 1:
+                    return self.__finish_poll_into(frame, inverter_index, reading)
+                if kind == 2:
+                    return 'NoRoute'
+            # Checked every round, noise or other frames may keep arriving
+            if _expired(deadline):
+                return 'timeout'
+            if length:
+                continue
+            if not parser.fill(reader, reader.in_waiting if serial else reader.any()):
+                time.sleep(0.005)
+
+    async def poll_into_async(self, inverter_index, reading, timeout=2000):
+        '''
+        poll_into for a uasyncio stream: ApsYc600(stream, stream) with
+        stream = uasyncio.StreamReader(uart), other tasks run while waiting
+
+        Does not own the port (see CommandQueue): do not run it at the same
+        time as other calls on this object, from threads or other tasks.
+        It has its own parser, so it does not disturb theirs. Besides
+        poll_into's allocations every read timeout (100 ms) allocates.
+        '''
+        try:
+            import uasyncio as asyncio
+        except ImportError:
+            import asyncio
+        if inverter_index > len(self.inv_data) -1:
+            raise Exception('Invalid inverter')
+        if self.__async_parser is None:
+            self.__async_parser = FrameParser()
+            self.__async_frame = bytearray(FRAME_MAX_DATA + 5)
+        parser = self.__async_parser
+        frame = self.__async_frame
+        # Stale frames are told apart by address / transaction ID
+        parser.reset()
+        self.writer.write(self._poll_frame(inverter_index))
+        await self.writer.drain()
+        deadline = _deadline(timeout)
+        while True:
+            length = parser.next_frame(frame)
+            if length:
+                kind = self.__poll_frame_kind(frame, inverter_index, length)
+                if kind == 1:
+                    return self.__finish_poll_into(frame, inverter_index, reading)
+                if kind == 2:
+                    return 'NoRoute'
+                continue
+            if _expired(deadline):
+                return 'timeout'
+            try:
+                parser.commit(await asyncio.wait_for(
+                    self.reader.readinto(parser.space()), 0.1))
+            except asyncio.TimeoutError:
+                pass
+
+    @_exclusive(PRIORITY_POLLING)
+    def poll_all(self, inverter_indexes=None, timeout=2000, max_in_flight=4, retries=0):
+        '''
+        Poll several inverters with up to max_in_flight requests outstanding.
+
+        Responses are matched to inverters by source address, NoRoute
+        replies by transaction ID. Returns dict of inverter index to the
+        result poll_inverter would give, timeout (ms) is per inverter.
+        Inverters with a timeout or NoRoute are queued again up to retries times.
+        Parser errors (CRC, length, skipped bytes) are labelled with the inverter
+        when max_in_flight is 1, in a pipelined sweep they cannot be attributed
+        and are counted unlabelled.
+        '''
+        if inverter_indexes is None:
+            inverter_indexes = range(len(self.inv_data))
+        pending = []
+        for inverter_index in inverter_indexes:
+            if inverter_index > len(self.inv_data) -1:
+                raise Exception('Invalid inverter')
+            pending.append(inverter_index)
+        pending.reverse()
+        results = {}
+        # inverter index -> deadline (ms)
+        in_flight = {}
+        # inverter index -> time request was sent (us), for metrics
+        sent = {}
+        # Route NoRoute responses: transaction ID -> inverter index
+        by_trans = {}
+        # Retries left per inverter
+        retries_left = {}
+        self.__drain()
+        while pending or in_flight:
+            # Keep the pipeline filled
+            while pending and len(in_flight) < max_in_flight:
+                # Inverters sharing a transaction ID (index % 255) are not in flight together
+                position = len(pending) - 1
+                while position >= 0 and self._trans_id(pending[position]) in by_trans:
+                    position -= 1
+                if position < 0:
+                    break
+                inverter_index = pending.pop(position)
+                by_trans[self._trans_id(inverter_index)] = inverter_index
+                self._count('polls', inverter_index)
+                sent[inverter_index] = _ticks_us()
+                self.__send_frame(self._poll_frame(inverter_index))
+                in_flight[inverter_index] = _ticks_ms() + timeout
+            label = ''
+            if max_in_flight == 1 and len(in_flight) == 1:
+                for inverter_index in in_flight:
+                    label = self._metric_label(inverter_index)
+            frames = self.__receive(label)
+            if frames is not None:
+                for frame in frames:
+                    if frame[2] != 0x44:
+                        continue
+                    if frame[3] == 0x81 and len(frame) >= 111:
+                        inverter_index = self.inv_data.index_by_addr(frame)
+                        if inverter_index in in_flight:
+                            self.__poll_done(inverter_index, in_flight, by_trans)
+                            response = self._decode(frame, inverter_index)
+                            if self.metrics is not None:
+                                self.metrics.observe(
+                                    'response', (_ticks_us() - sent[inverter_index]) / 1000000,
+                                    self._metric_label(inverter_index))
+                            error = self._check_poll_response(response)
+                            results[inverter_index] = response if error is None else error
+                    elif frame[3] == 0x80 and frame[4] == 0xCD:
+                        inverter_index = by_trans.get(frame[6])
+                        if inverter_index in in_flight:
+                            self.__poll_done(inverter_index, in_flight, by_trans)
+                            self._count('noroute', inverter_index)
+                            results[inverter_index] = {'error': 'NoRoute'}
+                            self.__poll_retry(inverter_index, retries, retries_left, pending)
+            # Expire every round, noise or other frames may keep arriving
+            now = _ticks_ms()
+            for inverter_index in list(in_flight):
+                if in_flight[inverter_index] <= now:
+                    self.__poll_done(inverter_index, in_flight, by_trans)
+                    self._count('timeouts', inverter_index)
+                    results[inverter_index] = {'error': 'timeout'}
+                    self.__poll_retry(inverter_index, retries, retries_left, pending)
+            if frames is None:
+                time.sleep(0.005)
+        # Energy offsets for the whole sweep at once
+        valid = [index for index in results if 'cmd' in results[index]]
+        self._apply_energy(valid, [results[index] for index in valid])
+        return results
+
+    def __poll_done(self, inverter_index, in_flight, by_trans):
+        '''
+        Request of inverter is answered or expired (poll_all)
+        '''
+        del in_flight[inverter_index]
+        del by_trans[self._trans_id(inverter_index)]
+
+    def __poll_retry(self, inverter_index, retries, retries_left, pending):
+        '''
+        Queue failed inverter again when it has retries left (poll_all)
+        '''
+        left = retries_left.get(inverter_index, retries)
+        if left <= 0:
+            return
+        retries_left[inverter_index] = left - 1
+        self._count('retries', inverter_index)
+        pending.insert(0, inverter_index)
+
+    @staticmethod
+    def _check_poll_response(response):
+        '''
+        Return error dict when decoded poll response is not usable, else None
+        '''
+        if not 'data' in response:
+            return {'error': 'incomplete'}
+        if not 'energy_panel1' in response['data']:
+            return {'error': 'incomplete', 'data': response}
+        if response['data']['voltage_dc1'] + response['data']['voltage_dc2'] < 0.1:
+            return {'error': 'data error', 'data': response}
+        return None
+
+    def _apply_energy(self, indexes, responses):
+        '''
+        Continue energy counters of checked poll responses using offsets
+        '''
+        energies = []
+        for inverter_index, response in zip(indexes, responses):
+            energies.append([
+                response['data']['energy_panel%d' % panel]
+                for panel in range(1, self.inv_data[inverter_index].panels + 1)])
+        continued = self.energy.update_many(indexes, energies)
+        for inverter_index, response, new_energy in zip(indexes, responses, continued):
+            for panel in range(len(new_energy)):
+                response['data']['energy_panel%d' % (panel + 1)] = new_energy[panel]
+            self.store_energy(inverter_index)
+
+    def _process_poll_response(self, inverter_index, response):
+        '''
+        Check decoded poll response and apply energy offsets
+        '''
+        error = self._check_poll_response(response)
+        if error is not None:
+            return error
+        self._apply_energy([inverter_index], [response])
+        return response
+
+    def command(self, priority=PRIORITY_DIAGNOSTICS, timeout=None):
+        '''
+        Command to own the serial port for several calls (they run inside it)
+        or to cancel a waiting call from another thread, see Command
+        '''
+        return Command(self.commands, priority, timeout)
+
+    @_exclusive(PRIORITY_DIAGNOSTICS)
+    def ping_radio(self, timeout=1000):
         '''
         Check if radio module is ok
         '''
-        self.__send_cmd('2101')
-        str_resp = self.__listen()
-        if str_resp is None:
-            print("Ping reply empty")
+        self.__send_frame(PING_FRAME)
+        response, cmd_output = self.__wait_for(
+            lambda frame: frame[2] == 0x61 and frame[3] == 0x01, timeout)
+        if response is None:
+            print("Ping reply empty", cmd_output)
             return False
-        cmd_output = self.__parse(str_resp)
-
-        for cmd in cmd_output:
-            if cmd['cmd'] == 'ZigbeePingResp' and cmd['crc'] and cmd['data'] == '7907':
-                return True
+        if response['data'] == '7907':
+            return True
         print("Ping failed", cmd_output)
         return False
 
-    def start_coordinator(self, pair_mode=False):
+    def _coordinator_frames(self, pair_mode):
         '''
-        Start coordinator proces in Zigbee radio.
-        Resets modem
+        Frames to start coordinator with their expected response prefixes
+        Built once per pair_mode
         '''
-        rev_controll_id = self.__reverse_byte_str(self.controller_id)
+        if pair_mode in self.__coordinator_frames:
+            return self.__coordinator_frames[pair_mode]
+        rev_controll_id = self.__controller_rev
         init_cmd = []
+        # Expected response prefix per command
         expect_response = []
         init_cmd.append('2605030103') # 20 ms
-        expect_response.append(['fe0166050062'])
+        expect_response.append('fe0166050062')
         init_cmd.append('410000') # 500 ms
-        expect_response.append(['fe064180020202020702c2'])
+        # SYS_RESET_IND, the rest (reason, versions) depends on the firmware
+        expect_response.append('fe06418002')
         init_cmd.append('26050108FFFF'+rev_controll_id) # 15 ms
-        expect_response.append(['fe0166050062'])
+        expect_response.append('fe0166050062')
         init_cmd.append('2605870100') # 10 ms
-        expect_response.append(['fe0166050062'])
+        expect_response.append('fe0166050062')
         init_cmd.append('26058302'+self.controller_id[:4]) # 20 ms
-        expect_response.append(['fe0166050062'])
+        expect_response.append('fe0166050062')
         init_cmd.append('2605840400000100') # 20 ms
-        expect_response.append(['fe0166050062'])
+        expect_response.append('fe0166050062')
         init_cmd.append('240014050F00010100020000150000') # 10 ms
-        expect_response.append(['fe0164000065'])
+        expect_response.append('fe0164000065')
         init_cmd.append('2600') # 1000 ms
-        expect_response.append(['fe00660066', 'fe0145c0088c']) # second is optional
+        expect_response.append('fe00660066')
         init_cmd.append('6700')
-        expect_response.append(['fe0e670000ffff'])
+        expect_response.append('fe0e670000ffff')
 
         if not pair_mode:
             init_cmd.append(''.join(
                 ('2401FFFF1414060001000F1E', rev_controll_id, 'FBFB11',
                  '00000D6030FBD3000000000000000004010281FEFE'))) # 20 ms
-            expect_response.append(
-                ['fe0164010064',
-                 'fe0145c0088c',
-                 'fe0145c0088c',
-                 'fe0145c0098d'])
-
-        all_verified = True
-        for cmd in init_cmd:
-            self.__send_cmd(cmd)
-            result_str = self.__listen(1100)
-            cmd_index = init_cmd.index(cmd)
-            try:
-                if not expect_response[cmd_index][0] in result_str:
-                    all_verified = False
-                    print('Verify failed', cmd, result_str)
-            finally:
-                pass
-            # Final commands need more time to process
-            if init_cmd.index(cmd) > 6:
-                time.sleep(1.5)
-        return all_verified
+            expect_response.append('fe0164010064')
+
+        init_frames = tuple(frame_from_hex(cmd) for cmd in init_cmd)
+        self.__coordinator_frames[pair_mode] = (init_frames, expect_response)
+        return init_frames, expect_response
+
+    def _coordinator_steps(self, pair_mode):
+        '''
+        Coordinator start steps: (name, frame, expected response prefix, timeout ms)
+        Built once per pair_mode
+        '''
+        if pair_mode in self.__coordinator_steps:
+            return self.__coordinator_steps[pair_mode]
+        init_frames, expect_response = self._coordinator_frames(pair_mode)
+        steps = tuple(
+            (COORDINATOR_STEPS[index][0], frame, unhexlify(expect_response[index]),
+             COORDINATOR_STEPS[index][1])
+            for index, frame in enumerate(init_frames))
+        self.__coordinator_steps[pair_mode] = steps
+        return steps
+
+    def _coordinator_running(self, data):
+        '''
+        True when device info (data of 6700 response, see check_coordinator)
+        shows a coordinator that runs (state 09) with our IEEE address
+        '''
+        return (data[:2] == '00' and data[24:26] == '09' and
+                data[2:18] == ('FFFF' + self.__controller_rev).upper())
+
+    @staticmethod
+    def _coordinator_step_result(name, ok, start_ms, data):
+        '''
+        Result of one coordinator start step
+        '''
+        return {'step': name, 'ok': ok, 'skipped': False,
+                'time_ms': _ticks_ms() - start_ms, 'data': data}
+
+    @staticmethod
+    def _coordinator_skipped(name):
+        '''
+        Result of a coordinator start step that was not needed
+        '''
+        return {'step': name, 'ok': True, 'skipped': True, 'time_ms': 0, 'data': []}
+
+    @_exclusive(PRIORITY_RECOVERY)
+    def start_coordinator_steps(self, pair_mode=False, fast=False):
+        '''
+        Start coordinator proces in Zigbee radio, returns list of step results:
+        {'step': name, 'ok': bool, 'skipped': bool, 'time_ms': duration, 'data': decoded frames}
 
-    def check_coordinator(self):
+        Every command is sent as soon as the previous one was answered.
+        By default the modem is reset and configured. With fast the
+        coordinator state is probed first (2700, step 'probe' is ok when it
+        already runs with our address), then all configuration is skipped
+        and only the announce (normal mode) is sent.
         '''
-        Send 2700 message to modem, show response
+        results = []
+        running = False
+        self.__drain()
+        if fast:
+            start_ms = _ticks_ms()
+            response, decoded = self.__wait_for_request(
+                DEVICE_INFO_FRAME, lambda frame: frame[2] == 0x67 and frame[3] == 0x00, 500)
+            running = response is not None and self._coordinator_running(response['data'])
+            results.append(self._coordinator_step_result('probe', running, start_ms, decoded))
+        for name, frame, expected, timeout in self._coordinator_steps(pair_mode):
+            if running and name != 'announce':
+                results.append(self._coordinator_skipped(name))
+                continue
+            start_ms = _ticks_ms()
+            response, decoded = self.__wait_for_request(
+                frame, lambda frame, expected=expected: frame[:len(expected)] == expected,
+                timeout)
+            if response is not None and name == 'zb_start':
+                # Network must be up before device info and announce
+                decoded.extend(self.__wait_for(
+                    lambda frame: frame == COORDINATOR_STARTED_FRAME,
+                    COORDINATOR_START_TIMEOUT)[1])
+            results.append(
+                self._coordinator_step_result(name, response is not None, start_ms, decoded))
+        return results
+
+    @_exclusive(PRIORITY_RECOVERY)
+    def start_coordinator(self, pair_mode=False, fast=False):
+        '''
+        Start coordinator proces in Zigbee radio.
+        Resets modem unless fast and the coordinator already runs.
+        Returns True when all steps succeeded, see start_coordinator_steps for details
+        '''
+        results = self.start_coordinator_steps(pair_mode, fast)
+        return all(result['ok'] for result in results if result['step'] != 'probe')
+
+    @_exclusive(PRIORITY_DIAGNOSTICS)
+    def check_coordinator(self, timeout=500):
+        '''
+        Send 2700 message to modem, show and return response data
         Result should contain 0709 (??)
         '''
-        self.clear_buffer()
-        self.__send_cmd('2700')
-        print('check_coord', self.__listen(500))
+        self.__drain()
+        self.__send_frame(DEVICE_INFO_FRAME)
+        response = self.__wait_for(
+            lambda frame: frame[2] == 0x67 and frame[3] == 0x00, timeout)[0]
+        if response is None:
+            print('check_coord', 'no response')
+            return None
+        print('check_coord', response['data'])
+        return response['data']
 
+    @_exclusive(PRIORITY_DIAGNOSTICS)
     def clear_buffer(self):
         '''
         Return serial buffer after waiting 100 msec
+        Partial frames in the parser are dropped too
         '''
-        return self.__listen(100)
+        buffer = self.__listen(100)
+        self.__parser.reset()
+        return hexlify(buffer).decode()
 
-    def pair_inverter(self, inverter_index):
+    def _pair_frames(self, inverter_index):
         '''
-        Pair with inverter at index inv_index
+        Frames to pair inverter, built once per inverter
         '''
-        if inverter_index > len(self.inv_data) -1:
-            raise Exception('Invalid inverter')
-        self.start_coordinator(True)
+        inverter = self.inv_data[inverter_index]
+        if inverter.pair_frames is not None:
+            return inverter.pair_frames
         init_cmd = []
-        inverter_serial = self.inv_data[inverter_index]['serial']
+        inverter_serial = self.inv_data[inverter_index].serial
         pair_cmd = ''.join(
             ("24020FFFFFFFFFFFFFFFFF14FFFF140D0200000F1100",
              inverter_serial, "FFFF10FFFF",
-             self.__reverse_byte_str(self.controller_id)))
+             self.__controller_rev))
         init_cmd.append(pair_cmd)
         pair_cmd = ''.join(
             ("24020FFFFFFFFFFFFFFFFF14FFFF140C0201000F0600",
@@ -545,32 +1872,53 @@ class ApsYc600:
         pair_cmd = ''.join(
             ("24020FFFFFFFFFFFFFFFFF14FFFF140F0102000F1100",
              inverter_serial,
-             self.__reverse_byte_str(self.controller_id)[-4:],
-             "10FFFF", self.__reverse_byte_str(self.controller_id)))
+             self.__controller_rev[-4:],
+             "10FFFF", self.__controller_rev))
         init_cmd.append(pair_cmd)
         pair_cmd = ''.join(
             ("24020FFFFFFFFFFFFFFFFF14FFFF14010103000F0600",
-             self.__reverse_byte_str(self.controller_id)))
+             self.__controller_rev))
         init_cmd.append(pair_cmd)
 
+        inverter.pair_frames = tuple(frame_from_hex(cmd) for cmd in init_cmd)
+        return inverter.pair_frames
+
+    def _pair_result(self, inverter_index, result):
+        '''
+        Find inverter ID in decoded responses to pair commands
+        Returns inverter ID or False
+        '''
+        inverter_serial = self.inv_data[inverter_index].serial
+        for result_obj in result:
+            if inverter_serial in result_obj['data']:
+                inv_id_start = 12 + result_obj['data'].index(inverter_serial)
+                inv_id = result_obj['data'][inv_id_start:inv_id_start+4]
+                if inv_id not in (
+                        '0000', 'FFFF',
+                        self.__controller_rev[-4:]):
+
+                    found = inv_id[2:]+inv_id[:2]
+                    print('Inverter ID Found', found)
+                    return found
+        return False
+
+    @_exclusive(PRIORITY_PAIRING)
+    def pair_inverter(self, inverter_index):
+        '''
+        Pair with inverter at index inv_index
+        '''
+        if inverter_index > len(self.inv_data) -1:
+            raise Exception('Invalid inverter')
+        # Pairing always resets the modem into pair mode
+        self.start_coordinator(True)
         found = False
-        for cmd in init_cmd:
-            self.__send_cmd(cmd)
-            result_str = self.__listen(1100)
+        for frame in self._pair_frames(inverter_index):
+            self.__send_frame(frame)
+            result_bytes = self.__listen(1100)
             # no check in place to verify responses from pair commands
             time.sleep(1.5)
-            result = self.__parse(result_str)
-
-            for result_obj in result:
-                if inverter_serial in result_obj['data']:
-                    inv_id_start = 12 + result_obj['data'].index(inverter_serial)
-                    inv_id = result_obj['data'][inv_id_start:inv_id_start+4]
-                    if inv_id not in (
-                            '0000', 'FFFF',
-                            self.__reverse_byte_str(self.controller_id)[-4:]):
-
-                        found = inv_id[2:]+inv_id[:2]
-                        print('Inverter ID Found', found)
-                        return found
+            found = self._pair_result(inverter_index, self.__parse(result_bytes))
+            if found:
+                return found
 
         return found
@@ -0,0 +1,300 @@
+'''
+asyncio front-end for the YC600 library
+
+Uses an asyncio StreamReader / StreamWriter pair (for example from
+serial_asyncio.open_serial_connection or asyncio.open_connection).
+A background task reads the stream and hands every frame to the
+request waiting for it, so one event loop can drive several
+coordinators without a thread per device.
+
+    reader, writer = await serial_asyncio.open_serial_connection(
+        url='/dev/ttyS0', baudrate=115200)
+    inverter = AsyncApsYc600(reader, writer)
+    inverter.add_inverter('123456789012', '9988', 2)
+    await inverter.start()
+    print(await inverter.start_coordinator())
+    print(await inverter.poll_inverter(0))
+'''
+import asyncio
+from aps_yc600 import (
+    ApsYc600, FrameParser, PING_FRAME, DEVICE_INFO_FRAME, COORDINATOR_STARTED_FRAME,
+    COORDINATOR_START_TIMEOUT, _ticks_ms, _ticks_us)
+
+
+class AsyncApsYc600(ApsYc600):
+    '''
+    Class to communicate with YC600 inverters using asyncio
+    '''
+
+    system_type = 'asyncio'
+
+    def __init__(self, reader, writer, controller_id='D8A3011B9780', energy_store=None,
+                 metrics=None):
+        '''
+        Create controller on asyncio streams, default controller ID is supplied
+        '''
+        super().__init__(reader, writer, controller_id, energy_store, metrics)
+        self._frames = FrameParser()
+        # Pending requests: [match function, future, metrics label]
+        self._waiters = []
+        self._reader_task = None
+
+    async def start(self):
+        '''
+        Start background reader task
+        '''
+        if self._reader_task is None:
+            self._reader_task = asyncio.ensure_future(self._read_loop())
+
+    async def close(self):
+        '''
+        Stop reader task and close transport
+        '''
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        self.writer.close()
+
+    async def _read_loop(self):
+        '''
+        Read stream and dispatch frames to waiting requests
+        '''
+        try:
+            while True:
+                chunk = await self.reader.read(256)
+                if not chunk:
+                    break
+                if self.metrics is None:
+                    for frame in self._frames.parse(chunk):
+                        self._dispatch(frame)
+                    continue
+                errors = (self._frames.crc_errors, self._frames.length_errors,
+                          self._frames.skipped_bytes)
+                start = _ticks_us()
+                frames = list(self._frames.parse(chunk))
+                self.metrics.observe('parse', (_ticks_us() - start) / 1000000)
+                # Errors only belong to an inverter when its request is the only one
+                # outstanding, with several requests (poll_all) they stay unlabelled
+                label = self._waiters[0][2] if len(self._waiters) == 1 else ''
+                for name, before, now in zip(
+                        ('crc_errors', 'length_errors', 'skipped_bytes'), errors,
+                        (self._frames.crc_errors, self._frames.length_errors,
+                         self._frames.skipped_bytes)):
+                    if now > before:
+                        self.metrics.inc(name, label, now - before)
+                for frame in frames:
+                    self._dispatch(frame)
+        finally:
+            # Transport closed, nobody will answer anymore
+            for waiter in self._waiters:
+                if not waiter[1].done():
+                    waiter[1].set_exception(Exception('Connection closed'))
+            self._waiters = []
+
+    def _dispatch(self, frame):
+        '''
+        Hand frame to first request waiting for it, other frames are dropped
+        '''
+        for waiter in self._waiters:
+            if not waiter[1].done() and waiter[0](frame):
+                waiter[1].set_result(frame)
+                self._waiters.remove(waiter)
+                return
+
+    def _expect(self, match, label=''):
+        '''
+        Register waiter for frame matching match(frame), see _receive
+        label is used for parser errors while it is the only waiter
+        '''
+        waiter = [match, asyncio.get_running_loop().create_future(), label]
+        self._waiters.append(waiter)
+        return waiter
+
+    async def _receive(self, waiter, timeout=1000):
+        '''
+        Wait for frame of waiter (from _expect)
+        Returns the frame or None after timeout (ms)
+        '''
+        try:
+            return await asyncio.wait_for(waiter[1], timeout / 1000)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    async def _request(self, request, match, timeout=1000, label=''):
+        '''
+        Send request frame and wait for frame matching match(frame)
+        Returns the frame or None after timeout (ms)
+        '''
+        if self._reader_task is None:
+            await self.start()
+        # Register before sending, the answer may be quick
+        waiter = self._expect(match, label)
+        try:
+            start = _ticks_us()
+            self.writer.write(request)
+            await self.writer.drain()
+            if self.metrics is not None:
+                self.metrics.observe('send', (_ticks_us() - start) / 1000000)
+        except Exception:
+            self._waiters.remove(waiter)
+            raise
+        return await self._receive(waiter, timeout)
+
+    async def ping_radio(self, timeout=1000):
+        '''
+        Check if radio module is ok
+        '''
+        frame = await self._request(
+            PING_FRAME, lambda frame: frame[2] == 0x61 and frame[3] == 0x01, timeout)
+        if frame is None:
+            print("Ping reply empty")
+            return False
+        response = self._decode(frame, -1)
+        if response['data'] == '7907':
+            return True
+        print("Ping failed", response)
+        return False
+
+    async def poll_inverter(self, inverter_index, timeout=2000, retries=0):
+        '''
+        Get values from inverter, see ApsYc600.poll_inverter
+        '''
+        if inverter_index > len(self.inv_data) -1:
+            raise Exception('Invalid inverter')
+        while True:
+            result = await self._poll_once(inverter_index, timeout)
+            if retries <= 0 or result.get('error') not in ('timeout', 'NoRoute'):
+                return result
+            retries -= 1
+            self._count('retries', inverter_index)
+
+    async def _poll_once(self, inverter_index, timeout):
+        '''
+        Single poll request, see poll_inverter
+        '''
+        self._count('polls', inverter_index)
+        start = _ticks_us()
+        frame = await self._request(
+            self._poll_frame(inverter_index), self._poll_answer(inverter_index), timeout,
+            self._metric_label(inverter_index))
+        if frame is None:
+            self._count('timeouts', inverter_index)
+            return {'error': 'timeout'}
+        response = self._decode(frame, inverter_index)
+        if response['cmd'] == '4480':
+            self._count('noroute', inverter_index)
+            return {'error': 'NoRoute'}
+        if self.metrics is not None:
+            self.metrics.observe('response', (_ticks_us() - start) / 1000000,
+                                 self._metric_label(inverter_index))
+        return self._process_poll_response(inverter_index, response)
+
+    async def poll_all(self, inverter_indexes=None, timeout=2000, max_in_flight=4, retries=0):
+        '''
+        Poll several inverters with up to max_in_flight requests outstanding
+        Returns dict of inverter index to poll result
+        Parser errors (CRC, length, skipped bytes) received while several
+        requests are outstanding cannot be attributed and are counted unlabelled.
+        '''
+        if inverter_indexes is None:
+            inverter_indexes = range(len(self.inv_data))
+        inverter_indexes = list(inverter_indexes)
+        in_flight = asyncio.Semaphore(max_in_flight)
+
+        async def poll(inverter_index):
+            async with in_flight:
+                return await self.poll_inverter(inverter_index, timeout, retries)
+
+        results = await asyncio.gather(*[poll(index) for index in inverter_indexes])
+        return dict(zip(inverter_indexes, results))
+
+    async def start_coordinator_steps(self, pair_mode=False, fast=False):
+        '''
+        Start coordinator proces in Zigbee radio, see ApsYc600.start_coordinator_steps
+        Step data only holds the expected responses.
+        '''
+        results = []
+        running = False
+        if fast:
+            start_ms = _ticks_ms()
+            frame = await self._request(
+                DEVICE_INFO_FRAME, lambda frame: frame[2] == 0x67 and frame[3] == 0x00, 500)
+            decoded = [] if frame is None else [self._decode(frame, -1)]
+            running = frame is not None and self._coordinator_running(decoded[0]['data'])
+            results.append(self._coordinator_step_result('probe', running, start_ms, decoded))
+        for name, request, expected, timeout in self._coordinator_steps(pair_mode):
+            if running and name != 'announce':
+                results.append(self._coordinator_skipped(name))
+                continue
+            start_ms = _ticks_ms()
+            started = None
+            if name == 'zb_start':
+                # May arrive right behind the response
+                started = self._expect(lambda frame: frame == COORDINATOR_STARTED_FRAME)
+            frame = await self._request(
+                request, lambda frame, expected=expected: frame[:len(expected)] == expected,
+                timeout)
+            decoded = [] if frame is None else [self._decode(frame, -1)]
+            if started is not None:
+                if frame is None:
+                    self._waiters.remove(started)
+                else:
+                    # Network must be up before device info and announce
+                    state = await self._receive(started, COORDINATOR_START_TIMEOUT)
+                    if state is not None:
+                        decoded.append(self._decode(state, -1))
+            results.append(
+                self._coordinator_step_result(name, frame is not None, start_ms, decoded))
+        return results
+
+    async def start_coordinator(self, pair_mode=False, fast=False):
+        '''
+        Start coordinator proces in Zigbee radio, see ApsYc600.start_coordinator
+        '''
+        results = await self.start_coordinator_steps(pair_mode, fast)
+        return all(result['ok'] for result in results if result['step'] != 'probe')
+
+    async def check_coordinator(self, timeout=500):
+        '''
+        Send 2700 message to modem, return response data
+        '''
+        frame = await self._request(
+            DEVICE_INFO_FRAME, lambda frame: frame[2] == 0x67 and frame[3] == 0x00, timeout)
+        if frame is None:
+            return None
+        return self._decode(frame, -1)['data']
+
+    async def clear_buffer(self):
+        '''
+        Drop partial frames, the reader task already consumes the serial buffer
+        '''
+        self._frames.reset()
+        return ''
+
+    async def pair_inverter(self, inverter_index):
+        '''
+        Pair with inverter at index inv_index
+        '''
+        if inverter_index > len(self.inv_data) -1:
+            raise Exception('Invalid inverter')
+        # Pairing always resets the modem into pair mode
+        await self.start_coordinator(True)
+        serial = self.inv_data[inverter_index].serial_bytes
+        found = False
+        for request in self._pair_frames(inverter_index):
+            frame = await self._request(
+                request,
+                lambda frame: frame[2] == 0x44 and frame[3] == 0x81 and serial in frame,
+                2600)
+            if frame is not None:
+                found = self._pair_result(inverter_index, [self._decode(frame, -1)])
+                if found:
+                    return found
+        return found
@@ -0,0 +1,207 @@
+'''
+Benchmarks for the frame, decode and poll hot paths of ApsYc600
+
+Runs against an in-memory transport and prints JSON results, e.g.
+    python3 bench.py > bench_output.txt
+    python3 bench.py --quick
+'''
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from array import array
+
+import aps_yc600
+from aps_yc600 import ApsYc600, build_frame, frame_from_hex
+from aps_emulator import VirtualInverter
+
+
+class LoopbackSerial:
+    '''
+    python3-serial like transport answering poll requests immediately
+    '''
+
+    def __init__(self):
+        self.rx = bytearray()
+        self.responses = {}
+
+    @property
+    def in_waiting(self):
+        return len(self.rx)
+
+    def read(self, size=1):
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        return data
+
+    def write(self, data):
+        self.rx.extend(self.responses.get(bytes(data), b''))
+        return len(data)
+
+
+class NullWriter:
+    '''
+    Writer dropping all data
+    '''
+
+    @staticmethod
+    def write(data):
+        return len(data)
+
+
+def setup(num_panels=2, count=1):
+    '''
+    ApsYc600 on loopback transport with count inverters that answer polls
+    '''
+    port = LoopbackSerial()
+    inverter = ApsYc600(port, port)
+    virtual = []
+    for number in range(count):
+        inv_id = '%04X' % (number + 1)
+        index = inverter.add_inverter('4080%08d' % number, inv_id, num_panels)
+        virtual.append(VirtualInverter('4080%08d' % number, inv_id, num_panels, watts=120.0))
+        port.responses[inverter._poll_frame(index)] = virtual[-1].poll_response()
+    return inverter, port, virtual
+
+
+def rate(func, iterations):
+    '''
+    Calls per second of func
+    '''
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return iterations / (time.perf_counter() - started)
+
+
+def percentiles(samples):
+    '''
+    Latency summary in ms
+    '''
+    samples = sorted(samples)
+
+    def pick(fraction):
+        return round(samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000, 4)
+
+    return {'p50_ms': pick(0.5), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99),
+            'max_ms': round(samples[-1] * 1000, 4)}
+
+
+def bench_frames(iterations):
+    '''
+    Frame build and send throughput
+    '''
+    inverter, _, _ = setup()
+    inverter.writer = NullWriter()
+    poll_cmd = frame_from_hex('2101')[2:-1]
+    send = inverter._ApsYc600__send_frame
+    poll_frame = inverter._poll_frame(0)
+    return {
+        'build_frames_per_s': round(rate(lambda: build_frame(poll_cmd), iterations)),
+        'send_frames_per_s': round(rate(lambda: send(poll_frame), iterations))}
+
+
+def bench_parse(iterations):
+    '''
+    Parse throughput of a buffer with many concatenated frames
+    '''
+    inverter, _, virtual = setup(count=20)
+    buffer = b''.join(inv.poll_response() + frame_from_hex('448000141E') for inv in virtual)
+    frames = 2 * len(virtual)
+    parse = inverter._ApsYc600__parse
+    per_s = rate(lambda: parse(buffer), iterations)
+    return {
+        'buffer_bytes': len(buffer),
+        'frames_per_buffer': frames,
+        'frames_per_s': round(per_s * frames),
+        'bytes_per_s': round(per_s * len(buffer))}
+
+
+def bench_decode(iterations):
+    '''
+    Decode throughput for 2 and 4 panel poll responses
+    '''
+    result = {}
+    for num_panels in (2, 4):
+        inverter, _, virtual = setup(num_panels)
+        frame = virtual[0].poll_response()
+        result['decode_%d_panels_per_s' % num_panels] = round(
+            rate(lambda: inverter._decode(frame, 0), iterations))
+    return result
+
+
+def bench_poll(iterations):
+    '''
+    End-to-end poll_inverter latency and allocations, sleeps mocked out
+    '''
+    inverter, _, _ = setup()
+    real_sleep = aps_yc600.time.sleep
+    aps_yc600.time.sleep = lambda seconds: None
+    try:
+        samples = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            if 'error' in inverter.poll_inverter(0):
+                raise Exception('Poll failed in benchmark')
+            samples.append(time.perf_counter() - started)
+        result = percentiles(samples)
+
+        # Allocations: warm up, then measure peak and retained memory per poll
+        inverter.poll_inverter(0)
+        # Preallocated so the measurement itself does not count as retained
+        peaks = array('q', bytes(8 * min(iterations, 200)))
+        library = [tracemalloc.Filter(True, aps_yc600.__file__)]
+        tracemalloc.start()
+        baseline = tracemalloc.take_snapshot().filter_traces(library)
+        for poll in range(len(peaks)):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            inverter.poll_inverter(0)
+            peaks[poll] = tracemalloc.get_traced_memory()[1] - before
+        # Only memory still held by the library counts
+        retained = sum(
+            stat.size_diff for stat in
+            tracemalloc.take_snapshot().filter_traces(library).compare_to(baseline, 'filename'))
+        tracemalloc.stop()
+        result['peak_bytes_per_poll'] = max(peaks)
+        result['retained_bytes_per_poll'] = round(retained / len(peaks), 1)
+    finally:
+        aps_yc600.time.sleep = real_sleep
+    return result
+
+
+def main():
+    '''
+    Run all benchmarks and print JSON
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='fewer iterations')
+    parser.add_argument('--output', help='write JSON to file instead of stdout')
+    args = parser.parse_args()
+    scale = 10 if args.quick else 1
+
+    # Keep the library from printing during the run
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        results = {
+            'python': platform.python_implementation() + ' ' + platform.python_version(),
+            'time': int(time.time()),
+            'frames': bench_frames(50000 // scale),
+            'parse': bench_parse(2000 // scale),
+            'decode': bench_decode(20000 // scale),
+            'poll': bench_poll(5000 // scale)}
+    finally:
+        sys.stdout = stdout
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+'''
+AsyncApsYc600 against the emulator over a socket pair
+'''
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aps_emulator import Cc2530Emulator  # noqa: E402
+from aps_yc600_async import AsyncApsYc600  # noqa: E402
+
+
+def run(emulator, test):
+    '''
+    Run coroutine test(api) with an AsyncApsYc600 connected to emulator
+    '''
+    async def main():
+        port = emulator.open_socket()
+        reader, writer = await asyncio.open_connection(sock=port.sock)
+        api = AsyncApsYc600(reader, writer)
+        for inverter in emulator.inverters:
+            api.add_inverter(inverter.serial, inverter.inv_id, inverter.panels)
+        await api.start()
+        try:
+            return await test(api)
+        finally:
+            await api.close()
+
+    try:
+        return asyncio.run(main())
+    finally:
+        emulator.stop()
+
+
+def test_out_of_order_replies_reach_their_request():
+    emulator = Cc2530Emulator(seed=1)
+    # The first request is answered last
+    emulator.add_inverter('408000000001', '0001', voltage_ac=220.0, latency=(0.3, 0.3))
+    emulator.add_inverter('408000000002', '0002', voltage_ac=240.0, latency=(0.02, 0.02))
+
+    async def test(api):
+        return await asyncio.gather(api.poll_inverter(0), api.poll_inverter(1), api.ping_radio())
+
+    first, second, ping = run(emulator, test)
+    assert ping is True
+    assert abs(first['data']['voltage_ac'] - 220.0) < 1
+    assert abs(second['data']['voltage_ac'] - 240.0) < 1
+
+
+def test_timeout_removes_waiter():
+    emulator = Cc2530Emulator(seed=1)
+    emulator.add_inverter('408000000001', '0001', loss=1.0)
+
+    async def test(api):
+        result = await api.poll_inverter(0, timeout=200)
+        return result, list(api._waiters)
+
+    result, waiters = run(emulator, test)
+    assert result == {'error': 'timeout'}
+    assert waiters == []
+
+
+def test_noroute():
+    emulator = Cc2530Emulator(seed=1)
+    emulator.add_inverter('408000000001', '0001', noroute=1.0)
+
+    async def test(api):
+        return await api.poll_inverter(0, timeout=500)
+
+    assert run(emulator, test) == {'error': 'NoRoute'}
+
+
+def test_poll_all_keeps_requests_in_flight():
+    emulator = Cc2530Emulator(seed=1, latency=(0.3, 0.3))
+    for number in range(4):
+        emulator.add_inverter('4080%08d' % number, '%04X' % (number + 1))
+
+    async def test(api):
+        start = time.time()
+        results = await api.poll_all(max_in_flight=4, timeout=2000)
+        return results, time.time() - start
+
+    results, duration = run(emulator, test)
+    assert sorted(results) == [0, 1, 2, 3]
+    assert all(result['cmd'] == 'AF_INCOMING_MSG' for result in results.values())
+    # One after the other would take 1.2 s
+    assert duration < 0.9
@@ -0,0 +1,115 @@
+'''
+ApsYc600 protocol scenarios against the emulated CC2530 (socket pair)
+'''
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aps_emulator import Cc2530Emulator  # noqa: E402
+from aps_yc600 import ApsYc600  # noqa: E402
+
+
+@pytest.fixture
+def emulator():
+    emulator = Cc2530Emulator(seed=1, latency=(0.01, 0.02))
+    yield emulator
+    emulator.stop()
+
+
+def connect(emulator, inv_ids=None):
+    '''
+    ApsYc600 on the emulator with its inverters registered
+    '''
+    port = emulator.open_socket()
+    api = ApsYc600(port, port)
+    for number, inverter in enumerate(emulator.inverters):
+        inv_id = inverter.inv_id if inv_ids is None else inv_ids[number]
+        api.add_inverter(inverter.serial, inv_id, inverter.panels)
+    return api
+
+
+def test_ping(emulator):
+    assert connect(emulator).ping_radio() is True
+
+
+def test_coordinator_startup(emulator):
+    emulator.started = False
+    api = connect(emulator)
+    steps = api.start_coordinator_steps()
+    assert [step['step'] for step in steps] == [
+        'startup_option', 'reset', 'ieee_address', 'logical_type', 'pan_id', 'channels',
+        'af_register', 'zb_start', 'device_info', 'announce']
+    assert all(step['ok'] and not step['skipped'] for step in steps)
+    assert emulator.started
+    # Device info (6700) reports the started coordinator
+    assert api.check_coordinator().endswith('070900')
+
+
+def test_coordinator_already_running_is_probed(emulator):
+    api = connect(emulator)
+    steps = api.start_coordinator_steps(fast=True)
+    assert steps[0]['step'] == 'probe' and steps[0]['ok']
+    assert [step['step'] for step in steps if not step['skipped']] == ['probe', 'announce']
+
+
+def test_pairing(emulator):
+    emulator.add_inverter('408000123456', '9988')
+    api = connect(emulator, inv_ids=['0000'])
+    assert api.pair_inverter(0) == '9988'
+
+
+def test_poll_decodes_values(emulator):
+    emulator.add_inverter('408000000001', '0001', watts=70.0, voltage_dc=35.0,
+                          voltage_ac=230.0, freq_ac=50.0, temperature=30.0)
+    result = connect(emulator).poll_inverter(0)
+    data = result['data']
+    assert result['cmd'] == 'AF_INCOMING_MSG'
+    assert abs(data['temperature'] - 30.0) < 0.5
+    assert abs(data['freq_ac'] - 50.0) < 0.1
+    assert abs(data['voltage_ac'] - 230.0) < 1
+    for panel in (1, 2):
+        assert abs(data['voltage_dc%d' % panel] - 35.0) < 0.1
+        assert abs(data['current_dc%d' % panel] - 2.0) < 0.05
+        assert abs(data['watt_panel%d' % panel] - 70.0) < 2
+
+
+def test_poll_qs1_has_four_panels(emulator):
+    emulator.add_inverter('408000000001', '0001', num_panels=4, watts=70.0, voltage_dc=35.0)
+    data = connect(emulator).poll_inverter(0)['data']
+    # Panel 4 shares its bytes with the AC frequency, see PANEL_OFFSETS
+    for panel in (1, 2, 3, 4):
+        assert abs(data['voltage_dc%d' % panel] - 35.0) < 0.1
+        assert abs(data['watt_panel%d' % panel] - 70.0) < 2
+
+
+def test_noroute(emulator):
+    emulator.add_inverter('408000000001', '0001', noroute=1.0)
+    assert connect(emulator).poll_inverter(0) == {'error': 'NoRoute'}
+
+
+def test_lost_poll_times_out(emulator):
+    emulator.add_inverter('408000000001', '0001', loss=1.0)
+    assert connect(emulator).poll_inverter(0, timeout=300)['error'] == 'timeout'
+
+
+def test_energy_continues_over_inverter_restart(emulator):
+    # 36 kW: 10 Wh per second per panel
+    inverter = emulator.add_inverter('408000000001', '0001', watts=36000.0, voltage_dc=60.0)
+    api = connect(emulator)
+    api.poll_inverter(0)
+    time.sleep(0.3)
+    before = api.poll_inverter(0)['data']['energy_panel1']
+    assert before > 0
+    inverter.reset = 1.0
+    time.sleep(0.3)
+    after = api.poll_inverter(0)['data']['energy_panel1']
+    assert inverter.resets == 1
+    assert after >= before
+    # A new day starts at 0
+    inverter.reset = 0.0
+    api.reset_counters(0)
+    assert api.poll_inverter(0)['data']['energy_panel1'] < before
@@ -0,0 +1,114 @@
+'''
+FrameParser: reassembly, resync and statistics
+'''
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aps_yc600 import FrameParser, FRAME_MAX_DATA, build_frame  # noqa: E402
+
+PING_REPLY = bytes(build_frame(bytes.fromhex('61017907')))
+STARTED = bytes(build_frame(bytes.fromhex('45C009')))
+LONG = bytes(build_frame(bytes.fromhex('4481') + bytes(range(120))))
+FRAMES = [PING_REPLY, STARTED, LONG]
+
+
+class ChunkReader:
+    '''
+    readinto() source handing out data in fixed chunks
+    '''
+
+    def __init__(self, data, chunk):
+        self.data = data
+        self.chunk = chunk
+
+    def readinto(self, buffer):
+        count = min(len(buffer), self.chunk, len(self.data))
+        buffer[:count] = self.data[:count]
+        self.data = self.data[count:]
+        return count
+
+
+def parse_chunks(data, chunk):
+    parser = FrameParser()
+    found = []
+    for pos in range(0, len(data), chunk):
+        found.extend(parser.parse(data[pos:pos + chunk]))
+    return parser, found
+
+
+def next_frames(data, chunk):
+    parser = FrameParser()
+    reader = ChunkReader(data, chunk)
+    out = bytearray(FRAME_MAX_DATA + 5)
+    found = []
+    while True:
+        length = parser.next_frame(out)
+        if length:
+            found.append(bytes(out[:length]))
+        elif not parser.fill(reader):
+            return parser, found
+
+
+@pytest.mark.parametrize('collect', [parse_chunks, next_frames])
+@pytest.mark.parametrize('chunk', [1, 2, 3, 7, 64, 1000])
+def test_split_and_combined_reads(collect, chunk):
+    data = b''.join(FRAMES * 3)
+    parser, found = collect(data, chunk)
+    assert found == FRAMES * 3
+    assert (parser.crc_errors, parser.length_errors, parser.skipped_bytes) == (0, 0, 0)
+
+
+@pytest.mark.parametrize('collect', [parse_chunks, next_frames])
+def test_garbage_before_sof(collect):
+    parser, found = collect(b'\x00\x11\x22' + PING_REPLY + b'\x33' + STARTED, 1000)
+    assert found == [PING_REPLY, STARTED]
+    assert parser.skipped_bytes == 4
+
+
+@pytest.mark.parametrize('collect', [parse_chunks, next_frames])
+def test_bad_fcs(collect):
+    corrupt = PING_REPLY[:-1] + bytes((PING_REPLY[-1] ^ 0xFF,))
+    parser, found = collect(corrupt + STARTED, 1000)
+    assert found == [STARTED]
+    assert parser.crc_errors == 1
+
+
+@pytest.mark.parametrize('collect', [parse_chunks, next_frames])
+def test_bad_length(collect):
+    parser, found = collect(b'\xfe\xfb\x00\x00\x00' + PING_REPLY, 1000)
+    assert found == [PING_REPLY]
+    assert parser.length_errors == 1
+
+
+@pytest.mark.parametrize('collect', [parse_chunks, next_frames])
+def test_stray_sof_does_not_hide_frame(collect):
+    # FE with a length the buffered data cannot fill
+    parser, found = collect(b'\xfe\xf0' + PING_REPLY, 1000)
+    assert found == [PING_REPLY]
+    assert parser.skipped_bytes == 2
+
+
+def test_incomplete_frame_waits_for_rest():
+    parser = FrameParser()
+    assert list(parser.parse(LONG[:50])) == []
+    assert list(parser.parse(LONG[50:])) == [LONG]
+
+
+@pytest.mark.parametrize('collect', [parse_chunks, next_frames])
+def test_ring_buffer_wraps(collect):
+    # Frames of 126 bytes do not divide the 512 byte ring, so they wrap around
+    data = LONG * 20
+    parser, found = collect(data, 100)
+    assert found == [LONG] * 20
+    assert parser.start != 0
+
+
+def test_feed_overflow_drops_oldest():
+    parser = FrameParser(size=260)
+    parser.feed(b'\x00' * 300)
+    assert parser.count == 260
+    assert parser.skipped_bytes == 40
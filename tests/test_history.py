@@ -0,0 +1,43 @@
+'''
+History: ring records and save / load
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aps_history import History  # noqa: E402
+
+
+def test_inverter_index_above_255(tmp_path):
+    history = History(budget=4096)
+    history.add(300, {'watt_panel1': 12.5}, timestamp=1000)
+    path = str(tmp_path / 'history.bin')
+    history.save(path)
+    loaded = History(budget=4096)
+    assert loaded.load(path) is True
+    records = loaded.query(inverter_index=300)
+    assert [(record[0], record[1]) for record in records] == [(1000, 300)]
+    assert records[0][2][loaded.fields.index('watt_panel1')] == 12.5
+
+
+def test_short_file_is_rejected(tmp_path):
+    history = History(budget=4096)
+    for second in range(10):
+        history.add(0, {'watt_panel1': 1.0}, timestamp=1000 + second)
+    path = str(tmp_path / 'history.bin')
+    history.save(path)
+    with open(path, 'rb') as history_file:
+        data = history_file.read()
+    with open(path, 'wb') as history_file:
+        history_file.write(data[:-10])
+    loaded = History(budget=4096)
+    loaded.add(1, {'watt_panel1': 2.0}, timestamp=900)
+    assert loaded.load(path) is False
+    assert loaded.query() == []
+
+
+def test_other_budget_is_rejected(tmp_path):
+    path = str(tmp_path / 'history.bin')
+    History(budget=4096).save(path)
+    assert History(budget=8192).load(path) is False
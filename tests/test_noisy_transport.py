@@ -0,0 +1,153 @@
+'''
+Timeouts must hold on a serial port that never goes idle
+(line noise or a steady stream of frames for someone else)
+'''
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aps_metrics import Metrics  # noqa: E402
+from aps_yc600 import ApsYc600, PollReading, COORDINATOR_STARTED_FRAME  # noqa: E402
+from aps_yc600_async import AsyncApsYc600  # noqa: E402
+
+NOISE = b'\x00' * 8
+
+
+class NoisySerial:
+    '''
+    python3-serial like port that always has chunk waiting
+    '''
+
+    def __init__(self, chunk=NOISE):
+        self.chunk = chunk
+
+    @property
+    def in_waiting(self):
+        return len(self.chunk)
+
+    def read(self, size=None):
+        return self.chunk
+
+    def readinto(self, buffer):
+        count = min(len(buffer), len(self.chunk))
+        buffer[:count] = self.chunk[:count]
+        return count
+
+    def write(self, data):
+        return len(data)
+
+
+def make_api(chunk=NOISE):
+    port = NoisySerial(chunk)
+    api = ApsYc600(port, port)
+    api.add_inverter('408000000001', '0001', 2)
+    return api
+
+
+def assert_returns_within(func, seconds):
+    start = time.time()
+    result = func()
+    assert time.time() - start < seconds
+    return result
+
+
+def test_wait_for_times_out_on_noise():
+    api = make_api()
+    assert assert_returns_within(lambda: api.ping_radio(timeout=200), 2) is False
+    assert assert_returns_within(lambda: api.check_coordinator(timeout=200), 2) is None
+    result = assert_returns_within(lambda: api.poll_inverter(0, timeout=200), 2)
+    assert result['error'] == 'timeout'
+
+
+def test_wait_for_times_out_on_other_frames():
+    api = make_api(COORDINATOR_STARTED_FRAME)
+    assert assert_returns_within(lambda: api.ping_radio(timeout=200), 2) is False
+    result = assert_returns_within(lambda: api.poll_inverter(0, timeout=200), 2)
+    assert result['error'] == 'timeout'
+
+
+def test_poll_all_times_out_on_noise():
+    api = make_api()
+    results = assert_returns_within(lambda: api.poll_all(timeout=200), 2)
+    assert results == {0: {'error': 'timeout'}}
+
+
+def test_poll_all_keeps_transaction_ids_unique():
+    port = NoisySerial()
+    sent = []
+    port.write = lambda data: sent.append((time.time(), bytes(data)))
+    api = ApsYc600(port, port)
+    for inverter_index in range(256):
+        api.add_inverter('4080%08d' % inverter_index, '%04X' % (inverter_index + 1), 2)
+    # Inverters 0 and 255 share transaction ID 1
+    results = api.poll_all([0, 255], timeout=200)
+    assert sorted(results) == [0, 255]
+    assert len(sent) == 2
+    assert sent[1][0] - sent[0][0] >= 0.19
+
+
+def test_poll_into_times_out_on_noise():
+    for chunk in (NOISE, COORDINATOR_STARTED_FRAME):
+        api = make_api(chunk)
+        result = assert_returns_within(lambda: api.poll_into(0, PollReading(), 200), 2)
+        assert result == 'timeout'
+
+
+def skipped_by_label(metrics):
+    return metrics.as_dict()['counters'].get('skipped_bytes', {})
+
+
+def test_parser_errors_labelled_with_single_request():
+    metrics = Metrics()
+    port = NoisySerial()
+    api = ApsYc600(port, port, metrics=metrics)
+    api.add_inverter('408000000001', '0001', 2)
+    api.add_inverter('408000000002', '0002', 2)
+    api.poll_inverter(0, timeout=100)
+    api.poll_all(timeout=100, max_in_flight=1)
+    assert set(skipped_by_label(metrics)) == {'408000000001', '408000000002'}
+    # Pipelined: the noise cannot be attributed
+    metrics.reset()
+    api.poll_all(timeout=100, max_in_flight=2)
+    assert set(skipped_by_label(metrics)) == {''}
+
+
+class NullWriter:
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_async_parser_errors_labelled_with_single_request():
+    metrics = Metrics()
+
+    async def main():
+        reader = asyncio.StreamReader()
+        api = AsyncApsYc600(reader, NullWriter(), metrics=metrics)
+        api.add_inverter('408000000001', '0001', 2)
+        api.add_inverter('408000000002', '0002', 2)
+        await api.start()
+        poll = asyncio.ensure_future(api.poll_inverter(0, timeout=100))
+        await asyncio.sleep(0.02)
+        reader.feed_data(NOISE)
+        await poll
+        single = dict(skipped_by_label(metrics))
+        metrics.reset()
+        sweep = asyncio.ensure_future(api.poll_all(timeout=100))
+        await asyncio.sleep(0.02)
+        reader.feed_data(NOISE)
+        await sweep
+        await api.close()
+        return single, skipped_by_label(metrics)
+
+    single, sweep = asyncio.run(main())
+    assert single == {'408000000001': len(NOISE)}
+    assert sweep == {'': len(NOISE)}
@@ -0,0 +1,35 @@
+'''
+Pipelined poll_all against the emulator: replies are routed by source
+address (poll data) and transaction ID (NoRoute)
+'''
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aps_emulator import Cc2530Emulator  # noqa: E402
+from aps_yc600 import ApsYc600  # noqa: E402
+
+
+def test_reordered_replies_noroute_and_timeout():
+    emulator = Cc2530Emulator(seed=1)
+    # Sent first, answered last: replies arrive in reverse order
+    emulator.add_inverter('408000000001', '0001', voltage_ac=220.0, latency=(0.4, 0.4))
+    emulator.add_inverter('408000000002', '0002', voltage_ac=225.0, latency=(0.2, 0.2))
+    emulator.add_inverter('408000000003', '0003', voltage_ac=235.0, latency=(0.01, 0.01))
+    emulator.add_inverter('408000000004', '0004', noroute=1.0)
+    emulator.add_inverter('408000000005', '0005', loss=1.0)
+    port = emulator.open_socket()
+    try:
+        api = ApsYc600(port, port)
+        for inverter in emulator.inverters:
+            api.add_inverter(inverter.serial, inverter.inv_id, inverter.panels)
+        results = api.poll_all(timeout=800, max_in_flight=5)
+    finally:
+        emulator.stop()
+    assert sorted(results) == [0, 1, 2, 3, 4]
+    for inverter_index, voltage in ((0, 220.0), (1, 225.0), (2, 235.0)):
+        assert results[inverter_index]['cmd'] == 'AF_INCOMING_MSG'
+        assert abs(results[inverter_index]['data']['voltage_ac'] - voltage) < 1
+    assert results[3] == {'error': 'NoRoute'}
+    assert results[4] == {'error': 'timeout'}
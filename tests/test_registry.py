@@ -0,0 +1,51 @@
+'''
+InverterRegistry lookups and ApsYc600.energy_data compatibility
+'''
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aps_yc600 import ApsYc600, Inverter, InverterRegistry  # noqa: E402
+
+
+def test_unpaired_inverters_are_not_routed():
+    registry = InverterRegistry()
+    registry.append(Inverter('408000000001', '0000', 2))
+    registry.append(Inverter('408000000002', '0000', 2))
+    assert registry.by_addr == {}
+    assert registry.index_by_addr(bytes(8) + b'\x00\x00') == -1
+
+
+def test_duplicate_inverter_id_is_rejected():
+    registry = InverterRegistry()
+    registry.append(Inverter('408000000001', '1234', 2))
+    registry.append(Inverter('408000000002', '0000', 2))
+    with pytest.raises(Exception):
+        registry.append(Inverter('408000000003', '1234', 2))
+    with pytest.raises(Exception):
+        registry.set_id(1, '1234')
+    registry.set_id(0, '1234')
+    registry.set_id(1, '5678')
+    assert registry.by_addr == {0x1234: 0, 0x5678: 1}
+
+
+class NullPort:
+    in_waiting = 0
+
+    def write(self, data):
+        return len(data)
+
+
+def test_energy_data_can_be_assigned():
+    api = ApsYc600(NullPort(), NullPort())
+    api.add_inverter('408000000001', '0001', 2)
+    saved = api.energy_data
+    saved[0]['last_energy_p1'] = 5.0
+    saved[0]['energy_offset_p2'] = 7.0
+    api.energy_data = saved
+    assert api.energy_data[0] == {
+        'last_energy_p1': 5.0, 'energy_offset_p1': 0.0,
+        'last_energy_p2': 0.0, 'energy_offset_p2': 7.0}